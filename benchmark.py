@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Benchmark database building steps."""
+
+# pylint: disable=invalid-name, consider-using-with
+
+from typing import Callable, Dict, List, Tuple
+from collections import Counter
+from os.path import exists
+import sys
+import time
+import argparse
+import logging
+import logging.config
+
+from lib import corpus, dbutil
+from lib.features import allfeatures
+
+wm2logconfig = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'root': {
+        'handlers': ['console'],
+        'level': 'INFO',
+    },
+    'formatters': {
+        'default_formatter': {
+            'format': '%(asctime)s %(levelname)s %(message)s',
+            'datefmt': '%d.%m.%Y %H:%M:%S'
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'default_formatter',
+            'level': 'INFO'
+        },
+    },
+}
+
+logging.config.dictConfig(wm2logconfig)
+logger = logging.getLogger('wm2')
+
+
+def time_reader(name: str, func: Callable[[], int]) -> Tuple[int, float]:
+    """Time a reader function returning a token count."""
+    start = time.perf_counter()
+    tokens = func()
+    elapsed = time.perf_counter() - start
+    rate = tokens / elapsed if elapsed > 0 else 0
+    print(f'{name:<24} {tokens:>10} tokens {elapsed:>8.2f} seconds {rate:>12.0f} tokens/s')
+    return tokens, elapsed
+
+
+def benchmark_reader(filename: str,
+                     featmap: Dict,
+                     sentencecount: int = 0):
+    """Compare the conllu parser and the fast token scanner."""
+    def parsed_tokens() -> int:
+        count = 0
+        for _idx, tokenlist in corpus.conllu_file_reader(filename, sentencecount=sentencecount):
+            count += len(tokenlist)  # type: ignore
+        return count
+
+    def scanned_tokens() -> int:
+        count = 0
+        for _idx, tokens in corpus.conllu_fast_file_reader(filename, sentencecount=sentencecount):
+            count += len(tokens)
+        return count
+
+    def parsed_freqs() -> int:
+        freqs = corpus.conllu_freq_reader(filename, featmap, sentencecount=sentencecount,
+                                          validate=True)
+        return freqs.total()
+
+    def scanned_freqs() -> int:
+        freqs = corpus.conllu_freq_reader(filename, featmap, sentencecount=sentencecount)
+        return freqs.total()
+
+    print(f'Benchmarking readers with {filename}')
+    _, parsetime = time_reader('conllu parser', parsed_tokens)
+    _, scantime = time_reader('token scanner', scanned_tokens)
+    _, parsefreqtime = time_reader('frequencies (parser)', parsed_freqs)
+    _, scanfreqtime = time_reader('frequencies (scanner)', scanned_freqs)
+    if scantime > 0 and scanfreqtime > 0:
+        print(f'Speedup: reading {parsetime / scantime:.1f}x, frequencies {parsefreqtime / scanfreqtime:.1f}x')
+
+
+def python_gram_freqs(rows: List[Tuple[str, int]]) -> Tuple[Counter, Counter, Counter, List[Tuple[str, int]]]:
+    """Count gram frequencies with a loop over the wordfreqs rows (the earlier implementation)."""
+    init, fin, bi = Counter(), Counter(), Counter()  # type: ignore
+    for form, freq in rows:
+        for i in range(len(form) - 1):
+            bi[form[i:i+2]] += freq
+        if len(form) < 4:
+            continue
+        init[form[:3]] += freq
+        fin[form[-3:]] += freq
+    wordbigrams = []
+    for form in sorted(set(form for form, _freq in rows)):
+        freqs = [bi[form[i:i+2]] for i in range(len(form) - 1)]
+        wordbigrams.append((form, sum(freqs) // len(freqs) if freqs else 0))
+    return init, fin, bi, wordbigrams
+
+
+def benchmark_grams(dbfile: str):
+    """Compare the gram frequency loop and the vectorized gram frequency counting."""
+    sqlcon = dbutil.get_connection(dbfile)
+    start = time.perf_counter()
+    rows = sqlcon.execute('select form, frequency from wordfreqs').fetchall()
+    print(f'Loaded {len(rows)} rows in {time.perf_counter() - start:.2f} seconds')
+
+    start = time.perf_counter()
+    expected = python_gram_freqs(rows)
+    looptime = time.perf_counter() - start
+    print(f'{"python loop":<24} {looptime:>8.2f} seconds')
+
+    start = time.perf_counter()
+    result = dbutil.get_gram_freqs(sqlcon)
+    vectortime = time.perf_counter() - start
+    print(f'{"vectorized":<24} {vectortime:>8.2f} seconds (including the grouping query)')
+
+    if list(result[:3]) != list(expected[:3]) or sorted(result[3]) != expected[3]:
+        logger.warning('Gram frequencies differ')
+    if vectortime > 0:
+        print(f'Speedup: {looptime / vectortime:.1f}x')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='benchmark',
+                                     description='Benchmark database building steps')
+
+    parser.add_argument('-c', '--cmd',
+                        type=str,
+                        required=True,
+                        choices=['reader', 'grams'],
+                        help='Benchmark to run')
+
+    parser.add_argument('-i', '--input',
+                        type=str,
+                        help='Input file')
+
+    parser.add_argument('-d', '--dbfile',
+                        type=str,
+                        help='Database file (feature map for reader, frequencies for grams)')
+
+    parser.add_argument('-s', '--sentencecount',
+                        type=int,
+                        default=0,
+                        help='Sentence count')
+
+    args = parser.parse_args()
+
+    if args.cmd == 'reader':
+        if not args.input or not exists(args.input):
+            logger.warning('No such file: %s', args.input)
+            sys.exit()
+        if args.dbfile:
+            featmap = dbutil.DatabaseConnection(args.dbfile, aggregates=False).featmap()
+        else:
+            featmap = dict(allfeatures)
+        benchmark_reader(args.input, featmap, args.sentencecount)
+
+    if args.cmd == 'grams':
+        if not args.dbfile or not exists(args.dbfile):
+            logger.warning('No such file: %s', args.dbfile)
+            sys.exit()
+        benchmark_grams(args.dbfile)
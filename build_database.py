@@ -15,115 +15,166 @@ from lib import corpus, dbutil, buildutil
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('build-database')
 
-parser = argparse.ArgumentParser(prog='build-database',
-                                 description='Generate SQL database from CoNLL file')
-
-parser.add_argument('-i', '--input',
-                    type=str,
-                    required=True,
-                    help='Input directory/file')
-
-parser.add_argument('-d', '--dbfile',
-                    type=str,
-                    required=True,
-                    help='DBfile')
-
-parser.add_argument('-n', '--newfile',
-                    action='store_true',
-                    help='New db file')
-
-parser.add_argument('-N', '--noindex',
-                    action='store_true',
-                    help='Do not add wordfreqs indexes to the database')
-
-parser.add_argument('-v', '--verbose',
-                    action='store_true',
-                    help='Verbose')
-
-parser.add_argument('-c', '--count',
-                    type=int,
-                    help='File count')
-
-parser.add_argument('-s', '--sentencecount',
-                    type=int,
-                    help='Sentence count')
-
-parser.add_argument('-t', '--trashfile',
-                    type=str,
-                    help='Trash file')
-
-parser.add_argument('-o', '--origcase',
-                    action='store_true',
-                    help='Original case')
-
-parser.add_argument('-l', '--language',
-                    type=str,
-                    required=False,
-                    help='Language code')
-
-args = parser.parse_args()
-
-
-if not exists(args.input):
-    logger.warning('No such file: %s', args.input)
-    sys.exit()
-
-dbc = None
-
-if not exists(args.dbfile):
-    if args.newfile:
-        dbc = buildutil.create_database(args.dbfile,
-                                        language=args.language)
-#        creationscripts = ['wordfreqs2.sql', 'features.sql']
-#        print(f'Creating database at {args.dbfile}')
-#        dbc = dbutil.DatabaseConnection(args.dbfile, aggregates=False)
-#        sqlcon = dbc.get_connection()
-#        cursor = sqlcon.cursor()
-#        for sqlfile in creationscripts:
-#            with open(f'sql/{sqlfile}', 'r', encoding='utf8') as schemafile:
-#                sqldata = schemafile.read()
-#                cursor.executescript(sqldata)
-#                sqlcon.commit()
-#        dbc.record_features()
-    else:
-        logger.warning('No such file: %s', args.dbfile)
-        sys.exit()
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='build-database',
+                                     description='Generate SQL database from CoNLL file')
+
+    parser.add_argument('-i', '--input',
+                        type=str,
+                        required=True,
+                        help='Input directory/file')
+
+    parser.add_argument('-d', '--dbfile',
+                        type=str,
+                        required=True,
+                        help='DBfile')
+
+    parser.add_argument('-n', '--newfile',
+                        action='store_true',
+                        help='New db file')
+
+    parser.add_argument('-N', '--noindex',
+                        action='store_true',
+                        help='Do not add wordfreqs indexes to the database')
 
-# FIXME: check that dbfile is a SQLite database?
+    parser.add_argument('-v', '--verbose',
+                        action='store_true',
+                        help='Verbose')
 
-if not dbc:
-    dbc = dbutil.DatabaseConnection(args.dbfile, aggregates=False)
+    parser.add_argument('-c', '--count',
+                        type=int,
+                        help='File count')
 
-trashfh = None
+    parser.add_argument('-s', '--sentencecount',
+                        type=int,
+                        help='Sentence count')
 
-featmap = dbc.featmap()
-logger.info('Features in the database %s: %s', args.dbfile, featmap)
+    parser.add_argument('-t', '--trashfile',
+                        type=str,
+                        help='Trash file')
 
-if args.trashfile:
-    print(f'Storing discarded strings to file {args.trashfile}')
-    trashfh = open(args.trashfile, 'w', encoding='utf-8')
+    parser.add_argument('-o', '--origcase',
+                        action='store_true',
+                        help='Original case')
 
-data = corpus.conllu_reader(args.input,
-                            featmap=featmap,
-                            verbose=args.verbose,
-                            origcase=args.origcase,
-                            sentencecount=args.sentencecount,
-                            trashfile=trashfh,
-                            filecount=args.count)
-if trashfh:
-    trashfh.close()
+    parser.add_argument('-l', '--language',
+                        type=str,
+                        required=False,
+                        help='Language code')
 
-print(f'Storing {len(data[0])} unigram frequencies to database {args.dbfile}')
-dbutil.write_freqs_to_db(dbc, data)
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='Number of worker processes for reading input files')
 
-if not args.noindex:
-    print('Adding indexes..')
-    indexscripts = ['wordfreqs_indexes.sql']
+    parser.add_argument('-V', '--validate',
+                        action='store_true',
+                        help='Parse input files with the full conllu parser (slower)')
 
-    sqlcon = dbc.get_connection()
-    cursor = sqlcon.cursor()
-    for sqlfile in indexscripts:
-        with open(f'sql/{sqlfile}', 'r', encoding='utf8') as schemafile:
-            sqldata = schemafile.read()
-            cursor.executescript(sqldata)
-            sqlcon.commit()
+    parser.add_argument('-m', '--memory-budget',
+                        type=int,
+                        help='Approximate memory budget for frequencies in megabytes; '
+                        'frequencies exceeding it are spilled to temporary files')
+
+    parser.add_argument('-r', '--resume',
+                        action='store_true',
+                        help='Store frequencies after each input file and skip files already stored '
+                        '(resumable and incremental builds)')
+
+    args = parser.parse_args()
+
+    if not exists(args.input):
+        logger.warning('No such file: %s', args.input)
+        sys.exit()
+
+    dbc = None
+
+    if not exists(args.dbfile):
+        if args.newfile:
+            dbc = buildutil.create_database(args.dbfile,
+                                            language=args.language)
+            # creationscripts = ['wordfreqs2.sql', 'features.sql']
+            # print(f'Creating database at {args.dbfile}')
+            # dbc = dbutil.DatabaseConnection(args.dbfile, aggregates=False)
+            # sqlcon = dbc.get_connection()
+            # cursor = sqlcon.cursor()
+            # for sqlfile in creationscripts:
+            #     with open(f'sql/{sqlfile}', 'r', encoding='utf8') as schemafile:
+            #         sqldata = schemafile.read()
+            #         cursor.executescript(sqldata)
+            #         sqlcon.commit()
+            # dbc.record_features()
+        else:
+            logger.warning('No such file: %s', args.dbfile)
+            sys.exit()
+
+    # FIXME: check that dbfile is a SQLite database?
+
+    if not dbc:
+        dbc = dbutil.DatabaseConnection(args.dbfile, aggregates=False)
+        buildutil.drop_query_table(dbc.get_connection())
+        buildutil.drop_trigram_table(dbc.get_connection())
+
+    trashfh = None
+
+    featmap = dbc.featmap()
+    logger.info('Features in the database %s: %s', args.dbfile, featmap)
+
+    if args.trashfile:
+        print(f'Storing discarded strings to file {args.trashfile}')
+        trashfh = open(args.trashfile, 'w', encoding='utf-8')
+
+    memory_budget = args.memory_budget * 2**20 if args.memory_budget else None
+
+    buildutil.report_peak_rss('before reading input', children=args.jobs > 1)
+    if args.resume:
+        buildutil.ingest_files(dbc,
+                               args.input,
+                               verbose=args.verbose,
+                               origcase=args.origcase,
+                               sentencecount=args.sentencecount,
+                               trashfile=trashfh,
+                               filecount=args.count,
+                               jobs=args.jobs,
+                               validate=args.validate,
+                               memory_budget=memory_budget)
+        if trashfh:
+            trashfh.close()
+    else:
+        data = corpus.conllu_reader(args.input,
+                                    featmap=featmap,
+                                    verbose=args.verbose,
+                                    origcase=args.origcase,
+                                    sentencecount=args.sentencecount,
+                                    trashfile=trashfh,
+                                    filecount=args.count,
+                                    jobs=args.jobs,
+                                    validate=args.validate,
+                                    memory_budget=memory_budget)
+        if trashfh:
+            trashfh.close()
+
+        buildutil.report_peak_rss('after reading input', children=args.jobs > 1)
+
+        if data.runs:
+            print(f'Storing unigram frequencies from {len(data.runs)} sorted runs to database {args.dbfile}')
+        else:
+            print(f'Storing {len(data)} unigram frequencies to database {args.dbfile}')
+        try:
+            dbutil.write_freqs_to_db(dbc, data)
+        finally:
+            data.remove_runs()
+    buildutil.report_peak_rss('after storing frequencies', children=args.jobs > 1)
+
+    if not args.noindex:
+        print('Adding indexes..')
+        indexscripts = ['wordfreqs_indexes.sql']
+
+        sqlcon = dbc.get_connection()
+        cursor = sqlcon.cursor()
+        for sqlfile in indexscripts:
+            with open(f'sql/{sqlfile}', 'r', encoding='utf8') as schemafile:
+                sqldata = schemafile.read()
+                cursor.executescript(sqldata)
+                sqlcon.commit()
@@ -10,7 +10,7 @@ import sys
 import argparse
 import logging
 import logging.config
-from lib import dbutil
+from lib import dbutil, buildutil
 
 # from tqdm.autonotebook import tqdm
 
@@ -63,6 +63,7 @@ if not exists(args.dbfile):
     sys.exit()
 
 sqlcon = dbutil.get_connection(args.dbfile)
+buildutil.drop_query_table(sqlcon)
 
 print(f'Add frequency tables to {args.dbfile}...')
 with open('sql/gramfreqs.sql', 'r', encoding='utf8') as schemafile:
@@ -71,13 +72,16 @@ with open('sql/gramfreqs.sql', 'r', encoding='utf8') as schemafile:
     cursor.executescript(sqldata)
 
 print('Generating gram frequencies..')
-gramfreqs = dbutil.get_trigram_freqs(sqlcon)
+gramfreqs = dbutil.get_gram_freqs(sqlcon)
 
-init, fin, bi = gramfreqs
+init, fin, bi, wordbigrams = gramfreqs
 print(f'Got {len(init)}, {len(fin)}, {len(bi)} init/fin/bigram frequencies')
 
 print('Inserting trigram frequencies..')
 dbutil.insert_trigram_freqs(sqlcon, init, fin, bi, args.empty)
 
 print('Inserting wordform bigram frequencies..')
-dbutil.insert_bigram_freqs(sqlcon, bi, args.empty)
+dbutil.insert_bigram_freqs(sqlcon, wordbigrams, args.empty)
+
+print('Storing aggregate totals..')
+dbutil.store_aggregate_totals(sqlcon)
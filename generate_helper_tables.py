@@ -5,20 +5,17 @@
 # import os
 from os.path import exists
 # from os.path import isdir, isfile, exists
-from typing import Dict, List, Iterator, Tuple
+from typing import Dict, List
 # import sys
 import argparse
 import logging
 import logging.config
 import math
-from collections import Counter
 import sqlite3
 from sqlite3 import IntegrityError
-import pandas as pd
 from tqdm.autonotebook import tqdm
-from symspellpy import SymSpell, Verbosity
-from uralicNLP import uralicApi
-from lib import dbutil, buildutil
+from lib import dbutil, buildutil, hood
+from lib.memo import PersistentCache
 
 wm2logconfig = {
     'version': 1,
@@ -49,42 +46,24 @@ logger = logging.getLogger('wm2')
 
 
 def record_pos_frequency(sqlcon: sqlite3.Connection):
-    """Aggregate frequency for pos/posx."""
-    # dbutil.adhoc_query(sqlcon, "alter table wordfreqs add column frequencyx INT default 0")
-    # dbutil.adhoc_query(sqlcon, "update wordfreqs set frequencyx = frequency")
+    """Aggregate frequency for pos/posx.
 
+    Verb rows sharing lemma, form and feats (e.g. VERB and AUX) get their
+    combined frequency as frequencyx.
+    """
     updatestatement = "update wordfreqs set frequencyx = frequency"
     dbutil.adhoc_query(sqlcon, updatestatement, verbose=True)
 
-    print('Fetching information for recording aggregate frequencies...')
-    posdf = dbutil.adhoc_query(sqlcon, "select id, lemma, form, frequency, frequencyx, pos, posx, feats from wordfreqs where posx = 'VERB'", todf=True)
-
-    posagg1 = posdf.groupby(['lemma', 'form',
-                             'posx', 'feats']).aggregate({'id': 'first', 'pos': 'first', 'frequency': 'sum'},
-                                                         ).sort_values(by='id').reset_index()
-    posagg2 = posdf.groupby(['lemma', 'form',
-                             'posx', 'feats']).aggregate({'id': 'last', 'pos': 'last', 'frequency': 'sum'},
-                                                         ).sort_values(by='id').reset_index()
-
-    posagg = posagg1.merge(posagg2, how='outer').sort_values(by='id').reset_index()
-    posagg = posagg.reindex(columns=['id', 'lemma', 'form', 'frequency', 'frequencyx', 'pos', 'posx', 'feats'])
-
-    posdf2 = posdf.copy().sort_values(by='id').reset_index()
-    posdf2.frequencyx = posagg.frequency
-
-    # Only update the changed values
-    changedf = posdf2[(posdf2.frequency != posdf2.frequencyx)].sort_values(by='frequencyx', ascending=False)
-    updatestatement = "update wordfreqs set frequencyx = ? where id = ?"
-    updates = [[row.frequencyx, row.id] for _idx, row in changedf.iterrows()]
-    cursor = sqlcon.cursor()
-
-    try:
-        cursor.executemany(updatestatement, updates)
-        sqlcon.commit()
-    except IntegrityError as e:
-        # this is not ok
-        logging.exception(e)
-        sqlcon.rollback()
+    print('Calculating aggregate frequencies...')
+    dbutil.adhoc_query(sqlcon, "drop table if exists temp.posxfreqs")
+    posxsql = """create temp table posxfreqs as select id, frequencyx from (select id, frequency,
+    sum(frequency) over (partition by lemma, form, posx, feats) as frequencyx from wordfreqs where posx = 'VERB')
+    where frequencyx != frequency"""
+    dbutil.adhoc_query(sqlcon, posxsql, verbose=True)
+    dbutil.adhoc_query(sqlcon, "create unique index temp.idx_posxfreqs_id on posxfreqs(id)")
+    buildutil.update_from(sqlcon, 'wordfreqs', {'frequencyx': 'src.frequencyx'},
+                          'temp.posxfreqs', 'wordfreqs.id = src.id')
+    dbutil.adhoc_query(sqlcon, "drop table temp.posxfreqs")
 
 
 def generate_form_aggregates(sqlcon: sqlite3.Connection):
@@ -98,11 +77,14 @@ def generate_form_aggregates(sqlcon: sqlite3.Connection):
         formsql = "insert into lemmaforms select lemma, form, posx as pos, sum(frequency) as frequency, 0 as formpct, 0 as formsum from wordfreqs group by lemma, form, posx order by frequency desc"
         dbutil.adhoc_query(sqlcon, formsql)
 
-    formcounts = "update lemmaforms set formsum = (select sum(l.frequency) from lemmaforms l where l.form = lemmaforms.form group by form)"
+    dbutil.adhoc_query(sqlcon, "drop table if exists temp.formsums")
+    formcounts = "create temp table formsums as select form, sum(frequency) as formsum from lemmaforms group by form"
     dbutil.adhoc_query(sqlcon, formcounts, verbose=True)
-
-    formpct = "update lemmaforms set formpct = frequency / cast(formsum as real)"
-    dbutil.adhoc_query(sqlcon, formpct, verbose=True)
+    dbutil.adhoc_query(sqlcon, "create unique index temp.idx_formsums_form on formsums(form)")
+    buildutil.update_from(sqlcon, 'lemmaforms',
+                          {'formsum': 'src.formsum', 'formpct': 'lemmaforms.frequency / cast(src.formsum as real)'},
+                          'temp.formsums', 'lemmaforms.form = src.form')
+    dbutil.adhoc_query(sqlcon, "drop table temp.formsums")
 
     print('Checking table forms...')
     have = dbutil.adhoc_query(sqlcon, 'select * from forms limit 1')
@@ -118,8 +100,8 @@ def record_hood(sqlcon: sqlite3.Connection, counts: Dict):
     """Record neighbourhood to forms table."""
     updatestatement = "update forms set hood = ? where form = ?"
     updvalues = []
-    for form, hood in counts.items():
-        updvalues.append([hood, form])
+    for form, count in counts.items():
+        updvalues.append([count, form])
 
     chunklen = 1000
     total = math.ceil(len(updvalues)/chunklen)
@@ -135,94 +117,16 @@ def record_hood(sqlcon: sqlite3.Connection, counts: Dict):
             sqlcon.rollback()
 
 
-def get_form_suggestions(df: pd.DataFrame, sym_spell) -> Iterator[Tuple[str, List[Tuple[str, int]]]]:
-    """Get iterator for form suggestions."""
-    # sym_spell = SymSpell(max_dictionary_edit_distance=1)
-    autofreq = 10000
-    minfreq = 100
-
-    for _idx, row in tqdm(df.iterrows(), total=len(df)):
-        form = row.form
-        # freq = row.frequency
-        suggestions = sym_spell.lookup(form, Verbosity.ALL)
-        formfinals = []
-
-        # Drop suggestion when 1) low frequency and 2) no morph analysis
-        for suggestion in suggestions:
-            ok = False
-            res = []
-            if suggestion.distance == 0:
-                ...
-            elif suggestion.count >= autofreq:
-                ok = True
-            elif suggestion.count < minfreq:
-                ...
-            else:
-                res = uralicApi.analyze(suggestion.term, "fin")
-                if len(res) > 0:
-                    ok = True
-            if ok:
-                formfinals.append((suggestion.term, suggestion.count))
-
-        yield form, formfinals
-
-
-def generate_hood(sqlcon: sqlite3.Connection):
+def generate_hood(sqlcon: sqlite3.Connection, jobs: int = 1, cachefile: str = hood.analysiscache):
     """Generate neighbourhood to forms table."""
     print('Loading form information for neighbourhood calculation...')
-    sdf = dbutil.adhoc_query(sqlcon, "select * from forms", todf=True)
-    sym_spell = SymSpell(max_dictionary_edit_distance=1)
-
-    print('Generating spelling dictionary...')
-    for _idx, row in tqdm(sdf.iterrows(), total=len(sdf)):
-        form = row.form
-        freq = row.frequency
-        sym_spell.create_dictionary_entry(form, freq)
-
-    # autofreq = 10000
-    # minfreq = 100
-    finals = {}  # type: ignore
-
-    print('Generating edit distances...')
-    for form, formfinals in get_form_suggestions(sdf, sym_spell):
-        finals[form] = formfinals
-
-#    for _idx, row in tqdm(sdf.iterrows(), total=len(sdf)):
-#        form = row.form
-#        freq = row.frequency
-#        suggestions = sym_spell.lookup(form, Verbosity.ALL)
-#        formfinals = []
-#
-#        # Drop suggestion when 1) low frequency and 2) no morph analysis
-#        for suggestion in suggestions:
-#            ok = False
-#            res = []
-#            if suggestion.distance == 0:
-#                ...
-#            elif suggestion.count >= autofreq:
-#                ok = True
-#            elif suggestion.count < minfreq:
-#                ...
-#            else:
-#                res = uralicApi.analyze(suggestion.term, "fin")
-#                if len(res) > 0:
-#                    ok = True
-#            if ok:
-#                formfinals.append((suggestion.term, suggestion.count))
-#        finals[form] = formfinals
-#        # break
-
-    levdict = Counter()  # type: ignore
-    hamdict = Counter()  # type: ignore
-
-    for key, analysis in finals.items():
-        levs = [w for w, _ in analysis]
-        hams = [w for w, _ in analysis if len(w) == len(key)]
-        levdict[key] = len(levs)
-        hamdict[key] = len(hams)
-
-    # print(levdict)
-    # print(hamdict)
+    rows = dbutil.adhoc_query(sqlcon, "select form, frequency from forms")
+    forms = [row[0] for row in rows]
+    freqs = [row[1] for row in rows]
+
+    print(f'Generating neighbourhoods, with analyses cached in {cachefile}...')
+    analyses = PersistentCache(hood.analyzable, cachefile, namespace='fin')
+    hamdict = hood.hood_counts(forms, freqs, analyses, jobs=jobs)
     record_hood(sqlcon, hamdict)
 
 
@@ -250,17 +154,14 @@ def update_table(sqlcon: sqlite3.Connection,
 
 def copy_to_wordfreqs(sqlcon: sqlite3.Connection):
     """Copy info to wordfreqs table."""
-    fetchst = "select hood, form from forms"
-    data = dbutil.adhoc_query(sqlcon, fetchst)
-    print('Getting hood information from forms table...')
-    updatestatement = "update wordfreqs set hood = ? where form = ? and hood = 0"
-    update_table(sqlcon, 'wordfreqs', updatestatement, data)
+    print('Copying hood information from forms table...')
+    buildutil.update_from(sqlcon, 'wordfreqs', {'hood': 'src.hood'},
+                          'forms', 'wordfreqs.form = src.form', where='wordfreqs.hood = 0')
 
-    fetchst = "select 1-formpct, lemma, form, pos from lemmaforms"
-    data = dbutil.adhoc_query(sqlcon, fetchst)
-    print('Getting ambform information from lemmaforms table...')
-    updatestatement = "update wordfreqs set ambform = ? where lemma = ? and form = ? and posx = ? and ambform = 0"
-    update_table(sqlcon, 'wordfreqs', updatestatement, data)
+    print('Copying ambform information from lemmaforms table...')
+    buildutil.update_from(sqlcon, 'wordfreqs', {'ambform': '1 - src.formpct'}, 'lemmaforms',
+                          'wordfreqs.lemma = src.lemma and wordfreqs.form = src.form and wordfreqs.posx = src.pos',
+                          where='wordfreqs.ambform = 0')
 
 
 def generate_lemma_aggregates(sqlcon: sqlite3.Connection):
@@ -271,105 +172,54 @@ def generate_lemma_aggregates(sqlcon: sqlite3.Connection):
         print('Table lemmas already has content, not inserting')
     else:
         print('Inserting aggregates into lemmas table...')
-        lemmasql = "insert into lemmas select lemma, replace(lemma, '#', '') as lemmac, posx as pos, sum(frequency) as lemmafreq, length(lemma) as lemmalen, 0 as amblemma, 0 as comparts from wordfreqs group by lemma, posx order by lemmafreq desc"
+        lemmasql = """insert into lemmas select lemma, replace(lemma, '#', '') as lemmac, posx as pos,
+        sum(frequency) as lemmafreq, length(lemma) as lemmalen, 0 as amblemma, 0 as comparts
+        from wordfreqs group by lemma, posx order by lemmafreq desc"""
         dbutil.adhoc_query(sqlcon, lemmasql)
         updatestatement = "update lemmas set lemmalen = length(lemmac)"
         dbutil.adhoc_query(sqlcon, updatestatement)
 
-    lemmadf = dbutil.adhoc_query(sqlcon, "select lemma from lemmas where instr(lemma, '#') > 0", todf=True, verbose=True)
-    updatestatement = "update lemmas set comparts = ? where lemma = ?"
-    insvalues = []
-    for lemma in lemmadf.lemma:
-        compval = lemma.count('#')
-        insvalues.append([compval, lemma])
-
-    chunklen = 10000
-    total = math.ceil(len(insvalues)/chunklen)
-    cursor = sqlcon.cursor()
-    print(f'Updating {len(lemmadf)} compound lemmas')
-    for chunk in tqdm(dbutil.chunks(insvalues, chunklen=chunklen), total=total):
-        try:
-            cursor.executemany(updatestatement, chunk)
-            sqlcon.commit()
-        except IntegrityError as e:
-            # this is not ok
-            logging.exception(e)
-            sqlcon.rollback()
+    print('Updating compound lemmas...')
+    updatestatement = """update lemmas set comparts = length(lemma) - length(replace(lemma, '#', ''))
+    where instr(lemma, '#') > 0"""
+    dbutil.adhoc_query(sqlcon, updatestatement, verbose=True)
 
+    # The frequency of forms that are (almost) unambiguous for the lemma, pos
     print('Generating amblemma percentages...')
-    lffreqsql = "select lf.lemma, lf.pos, sum(lf.frequency) as lfreq, l.lemmafreq, (select sum(lx.frequency) from lemmaforms lx, forms fx where (fx.numforms = 1 OR lx.formpct > 0.99) and lx.form = fx.form and lx.lemma = lf.lemma and lx.pos = lf.pos group by lx.lemma, lx.pos) as numfreq from lemmaforms lf, lemmas l where lf.lemma = l.lemma and lf.pos = l.pos group by lf.lemma, lf.pos order by lfreq desc"
-    lffreqdf = dbutil.adhoc_query(sqlcon, lffreqsql, todf=True, verbose=True)
-    print(f'Fetched {len(lffreqdf)} lemma, pos frequencies')
-
-    l2 = lffreqdf.copy()
-    l2['amblemma'] = (l2.lfreq - l2.numfreq) / l2.lfreq
-    l2.loc[l2.amblemma.isnull(), 'amblemma'] = 1
-    updvalues = l2[['amblemma', 'lemma', 'pos']].values
-
-#    updvalues2 = []
-#    for _idx, row in lffreqdf.iterrows():
-#        lemma = row.lemma
-#        pos = row.pos
-#        tot = row.lemmafreq
-#        uniques = row.numfreq
-#        if math.isnan(uniques):
-#            pct = 1
-#        else:
-#            pct = (tot-uniques)/tot
-#        # print(lemma, pos, tot, uniques, pct)
-#        updvalues2.append([pct, lemma, pos])
-
-    # print(lffreqdf[lffreqdf.lemma == 'ilman'][:10])
-    # print(lffreqdf[lffreqdf.numfreq.isnull()][:10])
-
-    updatestatement = "update lemmas set amblemma = ? where lemma = ? and pos = ?"
-    # chunklen = 1
-    print('Updating amblemma frequencies...')
-    total = math.ceil(len(updvalues)/chunklen)
-    cursor = sqlcon.cursor()
-    for chunk in tqdm(dbutil.chunks(updvalues, chunklen=chunklen), total=total):
-        try:
-            cursor.executemany(updatestatement, chunk)
-            sqlcon.commit()
-        except IntegrityError as e:
-            # this is not ok
-            print(chunk)
-            logging.exception(e)
-            sqlcon.rollback()
-
-
-def add_feat_pos_indexes(sqlcon: sqlite3.Connection):
-    """Add feats/pos indexes for building features tables."""
-    idx_sql = 'CREATE INDEX IF NOT EXISTS idx_wordfreqs_feats_pos_featid_partial on wordfreqs(feats, pos, featid) where featid = 0'
-    dbutil.adhoc_query(sqlcon, idx_sql)
+    dbutil.adhoc_query(sqlcon, "drop table if exists temp.lemmaformfreqs")
+    lffreqsql = """create temp table lemmaformfreqs as select lf.lemma, lf.pos, sum(lf.frequency) as lfreq,
+    sum(case when f.numforms = 1 or lf.formpct > 0.99 then lf.frequency end) as numfreq
+    from lemmaforms lf left join forms f on lf.form = f.form group by lf.lemma, lf.pos"""
+    dbutil.adhoc_query(sqlcon, lffreqsql, verbose=True)
+    dbutil.adhoc_query(sqlcon, "create unique index temp.idx_lemmaformfreqs on lemmaformfreqs(lemma, pos)")
+    buildutil.update_from(sqlcon, 'lemmas',
+                          {'amblemma': 'coalesce((src.lfreq - src.numfreq) / cast(src.lfreq as real), 1)'},
+                          'temp.lemmaformfreqs', 'lemmas.lemma = src.lemma and lemmas.pos = src.pos')
+    dbutil.adhoc_query(sqlcon, "drop table temp.lemmaformfreqs")
 
 
 def add_feature_index(sqlcon: sqlite3.Connection):
-    """Add feature index to wordfreqs table."""
+    """Add feature index to wordfreqs rows without one.
+
+    Feature ids are assigned when the frequencies are stored, so only rows
+    from older databases or concatenated databases need to be updated.
+    """
     # print('Adding feature index...')
-    featuresql = "select featid, feats, pos from features"
-    features = dbutil.adhoc_query(sqlcon, featuresql, todf=True, verbose=True)
     have = dbutil.adhoc_query(sqlcon, 'select count(*) from wordfreqs where featid = 0')
     if have[0][0] == 0:
         print('No feature ids to update')
     else:
-        print("Updating featid to wordfreqs table...")
-        updatestatement = "update wordfreqs set featid = ? where feats = ? and pos = ? and featid = 0"
-        insvalues = []
-        for featid, feats, pos in tqdm(zip(features.featid, features.feats, features.pos), total=len(features)):
-            insvalues.append([featid, feats, pos])
-
-            chunklen = 100
-            # total = math.ceil(len(insvalues)/chunklen)
-            cursor = sqlcon.cursor()
-            for chunk in dbutil.chunks(insvalues, chunklen=chunklen):
-                try:
-                    cursor.executemany(updatestatement, chunk)
-                    sqlcon.commit()
-                except IntegrityError as e:
-                    # this is not ok
-                    logging.exception(e)
-                    sqlcon.rollback()
+        print(f"Updating featid of {have[0][0]} rows to wordfreqs table...")
+        updatestatement = """update wordfreqs set featid = coalesce((select f.featid from features f
+        where f.feats = wordfreqs.feats and f.pos = wordfreqs.pos), 0) where featid = 0"""
+        cursor = sqlcon.cursor()
+        try:
+            cursor.execute(updatestatement)
+            sqlcon.commit()
+        except IntegrityError as e:
+            # this is not ok
+            logging.exception(e)
+            sqlcon.rollback()
 
 
 # def drop_indexes(sqlcon: sqlite3.Connection,
@@ -474,6 +324,24 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Copy computed forms information to wordfreqs table')
 
+    parser.add_argument('-Q', '--query-table',
+                        action='store_true',
+                        help='Create the query table joining wordfreqs, features, lemmas and gram frequencies')
+
+    parser.add_argument('-T', '--trigrams',
+                        action='store_true',
+                        help='Create the trigram index of forms for middle queries')
+
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='Number of worker processes for calculating the neighbourhood')
+
+    parser.add_argument('-A', '--analysis-cache',
+                        type=str,
+                        default=hood.analysiscache,
+                        help=f'Cache file for morphological analyses (default: {hood.analysiscache})')
+
     args = parser.parse_args()
 
     dbc = dbutil.DatabaseConnection(args.dbfile, aggregates=False)
@@ -482,6 +350,9 @@ if __name__ == '__main__':
     print(f'Generating helper table info to {args.dbfile}')
     buildutil.add_schema(sqlconn, "wordfreqs_indexes.sql")
 
+    if args.all or args.posx or args.features or args.forms or args.lemmas or args.hood or args.copy:
+        buildutil.drop_query_table(sqlconn)
+
     if args.forms or args.all:
         buildutil.add_schema(sqlconn, 'forms.sql')
 #        print('Adding forms.sql...')
@@ -521,8 +392,8 @@ if __name__ == '__main__':
     if args.features or args.all:
         # buildutil.drop_indexes(sqlconn, "_wordfreqs_featid")
         buildutil.add_features(dbc)
-        add_feat_pos_indexes(sqlconn)
         add_feature_index(sqlconn)
+        # Partial index used by older versions
         buildutil.drop_indexes(sqlconn, "featid_partial")
         # buildutil.add_schema(sqlconn, "wordfreqs_indexes.sql")
         create_feature_table(dbc, 'derivations', 'derivation')
@@ -538,7 +409,16 @@ if __name__ == '__main__':
         generate_lemma_aggregates(sqlconn)
 
     if args.hood or args.all:
-        generate_hood(sqlconn)
+        generate_hood(sqlconn, jobs=args.jobs, cachefile=args.analysis_cache)
 
     if args.copy:
         copy_to_wordfreqs(sqlconn)
+
+    if args.query_table:
+        buildutil.create_query_table(sqlconn)
+
+    if args.trigrams:
+        buildutil.create_trigram_table(sqlconn)
+
+    print('Storing aggregate totals...')
+    dbutil.store_aggregate_totals(sqlconn)
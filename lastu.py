@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Run database build stages."""
+
+# pylint: disable=invalid-name
+
+from os.path import abspath, exists
+import os
+import sys
+import time
+import argparse
+import logging
+import logging.config
+from tabulate import tabulate
+
+from lib import pipeline
+
+wm2logconfig = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'root': {
+        'handlers': ['console'],
+        'level': 'INFO',
+    },
+    'formatters': {
+        'default_formatter': {
+            'format': '%(asctime)s %(levelname)s %(message)s',
+            'datefmt': '%d.%m.%Y %H:%M:%S'
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'default_formatter',
+            'level': 'INFO'
+        },
+    },
+}
+
+logging.config.dictConfig(wm2logconfig)
+logger = logging.getLogger('wm2')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='lastu',
+                                     description='Lastu database tools')
+
+    subparsers = parser.add_subparsers(dest='cmd', required=True)
+
+    buildparser = subparsers.add_parser('build',
+                                        help='Build a database from CoNLL files, skipping completed stages')
+
+    buildparser.add_argument('-i', '--input',
+                             type=str,
+                             help='Input directory/file')
+
+    buildparser.add_argument('-d', '--dbfile',
+                             type=str,
+                             required=True,
+                             help='Database file')
+
+    buildparser.add_argument('-j', '--jobs',
+                             type=int,
+                             default=1,
+                             help='Number of stages to run concurrently')
+
+    buildparser.add_argument('-J', '--reader-jobs',
+                             type=int,
+                             default=1,
+                             help='Number of worker processes for reading input files')
+
+    buildparser.add_argument('-s', '--stages',
+                             type=str,
+                             nargs='+',
+                             help='Stages to build (with their dependencies); '
+                             'default: all stages except optional ones not built before')
+
+    buildparser.add_argument('-R', '--redo',
+                             type=str,
+                             nargs='+',
+                             help='Stages to run again, along with the stages depending on them')
+
+    buildparser.add_argument('-L', '--logdir',
+                             type=str,
+                             help='Directory for the output of concurrent stages (default: <dbfile>.logs)')
+
+    buildparser.add_argument('-l', '--language',
+                             type=str,
+                             help='Language code')
+
+    buildparser.add_argument('-m', '--memory-budget',
+                             type=int,
+                             help='Approximate memory budget for frequencies in megabytes')
+
+    buildparser.add_argument('-r', '--resume',
+                             action='store_true',
+                             help='Store frequencies after each input file and skip files already stored')
+
+    buildparser.add_argument('-V', '--validate',
+                             action='store_true',
+                             help='Parse input files with the full conllu parser (slower)')
+
+    args = parser.parse_args()
+
+    if args.cmd == 'build':
+        dbfile = abspath(args.dbfile)
+
+        buildargs = ['-j', str(args.reader_jobs)]
+        if args.input:
+            buildargs += ['-i', abspath(args.input)]
+        if args.language:
+            buildargs += ['-l', args.language]
+        if args.memory_budget:
+            buildargs += ['-m', str(args.memory_budget)]
+        if args.resume:
+            buildargs.append('-r')
+        if args.validate:
+            buildargs.append('-V')
+
+        stages = pipeline.build_stages(dbfile, buildargs)
+        for name in (args.stages or []) + (args.redo or []):
+            if name not in stages:
+                logger.warning('No such stage: %s (stages: %s)', name, ', '.join(stages))
+                sys.exit(1)
+
+        completed = pipeline.get_completed_stages(dbfile)
+        redo = set(args.redo or [])
+        if not args.input and ('unigrams' not in completed or 'unigrams' in redo):
+            logger.warning('Input directory/file is needed for building the unigram frequencies')
+            sys.exit(1)
+
+        if 'unigrams' in redo and exists(dbfile):
+            # All other stages depend on the unigram frequencies
+            logger.info('Removing %s for rebuilding', dbfile)
+            os.remove(dbfile)
+        elif 'unigrams' not in completed and exists(dbfile) and os.path.getsize(dbfile) > 0 and not args.resume:
+            # The unigram frequencies would be added to the rows of an interrupted or earlier build
+            logger.warning('Database %s exists without completed unigram frequencies: '
+                           'use -r to resume building them, or -R unigrams to rebuild the database', dbfile)
+            sys.exit(1)
+
+        logdir = args.logdir
+        if not logdir and args.jobs > 1:
+            logdir = dbfile + '.logs'
+
+        start = time.perf_counter()
+        report = pipeline.run_pipeline(stages, dbfile, jobs=args.jobs, redo=args.redo,
+                                       targets=args.stages, logdir=logdir)
+
+        print(tabulate([[name, status, f'{seconds:.1f}', rows] for name, status, seconds, rows in report],
+                       headers=['stage', 'status', 'seconds', 'rows']))
+        print(f'Total time: {time.perf_counter() - start:.1f} seconds')
+
+        if any(row[1] in ('failed', 'not run') for row in report):
+            sys.exit(1)
@@ -0,0 +1,261 @@
+"""Compact frequency accumulator for database building."""
+
+# pylint: disable=invalid-name, line-too-long
+
+from typing import List, Dict, Tuple, Optional, Iterator, Iterable
+import os
+import heapq
+import tempfile
+
+FreqKey = Tuple[str, str, str, str]
+
+# Bit widths for the packed (lemma, form, upos, feats) keys
+LEMMABITS = 30
+FORMBITS = 30
+POSBITS = 8
+FEATBITS = 20
+
+FORMSHIFT = POSBITS + FEATBITS
+LEMMASHIFT = FORMBITS + FORMSHIFT
+FORMMASK = (1 << FORMBITS) - 1
+POSMASK = (1 << POSBITS) - 1
+FEATMASK = (1 << FEATBITS) - 1
+
+# Approximate memory use per counted key and per vocabulary string, in bytes.
+# The key estimate includes the temporary sort list used when spilling.
+KEYBYTES = 200
+STRINGBYTES = 120
+
+# Maximum number of runs merged at once
+MAXMERGE = 64
+
+
+class Vocabulary:
+    """String table mapping strings to consecutive integer ids."""
+
+    def __init__(self, name: str, bits: int):
+        """Initialize vocabulary."""
+        self.name = name
+        self.maxsize = 1 << bits
+        self.ids: Dict[str, int] = {}
+        self.strings: List[str] = []
+
+    def intern(self, value: str) -> int:
+        """Get id for string, adding it if necessary."""
+        idx = self.ids.get(value)
+        if idx is None:
+            idx = len(self.strings)
+            if idx >= self.maxsize:
+                raise OverflowError(f'Too many distinct values in {self.name} vocabulary: {idx}')
+            self.ids[value] = idx
+            self.strings.append(value)
+        return idx
+
+    def __getitem__(self, idx: int) -> str:
+        """Get string for id."""
+        return self.strings[idx]
+
+    def __len__(self) -> int:
+        """Get vocabulary size."""
+        return len(self.strings)
+
+    def clear(self):
+        """Remove all strings."""
+        self.ids.clear()
+        self.strings.clear()
+
+
+class FreqAccumulator:
+    """Frequencies keyed by packed integer ids of (lemma, form, upos, feats).
+
+    Lemma, form, upos and feats strings are stored once in vocabulary tables.
+    The feats dictionaries needed for the features table are stored once per
+    distinct feats string.
+
+    With a memory budget (in bytes), the counts can be spilled to sorted run
+    files when the estimated size exceeds the budget. The runs are merged
+    when the items are read, in sorted key order.
+    """
+
+    def __init__(self,
+                 budget: Optional[int] = None,
+                 tmpdir: Optional[str] = None):
+        """Initialize accumulator."""
+        self.lemmas = Vocabulary('lemma', LEMMABITS)
+        self.forms = Vocabulary('form', FORMBITS)
+        self.poses = Vocabulary('upos', POSBITS)
+        self.feats = Vocabulary('feats', FEATBITS)
+        self.featdicts: List[Optional[Dict]] = []
+        self.counts: Dict[int, int] = {}
+        self.budget = budget
+        self.tmpdir = tmpdir
+        self.runs: List[str] = []
+        self.spilledtotal = 0
+        self.sentences = 0
+
+    def __len__(self) -> int:
+        """Get number of distinct keys in memory."""
+        return len(self.counts)
+
+    def intern_feats(self, feats: str, featdict: Optional[Dict] = None) -> int:
+        """Get id for feats string, storing the feats dictionary for new strings."""
+        idx = self.feats.ids.get(feats)
+        if idx is None:
+            idx = self.feats.intern(feats)
+            self.featdicts.append(featdict)
+        return idx
+
+    def pack(self, lemma: str, form: str, upos: str, featid: int) -> int:
+        """Pack key strings to an integer key."""
+        return ((self.lemmas.intern(lemma) << LEMMASHIFT)
+                | (self.forms.intern(form) << FORMSHIFT)
+                | (self.poses.intern(upos) << FEATBITS)
+                | featid)
+
+    def unpack(self, key: int) -> FreqKey:
+        """Unpack integer key to key strings."""
+        return (self.lemmas.strings[key >> LEMMASHIFT],
+                self.forms.strings[(key >> FORMSHIFT) & FORMMASK],
+                self.poses.strings[(key >> FEATBITS) & POSMASK],
+                self.feats.strings[key & FEATMASK])
+
+    def add(self, lemma: str, form: str, upos: str, feats: str,
+            count: int = 1,
+            featdict: Optional[Dict] = None):
+        """Add count for key."""
+        key = self.pack(lemma, form, upos, self.intern_feats(feats, featdict))
+        counts = self.counts
+        counts[key] = counts.get(key, 0) + count
+
+    def __getitem__(self, key: FreqKey) -> int:
+        """Get count for key strings."""
+        lemma, form, upos, feats = key
+        try:
+            packed = ((self.lemmas.ids[lemma] << LEMMASHIFT)
+                      | (self.forms.ids[form] << FORMSHIFT)
+                      | (self.poses.ids[upos] << FEATBITS)
+                      | self.feats.ids[feats])
+        except KeyError:
+            return 0
+        return self.counts.get(packed, 0)
+
+    def __contains__(self, key: FreqKey) -> bool:
+        """Check if key strings have a count."""
+        return self[key] > 0
+
+    def items(self) -> Iterator[Tuple[FreqKey, int]]:
+        """Iterate over key strings and counts.
+
+        Without spilled runs, the keys are in insertion order. Otherwise the
+        remaining counts are spilled too and the runs are merged in key order.
+        """
+        if self.runs:
+            if self.counts:
+                self.spill()
+            yield from self.merge_runs()
+            return
+        unpack = self.unpack
+        for key, count in self.counts.items():
+            yield unpack(key), count
+
+    def featdict(self, feats: str) -> Optional[Dict]:
+        """Get feats dictionary for feats string."""
+        idx = self.feats.ids.get(feats)
+        if idx is None:
+            return None
+        return self.featdicts[idx]
+
+    def total(self) -> int:
+        """Get sum of counts."""
+        return self.spilledtotal + sum(self.counts.values())
+
+    def size(self) -> int:
+        """Get estimated memory use in bytes."""
+        return len(self.counts) * KEYBYTES + (len(self.lemmas) + len(self.forms)) * STRINGBYTES
+
+    def over_budget(self) -> bool:
+        """Check if the estimated memory use exceeds the budget."""
+        return self.budget is not None and self.size() > self.budget
+
+    def spill(self):
+        """Write counts to a sorted run file and clear them from memory.
+
+        The lemma and form vocabularies are cleared too. The upos and feats
+        vocabularies are small and are kept, so that feats dictionaries are
+        still available when the runs are merged.
+        """
+        if not self.counts:
+            return
+        fd, runfile = tempfile.mkstemp(prefix='wm2run', suffix='.tsv', dir=self.tmpdir)
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='\n') as fh:
+            unpack = self.unpack
+            for key, count in sorted((unpack(key), count) for key, count in self.counts.items()):
+                fh.write('\t'.join(key) + f'\t{count}\n')
+        self.spilledtotal += sum(self.counts.values())
+        self.runs.append(runfile)
+        self.counts.clear()
+        self.lemmas.clear()
+        self.forms.clear()
+
+    def merge_runs(self) -> Iterator[Tuple[FreqKey, int]]:
+        """Merge the sorted runs, summing the counts of equal keys."""
+        runs = self.runs
+        while len(runs) > MAXMERGE:
+            fd, runfile = tempfile.mkstemp(prefix='wm2run', suffix='.tsv', dir=self.tmpdir)
+            with os.fdopen(fd, 'w', encoding='utf-8', newline='\n') as fh:
+                for key, count in merge_sorted_runs(runs[:MAXMERGE]):
+                    fh.write('\t'.join(key) + f'\t{count}\n')
+            for oldfile in runs[:MAXMERGE]:
+                os.remove(oldfile)
+            runs = runs[MAXMERGE:] + [runfile]
+            self.runs = runs
+        yield from merge_sorted_runs(runs)
+
+    def remove_runs(self):
+        """Remove the run files."""
+        for runfile in self.runs:
+            if os.path.exists(runfile):
+                os.remove(runfile)
+        self.runs = []
+        self.spilledtotal = 0
+
+    def merge(self, other: 'FreqAccumulator') -> 'FreqAccumulator':
+        """Merge counts from another accumulator, keeping the key insertion order."""
+        lemmamap = [self.lemmas.intern(s) for s in other.lemmas.strings]
+        formmap = [self.forms.intern(s) for s in other.forms.strings]
+        posmap = [self.poses.intern(s) for s in other.poses.strings]
+        featmap = [self.intern_feats(s, d) for s, d in zip(other.feats.strings, other.featdicts)]
+        counts = self.counts
+        for key, count in other.counts.items():
+            packed = ((lemmamap[key >> LEMMASHIFT] << LEMMASHIFT)
+                      | (formmap[(key >> FORMSHIFT) & FORMMASK] << FORMSHIFT)
+                      | (posmap[(key >> FEATBITS) & POSMASK] << FEATBITS)
+                      | featmap[key & FEATMASK])
+            counts[packed] = counts.get(packed, 0) + count
+        self.runs.extend(other.runs)
+        self.spilledtotal += other.spilledtotal
+        self.sentences += other.sentences
+        return self
+
+
+def read_run(runfile: str) -> Iterator[Tuple[FreqKey, int]]:
+    """Read keys and counts from a run file."""
+    with open(runfile, 'r', encoding='utf-8', newline='\n') as fh:
+        for line in fh:
+            lemma, form, upos, feats, count = line.rstrip('\n').split('\t')
+            yield (lemma, form, upos, feats), int(count)
+
+
+def merge_sorted_runs(runfiles: Iterable[str]) -> Iterator[Tuple[FreqKey, int]]:
+    """Merge sorted run files, summing the counts of equal keys."""
+    prevkey = None
+    total = 0
+    for key, count in heapq.merge(*[read_run(runfile) for runfile in runfiles]):
+        if key != prevkey:
+            if prevkey is not None:
+                yield prevkey, total
+            prevkey = key
+            total = 0
+        total += count
+    if prevkey is not None:
+        yield prevkey, total
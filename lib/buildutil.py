@@ -2,25 +2,138 @@
 
 # pylint: disable=invalid-name, line-too-long
 
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, TextIO
 # from typing import List, Dict, Tuple, Optional, Callable, Iterable
 # from typing import Optional, Tuple, Dict
 # import sys
 import math
-# import os
-from os.path import exists
+import os
+from os.path import exists, abspath
+import sys
+import time
+import hashlib
 import logging
 import sqlite3
 from sqlite3 import IntegrityError
 # from pathlib import Path
 # from shutil import copy
 from tqdm.autonotebook import tqdm
-from .dbutil import adhoc_query, chunks, DatabaseConnection
+from .dbutil import (
+    adhoc_query, chunks, DatabaseConnection, get_manifest, upsert_freqs, querytable, store_aggregate_totals
+)
+from .planner import trigramtable, histogramtable, histogramcolumns, get_histogram
+from .corpus import input_files, file_freqs
 
 
 logger = logging.getLogger('wm2')
 # logger.setLevel(logging.DEBUG)
 
+# UPDATE ... FROM is supported from SQLite 3.33 onwards
+updatefrom = sqlite3.sqlite_version_info >= (3, 33, 0)
+
+
+def get_peak_rss(children: bool = False) -> Optional[float]:
+    """Get peak resident set size of this process (or its children) in megabytes."""
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        # Not available on Windows
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    maxrss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == 'darwin':
+        return maxrss / 1024 / 1024
+    return maxrss / 1024
+
+
+def report_peak_rss(phase: str, children: bool = False):
+    """Print peak resident set size."""
+    peak = get_peak_rss()
+    if peak is None:
+        return
+    if children:
+        childpeak = get_peak_rss(children=True)
+        print(f'Peak RSS {phase}: {peak:.1f} MB (worker processes: {childpeak:.1f} MB)')
+    else:
+        print(f'Peak RSS {phase}: {peak:.1f} MB')
+
+
+def file_sha256(filename: str) -> str:
+    """Get SHA-256 hash of file contents."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as fh:
+        while block := fh.read(2**20):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def ingest_files(dbc: DatabaseConnection,
+                 path: str,
+                 verbose: bool = False,
+                 origcase: Optional[bool] = False,
+                 sentencecount: Optional[int] = None,
+                 trashfile: Optional[TextIO] = None,
+                 filecount: Optional[int] = None,
+                 jobs: int = 1,
+                 validate: Optional[bool] = False,
+                 memory_budget: Optional[int] = None):
+    """Store frequencies after each input file, skipping files already stored.
+
+    The stored files are recorded in the manifest table with their size,
+    modification time and content hash. Frequencies of new files are added
+    to the existing frequencies.
+    """
+    sqlcon = dbc.get_connection()
+    add_schema(sqlcon, 'manifest.sql')
+    manifest = get_manifest(dbc)
+
+    print(f"Reading input files: {path}")
+    files = []
+    skipped = 0
+    for fnpath, fn in input_files(path, filecount):
+        stat = os.stat(fnpath)
+        stored = manifest.get(abspath(fnpath))
+        if stored:
+            size, mtime, sha256 = stored
+            if size == stat.st_size and mtime == stat.st_mtime:
+                skipped += 1
+                continue
+            if sha256 != file_sha256(fnpath):
+                logger.warning('File %s has changed after it was stored, skipping', fnpath)
+            skipped += 1
+            continue
+        files.append((fnpath, fn))
+
+    print(f'Skipping {skipped} files already stored, reading {len(files)} files')
+
+    storedcount = 0
+    for fnpath, fn, freqs, error in file_freqs(files,
+                                               dbc.featmap(),
+                                               jobs=jobs,
+                                               verbose=verbose,
+                                               origcase=origcase,
+                                               sentencecount=sentencecount,
+                                               trashfile=trashfile,
+                                               validate=validate,
+                                               memory_budget=memory_budget):
+        if error:
+            # The file is not recorded, so it is read again on the next run
+            print(f'Error with file {fn}: {error}')
+            freqs.remove_runs()
+            continue
+        stat = os.stat(fnpath)
+        try:
+            upsert_freqs(dbc, freqs, (abspath(fnpath), stat.st_size, stat.st_mtime,
+                                      file_sha256(fnpath), freqs.total()))
+        finally:
+            freqs.remove_runs()
+        storedcount += 1
+
+    print(f'Stored frequencies from {storedcount} files')
+    if storedcount:
+        store_aggregate_totals(sqlcon)
+
 
 def drop_table(sqlcon: sqlite3.Connection, table: str):
     """Drop table from database."""
@@ -49,6 +162,144 @@ def drop_helper_tables(sqlcon: sqlite3.Connection, full: bool = False):
 
     for table in tables:
         drop_table(sqlcon, table)
+    drop_query_table(sqlcon)
+
+
+def has_table(sqlcon: sqlite3.Connection, table: str) -> bool:
+    """Check if the database has a table."""
+    return bool(adhoc_query(sqlcon, f"SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = '{table}'"))
+
+
+def has_query_table(sqlcon: sqlite3.Connection) -> bool:
+    """Check if the database has the query table."""
+    return has_table(sqlcon, querytable)
+
+
+def drop_stage_table(sqlcon: sqlite3.Connection, table: str, stage: str, option: str):
+    """Drop the table of an optional build stage and record the stage as not completed."""
+    if not has_table(sqlcon, table):
+        return
+    print(f'Dropping the table {table}; create it again with generate_helper_tables.py {option}')
+    drop_table(sqlcon, table)
+    adhoc_query(sqlcon, f"DELETE FROM metadata WHERE key = 'stage_{stage}'")
+
+
+def drop_query_table(sqlcon: sqlite3.Connection):
+    """Drop the query table, which is out of date when the tables it is built from change."""
+    drop_stage_table(sqlcon, querytable, 'querytable', '-Q')
+
+
+def drop_trigram_table(sqlcon: sqlite3.Connection):
+    """Drop the trigram index of forms, which is out of date when forms are added."""
+    drop_stage_table(sqlcon, trigramtable, 'trigrams', '-T')
+
+
+def create_trigram_table(sqlcon: sqlite3.Connection):
+    """Create the trigram index of forms: the distinct forms of wordfreqs for each trigram.
+
+    Middle queries look up their candidate forms from the index. Deleted forms may be
+    left in the index, since the candidates are checked against the query.
+    """
+    start = time.perf_counter()
+    drop_table(sqlcon, trigramtable)
+    add_schema(sqlcon, f'{trigramtable}.sql')
+    maxlen = adhoc_query(sqlcon, 'SELECT max(length(form)) FROM wordfreqs', raiseerror=True)[0][0] or 0
+    print(f'Creating the trigram index {trigramtable}...')
+    cursor = sqlcon.cursor()
+    cursor.execute(f"""INSERT OR IGNORE INTO {trigramtable}
+    WITH RECURSIVE positions(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM positions WHERE i < ?)
+    SELECT substr(f.form, p.i, 3), f.form FROM (SELECT DISTINCT form FROM wordfreqs) f
+    JOIN positions p ON p.i <= length(f.form) - 2
+    ORDER BY 1, 2""", (maxlen - 2,))
+    sqlcon.commit()
+    print(f'Inserted {cursor.rowcount} rows to {trigramtable} in {time.perf_counter() - start:.1f} seconds')
+
+
+def store_histogram(sqlcon: sqlite3.Connection,
+                    table: str,
+                    column: str,
+                    countquery: str):
+    """Store the histogram of a column from a query of its values and their row counts in value order."""
+    counts = adhoc_query(sqlcon, countquery, raiseerror=True)
+    samples = get_histogram(counts)
+    sqlcon.executemany(f'INSERT INTO {histogramtable} VALUES (?, ?, ?, ?, ?, ?)',
+                       [(table, column) + sample for sample in samples])
+
+
+def analyze_database(sqlcon: sqlite3.Connection):
+    """Gather the statistics of the query planner.
+
+    ANALYZE stores the rows per key of the indexes in sqlite_stat1. The histograms are
+    stored for the numeric columns and pos/posx of wordfreqs, lemmas and the query table,
+    and for the feature columns counted by the wordfreqs rows having the features.
+    """
+    start = time.perf_counter()
+    print('Analyzing the indexes...')
+    adhoc_query(sqlcon, 'ANALYZE', raiseerror=True)
+    drop_table(sqlcon, histogramtable)
+    add_schema(sqlcon, f'{histogramtable}.sql')
+    for table in ('wordfreqs', 'lemmas', querytable):
+        if not has_table(sqlcon, table):
+            continue
+        for row in adhoc_query(sqlcon, f'PRAGMA table_info({table})'):
+            column, ctype = row[1], row[2].upper()
+            if column in ('id', 'featid') or not (column in histogramcolumns or ctype in ('INTEGER', 'FLOAT', 'REAL')):
+                continue
+            print(f'Histogram of {table}.{column}...')
+            store_histogram(sqlcon, table, column,
+                            f'SELECT {column}, count(*) FROM {table} WHERE {column} IS NOT NULL GROUP BY 1 ORDER BY 1')
+    if has_table(sqlcon, 'features'):
+        for row in adhoc_query(sqlcon, 'PRAGMA table_info(features)'):
+            column = row[1]
+            if column in ('featid', 'feats', 'pos'):
+                continue
+            print(f'Histogram of features.{column}...')
+            store_histogram(sqlcon, 'features', column,
+                            f"""SELECT ft.{column}, sum(w.n) FROM features ft
+                            JOIN (SELECT featid, count(*) AS n FROM wordfreqs GROUP BY featid) w ON w.featid = ft.featid
+                            WHERE ft.{column} IS NOT NULL GROUP BY 1 ORDER BY 1""")
+    adhoc_query(sqlcon, f"INSERT OR REPLACE INTO metadata VALUES ('analyzed', '{time.strftime('%Y-%m-%d %H:%M:%S')}')")
+    sqlcon.commit()
+    print(f'Analyzed the database in {time.perf_counter() - start:.1f} seconds')
+
+
+def create_query_table(sqlcon: sqlite3.Connection):
+    """Create the query table: wordfreqs joined with features, lemmas and gram frequencies.
+
+    The joined columns are named as in the query results, so queries select them
+    from the query table without joins.
+    """
+    for table in ('features', 'lemmas', 'initgramfreqs', 'fingramfreqs', 'wordbigramfreqs'):
+        if not adhoc_query(sqlcon, f'PRAGMA table_info({table})'):
+            logger.warning('The query table needs the %s table', table)
+            return
+    start = time.perf_counter()
+    drop_table(sqlcon, querytable)
+    # (name, type) of the columns, the ones named by wordfreqs left out from the joined tables
+    wcols = [(row[1], row[2]) for row in adhoc_query(sqlcon, 'PRAGMA table_info(wordfreqs)')]
+    ftcols = [(row[1], row[2]) for row in adhoc_query(sqlcon, 'PRAGMA table_info(features)')
+              if row[1] not in ('featid', 'feats', 'pos', 'posx')]
+    lcols = [(row[1], row[2]) for row in adhoc_query(sqlcon, 'PRAGMA table_info(lemmas)')
+             if row[1] not in ('lemma', 'pos')]
+    gramcols = [('initgramfreq', 'INTEGER'), ('fingramfreq', 'INTEGER'), ('bigramfreq', 'INTEGER')]
+
+    coldefs = [f'{name} {ctype} PRIMARY KEY' if name == 'id' else f'{name} {ctype}'
+               for name, ctype in wcols + ftcols + lcols + gramcols]
+    selects = ([f'w.{name}' for name, _ in wcols] + [f'ft.{name}' for name, _ in ftcols]
+               + [f'l.{name}' for name, _ in lcols]
+               + ['iif(length(w.form) > 3, i.frequency, 0)', 'iif(length(w.form) > 3, e.frequency, 0)', 'b.frequency'])
+    print(f'Creating the query table {querytable}...')
+    adhoc_query(sqlcon, f"CREATE TABLE {querytable} ({', '.join(coldefs)})", raiseerror=True)
+    cursor = sqlcon.cursor()
+    cursor.execute(f"""INSERT INTO {querytable} SELECT {', '.join(selects)}
+    FROM wordfreqs w JOIN features ft ON w.featid = ft.featid
+    LEFT JOIN lemmas l ON w.lemma = l.lemma AND w.posx = l.pos
+    LEFT JOIN initgramfreqs i ON i.form = substr(w.form, 1, 3)
+    LEFT JOIN fingramfreqs e ON e.form = substr(w.form, -3, 3)
+    LEFT JOIN wordbigramfreqs b ON b.form = w.form""")
+    sqlcon.commit()
+    print(f'Inserted {cursor.rowcount} rows to {querytable} in {time.perf_counter() - start:.1f} seconds')
+    add_schema(sqlcon, f'{querytable}_indexes.sql')
 
 
 def drop_indexes(sqlcon: sqlite3.Connection,
@@ -113,6 +364,34 @@ def vacuum(sqlcon: sqlite3.Connection):
     adhoc_query(sqlcon, "VACUUM;")
 
 
+def update_from(sqlcon: sqlite3.Connection,
+                table: str,
+                assignments: Dict[str, str],
+                source: str,
+                condition: str,
+                where: Optional[str] = None):
+    """Update columns of a table from a joined source table in one statement.
+
+    The assignments are expressions over the source (aliased src) and the table;
+    the condition joins them. With SQLite versions before 3.33, correlated
+    subqueries are used instead of UPDATE ... FROM.
+    """
+    if updatefrom:
+        setlist = ', '.join(f'{column} = {expr}' for column, expr in assignments.items())
+        updatestr = f"UPDATE {table} SET {setlist} FROM {source} AS src WHERE {condition}"
+    else:
+        setlist = ', '.join(f'{column} = (SELECT {expr} FROM {source} AS src WHERE {condition})'
+                            for column, expr in assignments.items())
+        updatestr = f"UPDATE {table} SET {setlist} WHERE EXISTS (SELECT 1 FROM {source} AS src WHERE {condition})"
+    if where:
+        updatestr += f" AND {where}"
+    start = time.perf_counter()
+    cursor = sqlcon.cursor()
+    cursor.execute(updatestr)
+    sqlcon.commit()
+    print(f'Updated {cursor.rowcount} rows in {table} in {time.perf_counter() - start:.1f} seconds')
+
+
 def get_database_metadata(dbc: DatabaseConnection) -> Dict:
     """Get metadata from the database."""
     sqlcon = dbc.get_connection()
@@ -141,7 +420,7 @@ def create_database(dbfile: str,
     dbc = DatabaseConnection(dbfile, aggregates=False)
     sqlcon = dbc.get_connection()
 
-    creationscripts = ['wordfreqs2.sql']
+    creationscripts = ['wordfreqs2.sql', 'manifest.sql']
 
     if language is not None:
         tryscript = f'languages/features_{language}.sql'
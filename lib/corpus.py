@@ -6,20 +6,27 @@
 from typing import List, Dict, Tuple, Optional, Iterable, Callable, TextIO, Iterator
 from os import walk
 from os.path import isfile, join, basename, getsize
+import os
+import io
 import re
 import gzip
+import mmap
+import time
 from contextlib import contextmanager
-from collections import Counter
+from functools import lru_cache
+from collections import defaultdict
+from multiprocessing import Pool
 # import pyconll
 # from conllu import parse_incr, TokenList
-from conllu import TokenList
+from conllu import Token, TokenList
 from conllu.exceptions import ParseException
 from conllu.parser import (
     parse_sentences, parse_token_and_metadata
 )
 # from tqdm.notebook import tqdm
 from tqdm.autonotebook import tqdm
-from .mytypes import Freqs
+from .accumulator import FreqAccumulator
+from .memo import MemoCache, CacheStats, add_stats, format_stats
 
 initchars = '^'
 alpha = 'abcdefghijklmnopqrstuvwxyzåäöüáàãâéèêíìïóòôõúñç'
@@ -34,6 +41,16 @@ hasalpha = re.compile(''.join(['.*?[', alpha, '].*?']))
 validregex = re.compile(''.join([initchars, alphanum, midchars, alphanumplus, endchars]))
 # alphanumregex = re.compile(''.join([initchars, alphanumplus, '+', endchars]))
 
+# Input files read from directories
+inputsuffixes = ('conllu', '.conllu.gz', '.vrt', '.vrt.gz')
+
+# Sizes of the word validity and feats caches
+VALIDCACHESIZE = 2**20
+FEATSCACHESIZE = 2**16
+
+# Size of the byte ranges (and gzip blocks) of a single file read in parallel
+RANGESIZE = 64 * 2**20
+
 
 # def semi_word(word: str) -> bool:
 #     """Check if word is semi-valid."""
@@ -62,8 +79,10 @@ def conllu_file_reader(cfile: str,
     shortfn = basename(cfile)
 
     if cfile.endswith('.vrt') or cfile.endswith('.vrt.gz'):
-        for idx, tokenlist in conllu_vrt_file_reader(cfile):
-            yield idx, tokenlist
+        for idx, tokens in vrt_file_reader(cfile, sentencecount=sentencecount):
+            yield idx, TokenList([Token({'form': form, 'lemma': lemma, 'upos': upos,
+                                         'feats': parse_feats(feats) or None})
+                                  for form, lemma, upos, feats in tokens])
     else:
         if checker:
             maxsize = 10**8
@@ -108,93 +127,124 @@ def conllu_file_reader(cfile: str,
 #            yield idx, sentence
 
 
-def conllu_vrt_file_reader(filename: str):
-    """Read sentences from vrt file."""
-    # Convert suomi24 data to standard ConLL-U order
-    outorder = {
-        0: 'ref',
-        1: 'lemma',
-        2: 'word',
-        3: 'pos',
-        5: 'msd',
-        6: 'dephead',
-        7: 'deprel',
-        9: 'lex',
-    }
-    inorder = None
-
-    with open(filename, 'r', encoding='utf-8') as f:
-        idx = 0
-        fileidx = 0
-        insentence = False
-        tabidx = [1, 0, 2, 4, 8, 5, 6, 7, 8, 10]
-        sentencedata: List[str] = []
-
-        # FIXME: use conllu module instead of pyconll
-        for line in tqdm(f):
-            idx += 1
-            if 'positional-attributes' in line:
-                attrs = re.search(r':\s+(.*)\/', line)
-                if attrs:
-                    _attrs = attrs.group(1).split()
-                    inorder = {k: i for i, k in enumerate(_attrs)}
-                    # print(inorder)
-            if line.startswith('</sentence'):
-                insentence = False
-                fileidx += 1
-                # in_string = ''.join(sentencedata)
-                # print(in_string)
-                sentencedata.append('\n')
-                # c = pyconll.unit.conll.Conll(sentencedata)
-                # c = pyconll.unit.sentence.Sentence(in_string)
-                c = []  # type: ignore
-                sentencedata = []
-                yield fileidx, c
+def conllu_token_scanner(lines: Iterable[str],
+                         sentencecount: Optional[int] = None) \
+                         -> Iterator[Tuple[int, List[Tuple[str, str, str, str]]]]:
+    """Scan CoNLL-U lines without the conllu parser.
+
+    Only FORM, LEMMA, UPOS and the raw FEATS string of each token are returned.
+    Sentences are separated by blank lines, comment lines are skipped.
+    """
+    idx = 0
+    tokens: List[Tuple[str, str, str, str]] = []
+    insentence = False
+
+    for line in lines:
+        line = line.strip()
+        if not line:
             if insentence:
-                # reformat fields to standard (?) ConLL-U format
-                tabs = line.split('\t')
-                if inorder:
-                    nutabs = []
-                    for _i in range(0, 10):
-                        if _i in outorder:
-                            field = outorder.get(_i)
-                            inidx = inorder[field]
-                            value = tabs[inidx]
-                            # print(field, inidx, value)
-                            if field == 'msd' and value != '_':
-                                if '_' in value and '=' not in value:
-                                    nuvals = []
-                                    for _v in value.split('|'):
-                                        try:
-                                            if '_' in _v:
-                                                vals = _v.split('_')
-                                                k = vals[0]
-                                                if len(vals) > 2:
-                                                    v = '_'.join(vals[1:])
-                                                else:
-                                                    v = vals[1]
-                                                nuvals.append('='.join([k, v]))
-                                            else:
-                                                nuvals.append(_v)
-                                        except ValueError as e:
-                                            print(_v)
-                                            raise e
-                                    value = '|'.join(nuvals)
-                            nutabs.append(value)
-                        else:
-                            nutabs.append('_')
-                else:
-                    nutabs = [tabs[i] for i in tabidx]
-                # print(line)
-                # print(nutabs)
-                sentencedata.append('\t'.join(nutabs))
+                idx += 1
+                if sentencecount and idx > sentencecount:
+                    return
+                yield idx, tokens
+                tokens = []
+                insentence = False
+            continue
+        insentence = True
+        if line[0] == '#':
+            continue
+        # Same space handling as in conllu_file_reader
+        if '  ' in line:
+            line = re.sub(r' +', ' ', line)
+        fields = line.split('\t')
+        if len(fields) < 6:
+            raise ParseException(f'Invalid line format in sentence {idx + 1}: {line}')
+        tokens.append((fields[1], fields[2], fields[3], fields[5]))
+
+    if insentence:
+        idx += 1
+        if sentencecount and idx > sentencecount:
+            return
+        yield idx, tokens
+
+
+def conllu_fast_file_reader(cfile: str,
+                            sentencecount: Optional[int] = None) \
+                            -> Iterator[Tuple[int, List[Tuple[str, str, str, str]]]]:
+    """Scan conllu file, possibly gzipped, for token frequency information."""
+    with get_filehandle(cfile) as fileh:
+        yield from conllu_token_scanner(fileh, sentencecount=sentencecount)
+
+
+# Default VRT columns of word, lemma, pos and msd without positional-attributes
+vrtcolumns = (0, 2, 4, 5)
+
+
+@lru_cache(maxsize=2**16)
+def vrt_feats(msd: str) -> str:
+    """Convert VRT msd (Case_Nom|Number_Sing) to FEATS (Case=Nom|Number=Sing)."""
+    if msd == '_' or '_' not in msd or '=' in msd:
+        return msd
+    feats = []
+    for feat in msd.split('|'):
+        if '_' in feat:
+            key, value = feat.split('_', 1)
+            feats.append(f'{key}={value}')
+        else:
+            feats.append(feat)
+    return '|'.join(feats)
+
+
+def vrt_token_scanner(lines: Iterable[str],
+                      sentencecount: Optional[int] = None) \
+                      -> Iterator[Tuple[int, List[Tuple[str, str, str, str]]]]:
+    """Scan VRT lines.
+
+    Returns the same FORM, LEMMA, UPOS and raw FEATS tuples as conllu_token_scanner.
+    The columns are taken from the positional-attributes comment, if present.
+    """
+    idx = 0
+    tokens: List[Tuple[str, str, str, str]] = []
+    insentence = False
+    formcol, lemmacol, poscol, msdcol = vrtcolumns
+    mincols = max(vrtcolumns) + 1
+
+    for line in lines:
+        if line.startswith('<'):
             if line.startswith('<sentence'):
                 insentence = True
-
-            if idx > 20:
-                pass
-
-    yield 0, ''
+            elif line.startswith('</sentence'):
+                insentence = False
+                idx += 1
+                if sentencecount and idx > sentencecount:
+                    return
+                yield idx, tokens
+                tokens = []
+            elif 'positional-attributes' in line:
+                attrs = re.search(r':\s+(.*)\/', line)
+                if attrs:
+                    columns = {k: i for i, k in enumerate(attrs.group(1).split())}
+                    formcol, lemmacol, poscol, msdcol = [columns[k] for k in ('word', 'lemma', 'pos', 'msd')]
+                    mincols = max(formcol, lemmacol, poscol, msdcol) + 1
+            continue
+        if not insentence:
+            continue
+        line = line.rstrip('\r\n')
+        # Same space handling as in conllu_file_reader
+        if '  ' in line:
+            line = re.sub(r' +', ' ', line)
+        fields = line.split('\t')
+        if len(fields) < mincols:
+            raise ParseException(f'Invalid line format in sentence {idx + 1}: {line}')
+        tokens.append((fields[formcol], fields[lemmacol], fields[poscol], vrt_feats(fields[msdcol])))
+
+
+def vrt_file_reader(filename: str,
+                    sentencecount: Optional[int] = None) \
+                    -> Iterator[Tuple[int, List[Tuple[str, str, str, str]]]]:
+    """Scan VRT file, possibly gzipped, for token frequency information."""
+    with get_filehandle(filename) as fileh:
+        yield from vrt_token_scanner(fileh, sentencecount=sentencecount)
 
 
 @contextmanager
@@ -217,6 +267,111 @@ def get_trashfh(filename: Optional[str]) -> Iterator[Optional[TextIO]]:
     yield None
 
 
+def sentence_ranges(cfile: str,
+                    rangesize: int = RANGESIZE) -> List[Tuple[int, int]]:
+    """Split an uncompressed conllu file to byte ranges at sentence boundaries."""
+    size = getsize(cfile)
+    ranges: List[Tuple[int, int]] = []
+    if size == 0:
+        return ranges
+    with open(cfile, 'rb') as fh:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # Blank line separating sentences
+            sep = b'\n\r\n' if b'\r\n' in data[:2**16] else b'\n\n'
+            start = 0
+            while start < size:
+                end = size
+                if start + rangesize < size:
+                    # Search from the previous bytes in case the blank line starts there
+                    found = data.find(sep, start + rangesize - len(sep) + 1)
+                    if found >= 0:
+                        end = found + len(sep)
+                ranges.append((start, end))
+                start = end
+    return ranges
+
+
+def block_gzip_filename(cfile: str) -> str:
+    """Get name of the block gzipped copy of a gzipped file."""
+    if cfile.endswith('.conllu.gz'):
+        return cfile[:-len('.conllu.gz')] + '.blocks.conllu.gz'
+    return cfile[:-len('.gz')] + '.blocks.gz'
+
+
+def block_gzip(cfile: str,
+               outfile: Optional[str] = None,
+               blocksize: int = RANGESIZE) -> str:
+    """Convert a gzipped conllu file to separately compressed blocks of whole sentences.
+
+    The result is still a valid gzip file. The byte ranges of the blocks are
+    written to an index file (outfile + '.idx').
+    """
+    if outfile is None:
+        outfile = block_gzip_filename(cfile)
+    print(f'Converting {cfile} to block gzip file {outfile}')
+    ranges = []
+    with gzip.open(cfile, 'rb') as inh, open(outfile, 'wb') as outh:
+        rest = b''
+        while True:
+            data = inh.read(blocksize)
+            rest += data
+            if data:
+                pos = max(rest.rfind(b'\n\n'), rest.rfind(b'\n\r\n'))
+                if pos < 0:
+                    continue
+                pos = rest.index(b'\n', pos + 1) + 1
+                block, rest = rest[:pos], rest[pos:]
+            else:
+                block, rest = rest, b''
+            if block:
+                start = outh.tell()
+                outh.write(gzip.compress(block, mtime=0))
+                ranges.append((start, outh.tell()))
+            if not data:
+                break
+    with open(outfile + '.idx', 'w', encoding='utf-8') as idxh:
+        for start, end in ranges:
+            idxh.write(f'{start}\t{end}\n')
+    return outfile
+
+
+def block_gzip_ranges(cfile: str) -> List[Tuple[int, int]]:
+    """Get byte ranges of the blocks of a block gzipped file."""
+    with open(cfile + '.idx', 'r', encoding='utf-8') as idxh:
+        return [(int(start), int(end)) for start, end in (line.split('\t') for line in idxh)]
+
+
+def file_ranges(cfile: str,
+                rangesize: int = RANGESIZE) -> Tuple[str, List[Tuple[int, int]]]:
+    """Get file and byte ranges for reading a single file in parallel.
+
+    Gzipped files are converted to block gzip files once, and the converted
+    file is used on later runs.
+    """
+    if not cfile.endswith('.gz'):
+        return cfile, sentence_ranges(cfile, rangesize=rangesize)
+    if not isfile(cfile + '.idx'):
+        blockfile = block_gzip_filename(cfile)
+        if not isfile(blockfile + '.idx') or os.path.getmtime(blockfile) < os.path.getmtime(cfile):
+            block_gzip(cfile, blockfile, blocksize=rangesize)
+        cfile = blockfile
+    return cfile, block_gzip_ranges(cfile)
+
+
+def read_range(cfile: str, start: int, end: int) -> List[str]:
+    """Read lines from a byte range of a file, or from a block of a block gzipped file."""
+    with open(cfile, 'rb') as fh:
+        fh.seek(start)
+        data = fh.read(end - start)
+    if cfile.endswith('.gz'):
+        data = gzip.decompress(data)
+    text = data.decode('utf-8')
+    # Same newline handling as with files opened in text mode
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text.split('\n')
+
+
 def get_last_sentence(data: str) -> int:
     """Get id of last sentence in conllu file."""
     sentids = re.findall(r'# sent_id = (\d+)', data, flags=re.MULTILINE)
@@ -236,28 +391,144 @@ def serialize_feats(feats: Dict) -> str:
     return '|'.join(fields)
 
 
+def parse_feats(feats: str) -> Dict[str, Optional[str]]:
+    """Parse raw FEATS string to a dictionary.
+
+    The conllu module conventions are kept, so that serialize_feats produces
+    the same strings for both the parsed and the scanned input.
+    """
+    featdict: Dict[str, Optional[str]] = {}
+    if not feats or feats == '_':
+        return featdict
+    for part in feats.split('|'):
+        keyval = part.split('=')
+        key = keyval[0]
+        if not key or key == '_':
+            continue
+        if len(keyval) == 1:
+            featdict[key] = ''
+        elif not keyval[1] or keyval[1] == '_':
+            featdict[key] = None
+        else:
+            featdict[key] = keyval[1]
+    return featdict
+
+
+def split_feats(feats: str, featmap: Dict) -> Tuple[str, str, Optional[Dict]]:
+    """Get full and core features strings and core features from raw FEATS string."""
+    featdict = parse_feats(feats)
+    if not featdict:
+        return '_', '_', None
+    corefeats = {k: v for k, v in featdict.items() if k in featmap}
+    return serialize_feats(featdict), serialize_feats(corefeats), corefeats or None
+
+
+def filter_feats(feats: str, featmap: Dict) -> Tuple[str, str]:
+    """Get full and core features strings from raw FEATS string."""
+    fullfeats, corefeats, _coredict = split_feats(feats, featmap)
+    return fullfeats, corefeats
+
+
+class TokenCaches:
+    """Caches for word validity and feats of the tokens."""
+
+    def __init__(self, featmap: Dict):
+        """Initialize caches."""
+        self.valid = MemoCache(lambda word: valid_word(word.lower()), VALIDCACHESIZE)
+        self.feats = MemoCache(lambda feats: split_feats(feats, featmap), FEATSCACHESIZE)
+
+    def stats(self) -> Dict[str, CacheStats]:
+        """Get statistics of the caches."""
+        return {'valid': self.valid.stats(), 'feats': self.feats.stats()}
+
+
+_token_caches: Dict[frozenset, TokenCaches] = {}
+
+
+def token_caches(featmap: Dict) -> TokenCaches:
+    """Get token caches for a feature map, shared by all files read in this process."""
+    key = frozenset(featmap)
+    if key not in _token_caches:
+        _token_caches[key] = TokenCaches(dict(featmap))
+    return _token_caches[key]
+
+
+def cache_stats(featmap: Dict) -> Dict[str, CacheStats]:
+    """Get statistics of the token caches of this process."""
+    return token_caches(featmap).stats()
+
+
 def conllu_freq_reader(path: str,
                        featmap: Dict,
                        origcase: Optional[bool] = False,
                        sentencecount: Optional[int] = None,
                        trashfile: Optional[TextIO] = None,
                        singlefile: Optional[bool] = False,
-                       counts: Optional[Freqs] = None) -> Freqs:
-    """Get frequencies from conllu files."""
-    if counts:
+                       counts: Optional[FreqAccumulator] = None,
+                       validate: Optional[bool] = False,
+                       lines: Optional[Iterable[str]] = None) -> FreqAccumulator:
+    """Get frequencies from conllu files.
+
+    By default the files are read with the fast token scanner. With validate,
+    the sentences are parsed with the conllu module. VRT files are always
+    read with the VRT scanner. If lines are given, they are scanned instead
+    of the file.
+    """
+    if counts is not None:
         freqs = counts
     else:
-        freqs = (Counter(), {}, Counter())
+        freqs = FreqAccumulator()
+
+    wordcounter = freqs.counts
+    featids = freqs.feats.ids
+
+    sentences = 0
+
+    if lines is not None or not validate or path.endswith(('.vrt', '.vrt.gz')):
+        if lines is not None:
+            scanner = conllu_token_scanner(lines, sentencecount=sentencecount)
+        elif path.endswith(('.vrt', '.vrt.gz')):
+            scanner = vrt_file_reader(path, sentencecount=sentencecount)
+        else:
+            scanner = conllu_fast_file_reader(path, sentencecount=sentencecount)
+        caches = token_caches(featmap)
+        isvalid = caches.valid.get
+        splitfeats = caches.feats.get
+        for _idx, tokens in (pbar := tqdm(scanner, disable=not singlefile)):
+            sentences = _idx
+            if freqs.over_budget():
+                freqs.spill()
+            if singlefile and _idx % 10000 == 0:
+                pbar.set_postfix_str(format_stats(caches.stats()), refresh=False)
+            for form, lemma, upos, rawfeats in tokens:
+                if not isvalid(form) or not isvalid(lemma):
+                    if len(form) > 1 and len(lemma) > 1:
+                        if trashfile:
+                            trashfile.write('\t'.join([path, str(_idx), form, lemma]) + '\n')
+                    continue
 
-    wordcounter = freqs[0]
-    wordfeats = freqs[1]
-    # featcounter = freqs[2]
+                if lemma and form and upos:
+                    _origfeats, corefeats, coredict = splitfeats(rawfeats)
+                    uselemma = lemma if origcase else lemma.lower()
+                    useform = form if origcase else form.lower()
+                    featid = featids.get(corefeats)
+                    if featid is None:
+                        # Only the core features are needed for the features table
+                        featid = freqs.intern_feats(corefeats, coredict)
+                    useasidx = freqs.pack(uselemma, useform, upos, featid)
+                    wordcounter[useasidx] = wordcounter.get(useasidx, 0) + 1
+
+        freqs.sentences += sentences
+        return freqs
 
     for _idx, sentence in tqdm(conllu_file_reader(path,
                                                   sentencecount=sentencecount),
                                disable=not singlefile):
         # if _idx > count:
         #    break
+        sentences = max(sentences, _idx)
+        if freqs.over_budget():
+            freqs.spill()
         pos = 0
         for token in sentence:  # type: ignore
             pos += 1
@@ -303,54 +574,312 @@ def conllu_freq_reader(path: str,
 
                 uselemma = lemma if origcase else lemma.lower()
                 useform = form if origcase else form.lower()
-                useasidx = (uselemma, useform, upos, corefeats)
-                wordcounter[useasidx] += 1
-
-                wordfeats[useasidx] = feats
+                freqs.add(uselemma, useform, upos, corefeats, featdict=feats)
 
                 # useasidx2 = (uselemma, useform, upos, origfeats)
                 # featcounter[useasidx2] += 1
 
+    freqs.sentences += sentences
+    return freqs
+
+
+def count_file(task: Tuple[str, Dict, Optional[bool], Optional[int], bool, Optional[bool], Optional[int]]) \
+        -> Tuple[FreqAccumulator, str, Optional[str], int, float, Dict[str, CacheStats]]:
+    """Count frequencies from a single file in a worker process.
+
+    Returns the partial frequencies, the discarded strings (if trash is collected),
+    a possible error message, the worker process id, the elapsed time and the
+    statistics of the token caches of the worker process.
+    """
+    fnpath, featmap, origcase, sentencecount, collecttrash, validate, budget = task
+    freqs = FreqAccumulator(budget=budget)
+    trashfh = io.StringIO() if collecttrash else None
+    error = None
+    start = time.perf_counter()
+    try:
+        conllu_freq_reader(fnpath,
+                           featmap,
+                           origcase=origcase,
+                           sentencecount=sentencecount,
+                           trashfile=trashfh,
+                           counts=freqs,
+                           validate=validate)
+    except Exception as e:
+        # Partial counts are kept, as in the serial reader
+        error = str(e)
+    elapsed = time.perf_counter() - start
+    trash = trashfh.getvalue() if trashfh else ''
+    return freqs, trash, error, os.getpid(), elapsed, cache_stats(featmap)
+
+
+def parallel_reader(files: List[Tuple[str, str]],
+                    featmap: Dict,
+                    jobs: int,
+                    verbose: bool = False,
+                    origcase: Optional[bool] = False,
+                    sentencecount: Optional[int] = None,
+                    trashfile: Optional[TextIO] = None,
+                    validate: Optional[bool] = False,
+                    memory_budget: Optional[int] = None) -> FreqAccumulator:
+    """Read conllu files with a pool of worker processes.
+
+    Each worker counts one file at a time. The partial results are merged
+    in the input file order, so the result is identical to the serial reader.
+    With a memory budget, the budget is shared by the workers and the main process.
+    """
+    budget = memory_budget // (jobs + 1) if memory_budget else None
+    freqs = FreqAccumulator(budget=budget)
+    tasks = [(fnpath, featmap, origcase, sentencecount, trashfile is not None, validate, budget)
+             for fnpath, _fn in files]
+    workerstats: Dict[int, List] = defaultdict(lambda: [0, 0, 0.0])
+    cachestats: Dict[int, Dict[str, CacheStats]] = {}
+
+    print(f'Reading {len(tasks)} files with {jobs} worker processes')
+    with Pool(processes=jobs) as pool:
+        results = pool.imap(count_file, tasks)
+        for (_fnpath, fn), result in (pbar := tqdm(zip(files, results), total=len(files))):
+            part, trash, error, pid, elapsed, cachestats[pid] = result
+            pbar.set_postfix_str(format_stats(sum_cache_stats(cachestats)), refresh=False)
+            if verbose:
+                pbar.set_description(f'{fn}')
+            if error:
+                print(f'Error with file {fn}: {error}')
+            if trash and trashfile:
+                trashfile.write(trash)
+            freqs.merge(part)
+            if freqs.over_budget():
+                freqs.spill()
+            stats = workerstats[pid]
+            stats[0] += 1
+            stats[1] += part.total()
+            stats[2] += elapsed
+
+    print_worker_stats(workerstats)
+    print(f'Token caches: {format_stats(sum_cache_stats(cachestats))}')
+
+    return freqs
+
+
+def sum_cache_stats(cachestats: Dict[int, Dict[str, CacheStats]]) -> Dict[str, CacheStats]:
+    """Sum token cache statistics of worker processes."""
+    total: Dict[str, CacheStats] = {}
+    for stats in cachestats.values():
+        total = add_stats(total, stats)
+    return total
+
+
+def print_worker_stats(workerstats: Dict[int, List], unit: str = 'files'):
+    """Print file (or range) and token counts and throughput of each worker process."""
+    for widx, (pid, (filecount, tokencount, elapsed)) in enumerate(sorted(workerstats.items())):
+        rate = tokencount / elapsed if elapsed > 0 else 0
+        print(f'Worker {widx + 1} (pid {pid}): {filecount} {unit}, {tokencount} tokens '
+              f'in {elapsed:.1f} seconds ({rate:.0f} tokens/s)')
+
+
+def count_range(task: Tuple[str, int, int, Dict, Optional[bool], bool, Optional[int]]) \
+        -> Tuple[FreqAccumulator, str, Optional[str], int, float, Dict[str, CacheStats]]:
+    """Count frequencies from a byte range of a file in a worker process.
+
+    Returns the same values as count_file. The sentence numbers of the
+    discarded strings are relative to the start of the range.
+    """
+    cfile, start, end, featmap, origcase, collecttrash, budget = task
+    freqs = FreqAccumulator(budget=budget)
+    trashfh = io.StringIO() if collecttrash else None
+    error = None
+    starttime = time.perf_counter()
+    try:
+        conllu_freq_reader(cfile,
+                           featmap,
+                           origcase=origcase,
+                           trashfile=trashfh,
+                           counts=freqs,
+                           lines=read_range(cfile, start, end))
+    except Exception as e:
+        error = str(e)
+    elapsed = time.perf_counter() - starttime
+    trash = trashfh.getvalue() if trashfh else ''
+    return freqs, trash, error, os.getpid(), elapsed, cache_stats(featmap)
+
+
+def range_reader(cfile: str,
+                 featmap: Dict,
+                 jobs: int,
+                 origcase: Optional[bool] = False,
+                 trashfile: Optional[TextIO] = None,
+                 memory_budget: Optional[int] = None,
+                 rangesize: int = RANGESIZE) -> FreqAccumulator:
+    """Read a single conllu file in byte ranges with a pool of worker processes.
+
+    The ranges start at sentence boundaries. The partial results are merged
+    in the file order, so the result is identical to the serial reader.
+    """
+    if not cfile.endswith('.gz'):
+        # Several ranges per worker for smaller files too
+        rangesize = min(rangesize, max(2**20, getsize(cfile) // (4 * jobs)))
+    rangefile, ranges = file_ranges(cfile, rangesize=rangesize)
+    budget = memory_budget // (jobs + 1) if memory_budget else None
+    freqs = FreqAccumulator(budget=budget)
+    tasks = [(rangefile, start, end, featmap, origcase, trashfile is not None, budget)
+             for start, end in ranges]
+    workerstats: Dict[int, List] = defaultdict(lambda: [0, 0, 0.0])
+    cachestats: Dict[int, Dict[str, CacheStats]] = {}
+
+    print(f'Reading {len(tasks)} ranges with {jobs} worker processes')
+    with Pool(processes=jobs) as pool:
+        results = pool.imap(count_range, tasks)
+        for part, trash, error, pid, elapsed, cachestats[pid] in (pbar := tqdm(results, total=len(tasks))):
+            pbar.set_postfix_str(format_stats(sum_cache_stats(cachestats)), refresh=False)
+            if error:
+                raise ParseException(f'Error in file {cfile} after sentence {freqs.sentences}: {error}')
+            if trash and trashfile:
+                # Sentence numbers relative to the whole file
+                for line in trash.splitlines():
+                    _path, idx, form, lemma = line.split('\t', 3)
+                    trashfile.write('\t'.join([cfile, str(int(idx) + freqs.sentences), form, lemma]) + '\n')
+            freqs.merge(part)
+            if freqs.over_budget():
+                freqs.spill()
+            stats = workerstats[pid]
+            stats[0] += 1
+            stats[1] += part.total()
+            stats[2] += elapsed
+
+    print_worker_stats(workerstats, unit='ranges')
+    print(f'Token caches: {format_stats(sum_cache_stats(cachestats))}')
+
     return freqs
 
 
+def file_freqs(files: List[Tuple[str, str]],
+               featmap: Dict,
+               jobs: int = 1,
+               verbose: bool = False,
+               origcase: Optional[bool] = False,
+               sentencecount: Optional[int] = None,
+               trashfile: Optional[TextIO] = None,
+               validate: Optional[bool] = False,
+               memory_budget: Optional[int] = None) \
+        -> Iterator[Tuple[str, str, FreqAccumulator, Optional[str]]]:
+    """Get frequencies of each conllu file separately, in the input file order.
+
+    Yields the file path and name, the frequencies and a possible error message.
+    """
+    if jobs > 1:
+        budget = memory_budget // (jobs + 1) if memory_budget else None
+        tasks = [(fnpath, featmap, origcase, sentencecount, trashfile is not None, validate, budget)
+                 for fnpath, _fn in files]
+        with Pool(processes=jobs) as pool:
+            results = pool.imap(count_file, tasks)
+            for (fnpath, fn), result in (pbar := tqdm(zip(files, results), total=len(files))):
+                freqs, trash, error, _pid, _elapsed, _cachestats = result
+                if verbose:
+                    pbar.set_description(f'{fn}')
+                if trash and trashfile:
+                    trashfile.write(trash)
+                yield fnpath, fn, freqs, error
+        return
+
+    for fnpath, fn in (pbar := tqdm(files, total=len(files))):
+        if verbose:
+            pbar.set_description(f'{fn}')
+        freqs = FreqAccumulator(budget=memory_budget)
+        error = None
+        try:
+            conllu_freq_reader(fnpath,
+                               featmap,
+                               origcase=origcase,
+                               sentencecount=sentencecount,
+                               trashfile=trashfile,
+                               counts=freqs,
+                               validate=validate)
+        except Exception as e:
+            error = str(e)
+        yield fnpath, fn, freqs, error
+
+
+def walk_files(path: str) -> List[Tuple[str, str]]:
+    """Get paths and names of all files in a directory, recursively."""
+    files = []
+    for res in list(walk(path)):
+        dirpath, _dirnames, filenames = res
+        for fn in filenames:
+            files.append((join(dirpath, fn), fn))
+    return files
+
+
+def input_files(path: str,
+                filecount: Optional[int] = None) -> List[Tuple[str, str]]:
+    """Get paths and names of conllu input files from a file or a directory."""
+    if isfile(path):
+        return [(path, basename(path))]
+    files = walk_files(path)
+    total = filecount if filecount else len(files)
+    return [(fnpath, fn) for fnpath, fn in files[:total] if fn.endswith(inputsuffixes)]
+
+
 def conllu_reader(path: str,
                   featmap: Dict,
                   verbose: bool = False,
                   origcase: Optional[bool] = False,
                   sentencecount: Optional[int] = None,
                   trashfile: Optional[TextIO] = None,
-                  filecount: Optional[int] = None) -> Optional[Freqs]:
-    """Read conllu files recursively."""
+                  filecount: Optional[int] = None,
+                  jobs: int = 1,
+                  validate: Optional[bool] = False,
+                  memory_budget: Optional[int] = None) -> FreqAccumulator:
+    """Read conllu files recursively.
+
+    With a memory budget (in bytes), frequencies exceeding the budget are
+    spilled to sorted run files in the temporary directory.
+    """
     print(f"Reading input files: {path}")
 
     if isfile(path):
         if sentencecount:
             print(f"Reading {sentencecount} sentences")
 
+        if jobs > 1 and not sentencecount and not validate and path.endswith(('.conllu', '.conllu.gz')):
+            return range_reader(path,
+                                featmap,
+                                jobs,
+                                origcase=origcase,
+                                trashfile=trashfile,
+                                memory_budget=memory_budget)
+
         freqs = conllu_freq_reader(path,
                                    featmap,
                                    origcase=origcase,
                                    sentencecount=sentencecount,
                                    trashfile=trashfile,
-                                   singlefile=True)
+                                   singlefile=True,
+                                   counts=FreqAccumulator(budget=memory_budget),
+                                   validate=validate)
     else:
         idx = 0
         # FIXME: move initialization to another file or data class?
         # columns = ['lemma', 'form', 'pos', 'case', 'feats', 'count']
-        freqs = (Counter(), {}, Counter())
+        freqs = FreqAccumulator(budget=memory_budget)
 
-        files = []
-        for res in list(walk(path)):
-            dirpath, _dirnames, filenames = res
-            for fn in filenames:
-                files.append((join(dirpath, fn), fn))
+        files = walk_files(path)
 
         total = filecount if filecount else len(files)
 
+        if jobs > 1:
+            usefiles = input_files(path, filecount)
+            return parallel_reader(usefiles,
+                                   featmap,
+                                   jobs,
+                                   verbose=verbose,
+                                   origcase=origcase,
+                                   sentencecount=sentencecount,
+                                   trashfile=trashfile,
+                                   validate=validate,
+                                   memory_budget=memory_budget)
+
         for fnpath, fn in (pbar := tqdm(files[:total], total=total)):
             try:
-                if not fn.endswith('conllu'):
+                if not fn.endswith(inputsuffixes):
                     continue
                 if verbose:
                     pbar.set_description(f'{fn}')
@@ -363,10 +892,15 @@ def conllu_reader(path: str,
                                            origcase=origcase,
                                            sentencecount=sentencecount,
                                            trashfile=trashfile,
-                                           counts=freqs)
+                                           counts=freqs,
+                                           validate=validate)
+                pbar.set_postfix_str(format_stats(cache_stats(featmap)), refresh=False)
                 if filecount and idx > filecount:
                     break
             except Exception as e:
                 print(f'Error with file {fn}: {e}')
 
+    if not validate:
+        print(f'Token caches: {format_stats(cache_stats(featmap))}')
+
     return freqs
@@ -3,13 +3,17 @@
 # pylint: disable=invalid-name, line-too-long
 
 # from typing import List, Dict, Tuple, Optional, Callable, Iterable
-from typing import List, Tuple, Union, Dict, Optional, Iterator
-from collections import Counter, defaultdict
+from typing import List, Tuple, Union, Dict, Optional, Iterator, Iterable, Deque, Any
+from collections import Counter, defaultdict, deque
+from itertools import islice
+from contextlib import contextmanager, nullcontext
 # import sys
 import time
 import math
 import re
+import json
 # from os.path import basename
+from os.path import abspath
 # from io import StringIO
 import sqlite3
 from sqlite3 import IntegrityError
@@ -19,16 +23,49 @@ from pandas.io.sql import DatabaseError
 import numpy as np
 from tqdm.autonotebook import tqdm
 from tabulate import tabulate
-from .mytypes import Freqs
+from .accumulator import FreqAccumulator
 from .features import allfeatures
+from .memo import MemoCache, ResultCache
+from .planner import Statistics, Condition, plan_query, has_table, has_index
 
 logger = logging.getLogger('wm2')
 # logger.setLevel(logging.DEBUG)
 
 
+# Seconds to wait for a lock held by another process, e.g. concurrent build stages
+locktimeout = 600
+
+# Number of compiled queries kept per database connection
+querycachesize = 256
+
+# Compiled query: SQL string, arguments, posx in use, aggregation query
+CompiledQuery = Tuple[str, List, bool, bool]
+
+
+def dataframe_size(df: pd.DataFrame) -> int:
+    """Get approximate memory usage of a dataframe in bytes."""
+    return int(df.memory_usage(deep=True).sum())
+
+
+# Results of query strings, shared by the database connections
+resultcache = ResultCache(256, sizeof=dataframe_size)
+
+# Query profiles are recorded when profiling is on
+profiling = False
+profiles: Deque[Dict] = deque(maxlen=100)
+# Interval of the progress handler counting virtual machine steps
+progresssteps = 1000
+
+
+def set_result_cache(budgetmb: float, filename: Optional[str] = None):
+    """Set the memory budget (and the file, for keeping results over restarts) of the result cache."""
+    global resultcache  # pylint: disable=global-statement
+    resultcache = ResultCache(budgetmb, sizeof=dataframe_size, filename=filename)
+
+
 def get_connection(dbfile: str) -> sqlite3.Connection:
     """Get SQLite connection."""
-    sqlcon = sqlite3.connect(dbfile)
+    sqlcon = sqlite3.connect(dbfile, timeout=locktimeout)
     return sqlcon
 
 
@@ -77,45 +114,110 @@ def adhoc_query(connection: sqlite3.Connection,
         return None
 
 
-def chunks(dataset: Union[List, pd.DataFrame], chunklen=1000) -> Iterator:
+def chunks(dataset: Union[List, pd.DataFrame, Iterable], chunklen=1000) -> Iterator:
     """Create an iterator for dataset chunks."""
     if isinstance(dataset, pd.DataFrame):
         dataset = dataset.values.tolist()
         # print(dataset[:10])
+    if not isinstance(dataset, list):
+        iterator = iter(dataset)
+        while slc := list(islice(iterator, chunklen)):
+            yield slc
+        return
     for i in range(0, len(dataset), chunklen):
         slc = dataset[i:i+chunklen]
         yield slc
 
 
-# FIXME: move gram freq functions to buildutil
-def get_trigram_freqs(connection: sqlite3.Connection) -> Tuple[Counter, Counter, Counter]:
-    """Get initrigram, fintrigram, bigram frequencies."""
-    init = Counter()  # type: ignore
-    fin = Counter()  # type: ignore
-    bi = Counter()  # type: ignore
-
-    cursor = connection.cursor()
-    # sqlstr = "select form, frequency from wordfreqs limit 10"
-    sqlstr = "select form, frequency from wordfreqs"
-
-    res = cursor.execute(sqlstr)
-    for row in tqdm(res):
-        form, freq = row
-
-        for i, j in zip(range(0, len(form)-1), range(2, len(form)+1)):
-            # print(i, j, form[i:j])
-            bi[form[i:j]] += freq
+def sum_by_code(codes: np.ndarray, weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sum weights by code; returns the sorted unique codes and their sums."""
+    if len(codes) == 0:
+        return codes, weights
+    order = np.argsort(codes)
+    codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    return codes[starts], np.add.reduceat(weights[order], starts)
+
+
+def count_gram_freqs(forms: List[str],
+                     freqs: np.ndarray,
+                     bigrams: Optional[Dict[str, int]] = None) -> Tuple[Counter, Counter, Counter, List[Tuple[str, int]]]:
+    """Get initrigram, fintrigram, bigram frequencies and mean bigram frequencies of distinct forms.
+
+    Forms of equal length are processed together as arrays of character indexes.
+    Bigrams are counted with a bincount over all character pairs, trigrams by sorting.
+    The mean bigram frequencies are calculated from the given bigram frequencies
+    instead of the counted ones, if given (for updating the means after changes).
+    """
+    alphabet = sorted(set(''.join(forms)))
+    size = max(len(alphabet), 1)
+    charindex = np.zeros(ord(alphabet[-1]) + 1 if alphabet else 1, dtype=np.int32)
+    charindex[[ord(char) for char in alphabet]] = np.arange(len(alphabet))
+
+    lengths = np.fromiter(map(len, forms), dtype=np.int64, count=len(forms))
+    freqs = np.asarray(freqs, dtype=np.int64)
+    buckets = []
+    bisums = np.zeros(size * size, dtype=np.float64)
+    inicodes: List[np.ndarray] = []
+    inisums: List[np.ndarray] = []
+    fincodes: List[np.ndarray] = []
+    finsums: List[np.ndarray] = []
+
+    for length in tqdm(np.unique(lengths)):
+        idx = np.flatnonzero(lengths == length)
+        if length < 2:
+            continue
+        chars = charindex[np.array([forms[i] for i in idx], dtype=f'<U{length}').view(np.uint32).reshape(len(idx), length)]
+        bicodes = chars[:, :-1] * size + chars[:, 1:]
+        buckets.append((idx, bicodes))
+        bucketfreqs = freqs[idx]
+        bisums += np.bincount(bicodes.ravel(), weights=np.repeat(bucketfreqs, length - 1), minlength=size * size)
 
-        if len(form) < 4:
+        if length < 4:
             continue
+        for codes, sums, start in ((inicodes, inisums, 0), (fincodes, finsums, length - 3)):
+            ucodes, usums = sum_by_code((chars[:, start].astype(np.int64) * size + chars[:, start + 1]) * size + chars[:, start + 2],
+                                        bucketfreqs)
+            codes.append(ucodes)
+            sums.append(usums)
+
+    def counter(codes: List[np.ndarray], sums: List[np.ndarray]) -> Counter:
+        allcodes, allsums = sum_by_code(np.concatenate(codes or [np.zeros(0, dtype=np.int64)]),
+                                        np.concatenate(sums or [np.zeros(0, dtype=np.int64)]))
+        return Counter({alphabet[code // (size * size)] + alphabet[code // size % size] + alphabet[code % size]: freq
+                        for code, freq in zip(allcodes.tolist(), allsums.tolist())})
+
+    init = counter(inicodes, inisums)
+    fin = counter(fincodes, finsums)
+    # Float sums are exact up to 2**53
+    bigramfreqs = np.rint(bisums).astype(np.int64)
+    nonzero = np.flatnonzero(bigramfreqs)
+    bi = Counter({alphabet[code // size] + alphabet[code % size]: freq
+                  for code, freq in zip(nonzero.tolist(), bigramfreqs[nonzero].tolist())})
+    if bigrams is not None:
+        index = {char: i for i, char in enumerate(alphabet)}
+        bigramfreqs = np.zeros(size * size, dtype=np.int64)
+        for gram, freq in bigrams.items():
+            if len(gram) == 2 and gram[0] in index and gram[1] in index:
+                bigramfreqs[index[gram[0]] * size + index[gram[1]]] = freq
+
+    # Mean bigram frequency of each form, rounded down
+    means = np.zeros(len(forms), dtype=np.int64)
+    for idx, bicodes in buckets:
+        means[idx] = bigramfreqs[bicodes].sum(axis=1) // bicodes.shape[1]
+
+    return init, fin, bi, list(zip(forms, means.tolist()))
 
-        initrigram = form[:3]
-        fintrigram = form[-3:]
-        # print(row, initrigram, fintrigram)
-        init[initrigram] += freq
-        fin[fintrigram] += freq
 
-    return init, fin, bi
+# FIXME: move gram freq functions to buildutil
+def get_gram_freqs(connection: sqlite3.Connection) -> Tuple[Counter, Counter, Counter, List[Tuple[str, int]]]:
+    """Get initrigram, fintrigram, bigram frequencies and mean bigram frequencies of forms."""
+    cursor = connection.cursor()
+    res = cursor.execute("select form, sum(frequency) from wordfreqs group by form").fetchall()
+    forms = [row[0] for row in res]
+    freqs = np.fromiter((row[1] for row in res), dtype=np.int64, count=len(res))
+    del res
+    return count_gram_freqs(forms, freqs)
 
 
 def insert_trigram_freqs(connection: sqlite3.Connection,
@@ -160,7 +262,7 @@ def insert_trigram_freqs(connection: sqlite3.Connection,
 
 
 def insert_bigram_freqs(connection: sqlite3.Connection,
-                        bi: Counter,
+                        wordbigrams: List[Tuple[str, int]],
                         empty: bool = False):
     """Insert word/bigram frequencies to database."""
     ok = True
@@ -178,24 +280,12 @@ def insert_bigram_freqs(connection: sqlite3.Connection,
         print(f'Table {table} already has content, not inserting', flush=True)
         return
 
-    # select = "SELECT DISTINCT(form) from wordfreqs LIMIT 10"
-    print(f'Loading distinct forms from {table}...', flush=True)
-    rows = adhoc_query(connection, "SELECT DISTINCT(form) from wordfreqs")
-    results = [row[0] for row in rows]
-
     insertsql = 'INSERT INTO wordbigramfreqs (form, frequency) VALUES (?, ?)'
-    insvalues = []
-    for form in results:
-        bigs = [form[i:j] for i, j in zip(range(0, len(form)-1), range(2, len(form)+1))]
-        freqs = [bi[s] for s in bigs]
-        freq = int(np.sum(freqs) / len(freqs))
-        # print(form, bigs, freqs, freq)
-        insvalues.append([form, freq])
 
     try:
-        print(f'Inserting {len(insvalues)} rows to table wordbigramfreqs', flush=True)
+        print(f'Inserting {len(wordbigrams)} rows to table wordbigramfreqs', flush=True)
         cursor = connection.cursor()
-        cursor.executemany(insertsql, insvalues)
+        cursor.executemany(insertsql, wordbigrams)
         connection.commit()
     except IntegrityError as e:
         # this is not ok
@@ -203,6 +293,89 @@ def insert_bigram_freqs(connection: sqlite3.Connection,
         connection.rollback()
 
 
+# Wordfreqs joined with features, lemmas and gram frequencies, used by queries when present
+querytable = 'wordquery'
+
+# Aggregate totals: attribute of DatabaseConnection -> (table, column)
+aggregatetotals = {
+    'wordfreqs': ('wordfreqs', 'frequency'),
+    'lemmafreqs': ('lemmas', 'lemmafreq'),
+    'initfreqs': ('initgramfreqs', 'frequency'),
+    'finfreqs': ('fingramfreqs', 'frequency'),
+    'bifreqs': ('bigramfreqs', 'frequency'),
+}
+
+
+def get_content_version(connection: sqlite3.Connection, transactions: int = 0) -> Optional[str]:
+    """Get the content version of a database, which changes with every committed write.
+
+    The version is the change counter in the header of the database file, which SQLite
+    increments on each write transaction, plus the number of write transactions the caller
+    is about to commit. In WAL mode the counter is not incremented, and an in-memory
+    database has no file: then there is no version (None), and nothing depending on the
+    contents is cached or stored with a version.
+    """
+    filename = connection.execute('PRAGMA database_list').fetchone()[2]
+    if not filename or connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+        return None
+    with open(filename, 'rb') as fh:
+        fh.seek(24)
+        counter = int.from_bytes(fh.read(4), 'big')
+    return str(counter + transactions)
+
+
+def get_query_fingerprint(connection: sqlite3.Connection) -> Optional[str]:
+    """Get a fingerprint of the tables used by queries.
+
+    The fingerprint is the content version of the database, so it changes with every
+    write: added, updated or deleted rows, the query table, the trigram index and the
+    statistics of the query planner. Without a content version, it is None.
+    """
+    return get_content_version(connection)
+
+
+def store_aggregate_totals(connection: sqlite3.Connection) -> Dict[str, Optional[int]]:
+    """Calculate aggregate totals and store them in the metadata table with the content version.
+
+    The stored version is the one after committing the totals, so they are used until the next write.
+    """
+    fingerprint = get_content_version(connection, transactions=1)
+    if fingerprint is None:
+        # The totals could not be told from stale ones
+        logger.info('Aggregate totals not stored, the database has no content version')
+    tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    totals: Dict[str, Optional[int]] = {}
+    for attr, (table, column) in aggregatetotals.items():
+        if table in tables:
+            totals[attr] = adhoc_query(connection, f'select sum({column}) from {table}', verbose=True)[0][0]
+        else:
+            totals[attr] = None
+    try:
+        if fingerprint is not None:
+            connection.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)',
+                                   [('totals', json.dumps(totals)), ('totals_fingerprint', fingerprint)])
+            connection.commit()
+    except sqlite3.Error as e:
+        # E.g. a read-only database; the totals are calculated again next time
+        logger.warning('Could not store aggregate totals: %s', e)
+        connection.rollback()
+    return totals
+
+
+def get_aggregate_totals(connection: sqlite3.Connection) -> Dict[str, Optional[int]]:
+    """Get aggregate totals from the metadata table, calculating them if the database has changed."""
+    try:
+        stored = dict(connection.execute("SELECT key, value FROM metadata WHERE key IN ('totals', 'totals_fingerprint')").fetchall())
+    except sqlite3.OperationalError:
+        # No metadata table
+        stored = {}
+    version = get_content_version(connection)
+    if 'totals' in stored and version is not None and stored.get('totals_fingerprint') == version:
+        return json.loads(stored['totals'])
+    logger.info('Calculating aggregate totals')
+    return store_aggregate_totals(connection)
+
+
 class DatabaseConnection:
     """Encapsulation of database connection."""
 
@@ -222,6 +395,10 @@ class DatabaseConnection:
         if aggregates:
             self.fetch_aggregate_frequencies()
         self.record_features()
+        self.compiled = MemoCache(self.compile_query, maxsize=querycachesize)
+        self._dataversion = None
+        self._fingerprint: Optional[str] = None
+        self._statistics: Optional[Tuple[Optional[str], Statistics]] = None
 
     def record_features(self):
         """Get actual features from the database."""
@@ -247,12 +424,13 @@ class DatabaseConnection:
         return get_connection(self.dbfile)
 
     def fetch_aggregate_frequencies(self):
-        """Fetch aggregate frequencies."""
-        self.wordfreqs = adhoc_query(self.connection, 'select sum(frequency) from wordfreqs', verbose=True)
-        self.lemmafreqs = adhoc_query(self.connection, 'select sum(lemmafreq) from lemmas', verbose=True)
-        self.initfreqs = adhoc_query(self.connection, 'select sum(frequency) from initgramfreqs', verbose=True)
-        self.finfreqs = adhoc_query(self.connection, 'select sum(frequency) from fingramfreqs', verbose=True)
-        self.bifreqs = adhoc_query(self.connection, 'select sum(frequency) from bigramfreqs', verbose=True)
+        """Fetch aggregate frequencies (as query results) from the stored totals."""
+        totals = get_aggregate_totals(self.connection)
+        self.wordfreqs = [(totals['wordfreqs'],)]
+        self.lemmafreqs = [(totals['lemmafreqs'],)]
+        self.initfreqs = [(totals['initfreqs'],)]
+        self.finfreqs = [(totals['finfreqs'],)]
+        self.bifreqs = [(totals['bifreqs'],)]
         # self.wbifreqs = adhoc_query(self.connection, 'select sum(frequency) from wordbigramfreqs', verbose=True)
 
     def record_columns(self):
@@ -275,6 +453,64 @@ class DatabaseConnection:
         """Return SQL connection."""
         return self.connection
 
+    def fingerprint(self, connection: Optional[sqlite3.Connection] = None) -> Optional[str]:
+        """Get the fingerprint of the tables, using the connection if given (e.g. in another thread).
+
+        With the own connection, the fingerprint is checked again only if another connection
+        has changed the database. The fingerprint is None if the database has no content
+        version (see get_content_version).
+        """
+        if connection is not None and connection is not self.connection:
+            return get_query_fingerprint(connection)
+        dataversion = self.connection.execute('PRAGMA data_version').fetchone()[0]
+        if dataversion != self._dataversion:
+            self._dataversion = dataversion
+            self._fingerprint = get_query_fingerprint(self.connection)
+        return self._fingerprint
+
+    def statistics(self, connection: Optional[sqlite3.Connection] = None) -> Statistics:
+        """Get the statistics of the query planner, read again if the tables have changed.
+
+        The statistics are read with the connection if given (e.g. in another thread).
+        """
+        fingerprint = self.fingerprint(connection)
+        statistics = self._statistics
+        if statistics is None or fingerprint is None or statistics[0] != fingerprint:
+            statistics = (fingerprint, Statistics(connection or self.connection))
+            self._statistics = statistics
+        return statistics[1]
+
+    def compile_query(self, key: Tuple, connection: Optional[sqlite3.Connection] = None) -> CompiledQuery:
+        """Compile a query for a key from query_key, using the connection if given (e.g. in another thread)."""
+        query, orderby, defaultindex, lemmas, grams, paging, _rowlimit, _fingerprint = key
+        return compile_query(self, query, orderby, defaultindex, lemmas, grams, paging, connection)
+
+    def query_key(self,
+                  query: str,
+                  orderby: str,
+                  defaultindex: bool,
+                  lemmas: bool,
+                  grams: bool,
+                  connection: Optional[sqlite3.Connection] = None,
+                  paging: str = '') -> Tuple:
+        """Get the cache key of a compiled query.
+
+        The key has the normalized query, the flags, the row limit and the fingerprint
+        of the database, so a query is compiled again if the tables have changed. Keys
+        without a fingerprint are not cached.
+        Pages ('first' or 'after' a key) are sized with an argument, so their key has no row limit.
+        """
+        rowlimit = 0 if paging else self.rowlimit()
+        return (query.strip(), orderby, defaultindex, lemmas, grams, paging, rowlimit, self.fingerprint(connection))
+
+    def has_index(self, name: str) -> bool:
+        """Check if the database has an index."""
+        return bool(adhoc_query(self.connection, f"SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = '{name}'"))
+
+    def has_table(self, name: str) -> bool:
+        """Check if the database has a table."""
+        return bool(adhoc_query(self.connection, f"SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = '{name}'"))
+
     def have_posx(self) -> bool:
         """Check if posx is in column list."""
         return 'posx' in self.columns['wordfreqs']
@@ -323,101 +559,243 @@ class DatabaseConnection:
         return cols
 
 
-def write_freqs_to_db(dbc: DatabaseConnection,
-                      freqs: Freqs):
-    """Write frequencies to SQLite database."""
-    connection = dbc.get_connection()
+def get_featids(connection: sqlite3.Connection) -> Dict[Tuple[str, str], int]:
+    """Get feature ids of (pos, feats) pairs from the features table."""
     cursor = connection.cursor()
-    # cursor.execute('PRAGMA journal_mode=wal')
-    # print('Cursor mode:', cursor.fetchall())
+    cursor.execute('SELECT featid, feats, pos FROM features')
+    return {(pos, feats): featid for featid, feats, pos in cursor.fetchall()}
 
-    template = "INSERT INTO %s (%s) values (%s)"
-    itemplate = "INSERT OR IGNORE INTO %s (%s) values (%s)"
 
+def freq_rows(freqs: FreqAccumulator,
+              featmap: Dict,
+              featvalues: List[List],
+              featids: Dict[Tuple[str, str], int]) -> Iterator[List]:
+    """Get wordfreqs rows from frequencies.
+
+    New (pos, feats) pairs get the next free feature id, and their features
+    rows are collected to featvalues.
+    """
+    nextfeatid = max(featids.values(), default=0) + 1
+    for key, freq in freqs.items():
+        lemma, word, pos, feats = key
+        featid = featids.get((pos, feats))
+        if featid is None:
+            featid = nextfeatid
+            nextfeatid += 1
+            featids[(pos, feats)] = featid
+            featvals = [featid, feats, pos]
+            featdict = freqs.featdict(feats)
+            for feat in sorted(featmap.keys()):
+                featval = '_'
+                # print(key, freq, featdict)
+                if isinstance(featdict, dict) and feat in featdict:
+                    # print(feat, featdict[feat])
+                    featval = featdict[feat]
+                # print(key, freq, featdict, featval)
+                # print(recvals)
+                featvals.append(featval)
+            featvalues.append(featvals)
+        posx = 'VERB' if pos == 'AUX' else pos
+        revword = word[::-1]
+        wordvals = [lemma, word, pos, posx, freq, len(word), revword, feats, featid, 0]
+        yield wordvals
+
+
+def get_freq_templates(dbc: DatabaseConnection) -> Tuple[List[str], List[str]]:
+    """Get wordfreqs and features fields for inserting frequencies."""
     featmap = dbc.featmap()
     wordfields = ['lemma', 'form', 'pos', 'posx', 'frequency', 'len',
                   'revform',
                   'feats', 'featid',
                   'hood']
-    featfields = ['feats', 'pos']
+    featfields = ['featid', 'feats', 'pos']
 
     for feat in sorted(featmap.keys()):
         featfields.append(featmap[feat])
 
+    return wordfields, featfields
+
+
+@contextmanager
+def bulk_load_pragmas(connection: sqlite3.Connection, cachemb: int = 256):
+    """Set pragmas for loading data to a new database, restoring them afterwards.
+
+    Without a journal, an interrupted load leaves the database unusable.
+    """
+    cursor = connection.cursor()
+    pragmas = ['journal_mode', 'synchronous', 'cache_size']
+    saved = {pragma: cursor.execute(f'PRAGMA {pragma}').fetchone()[0] for pragma in pragmas}
+    cursor.execute('PRAGMA journal_mode=OFF')
+    cursor.execute('PRAGMA synchronous=OFF')
+    cursor.execute(f'PRAGMA cache_size=-{cachemb * 1024}')
+    try:
+        yield
+    finally:
+        connection.commit()
+        for pragma, value in saved.items():
+            cursor.execute(f'PRAGMA {pragma}={value}')
+
+
+def table_is_empty(connection: sqlite3.Connection, table: str) -> bool:
+    """Check if table has no rows."""
+    cursor = connection.cursor()
+    cursor.execute(f'SELECT 1 FROM {table} LIMIT 1')
+    return cursor.fetchone() is None
+
+
+def write_freqs_to_db(dbc: DatabaseConnection,
+                      freqs: FreqAccumulator,
+                      bulk: bool = True):
+    """Write frequencies to SQLite database.
+
+    If the wordfreqs table is empty, the rows are bulk loaded in a single
+    transaction without a journal, and the unique index is created afterwards.
+    A failed bulk load cannot be rolled back, so the error is raised and the
+    database has to be rebuilt. The aggregate totals are stored at the end.
+    """
+    connection = dbc.get_connection()
+    cursor = connection.cursor()
+    # cursor.execute('PRAGMA journal_mode=wal')
+    # print('Cursor mode:', cursor.fetchall())
+
+    template = "INSERT INTO %s (%s) values (%s)"
+    itemplate = "INSERT OR IGNORE INTO %s (%s) values (%s)"
+
+    featmap = dbc.featmap()
+    wordfields, featfields = get_freq_templates(dbc)
+
     insert_tpl = ', '.join(list(wordfields))
     values_tpl = ', '.join(['?' for _ in wordfields])
 
     insert_template = template % ('wordfreqs', insert_tpl, values_tpl)
     print(insert_template)
 
-    wordvalues = []
-    featvalues = []
+    featvalues: List[List] = []
+    featids = get_featids(connection)
 
-    uqfeats = set()
+    chunklen = 100000
+    # The number of rows is not known before merging spilled runs
+    totwordchunks = None if freqs.runs else math.ceil(len(freqs)/chunklen)
 
-    for key, freq in freqs[0].items():
-        lemma, word, pos, feats = key
-        posx = 'VERB' if pos == 'AUX' else pos
-        revword = word[::-1]
-        wordvals = [lemma, word, pos, posx, freq, len(word), revword, feats, 0, 0]
-        featvals = [feats, pos]
-        featdict = freqs[1][key]
-        for feat in sorted(featmap.keys()):
-            featval = '_'
-            # print(key, freq, featdict)
-            if isinstance(featdict, dict) and feat in featdict:
-                # print(feat, featdict[feat])
-                featval = featdict[feat]
-            # print(key, freq, featdict, featval)
-            # print(recvals)
-            featvals.append(featval)
-        # print(recvals)
-        wordvalues.append(wordvals)
-        if (pos, feats) in uqfeats:
-            ...
+    bulk = bulk and table_is_empty(connection, 'wordfreqs')
+
+    with bulk_load_pragmas(connection) if bulk else nullcontext():
+        if bulk:
+            print('Bulk loading to an empty table, the unique index is created afterwards')
+            cursor.execute('DROP INDEX IF EXISTS idx_wordfreqs_basic')
+
+        if totwordchunks is None:
+            print(f'Inserting rows from {len(freqs.runs)} sorted runs in chunks of {chunklen}...')
         else:
-            uqfeats.add((pos, feats))
-            featvalues.append(featvals)
+            print(f'Inserting {len(freqs)} rows in {totwordchunks} chunks...')
+        print(insert_template)
 
-    print(wordvalues[0])
-    print(featvalues[0])
+        wordcount = 0
+        start = time.perf_counter()
+        for chunk in tqdm(chunks(freq_rows(freqs, featmap, featvalues, featids), chunklen=chunklen),
+                          total=totwordchunks):
+            if wordcount == 0:
+                print(chunk[0])
+            wordcount += len(chunk)
+            try:
+                cursor.executemany(insert_template, chunk)
+                if not bulk:
+                    connection.commit()
+            except IntegrityError as e:
+                # this is not ok
+                logging.exception(e)
+                if bulk:
+                    # without a journal the rows already written cannot be rolled back
+                    raise
+                connection.rollback()
+                break
 
-    chunklen = 100000
-    totwordchunks = math.ceil(len(wordvalues)/chunklen)
+        elapsed = time.perf_counter() - start
+        rate = wordcount / elapsed if elapsed > 0 else 0
+        print(f'Inserted {wordcount} rows in {elapsed:.1f} seconds ({rate:.0f} rows/s)')
+        if featvalues:
+            print(featvalues[0])
+
+        insert_tpl = ', '.join(list(featfields))
+        values_tpl = ', '.join(['?' for _ in featfields])
+
+        insert_template = itemplate % ('features', insert_tpl, values_tpl)
+
+        totfeatchunks = math.ceil(len(featvalues)/chunklen)
+
+        print(f'Inserting {len(featvalues)} rows in {totfeatchunks} chunks...')
+        print(insert_template)
+
+        for chunk in tqdm(chunks(featvalues, chunklen=chunklen),
+                          total=totfeatchunks):
+            try:
+                cursor.executemany(insert_template, chunk)
+                if not bulk:
+                    connection.commit()
+            except IntegrityError as e:
+                # this is not ok
+                logging.exception(e)
+                if bulk:
+                    raise
+                connection.rollback()
+
+        if bulk:
+            print('Creating index idx_wordfreqs_basic...')
+            start = time.perf_counter()
+            try:
+                cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_wordfreqs_basic '
+                               'on wordfreqs(lemma, form, pos, feats)')
+            except IntegrityError as e:
+                # this is not ok
+                logging.exception(e)
+                raise
+            print(f'Created index in {time.perf_counter() - start:.1f} seconds')
+
+    store_aggregate_totals(connection)
+
+
+def get_manifest(dbc: DatabaseConnection) -> Dict[str, Tuple[int, float, str]]:
+    """Get size, modification time and hash of the input files stored in the database."""
+    connection = dbc.get_connection()
+    cursor = connection.cursor()
+    cursor.execute('SELECT path, size, mtime, sha256 FROM manifest')
+    return {path: (size, mtime, sha256) for path, size, mtime, sha256 in cursor.fetchall()}
 
-    print(f'Inserting {len(wordvalues)} rows in {totwordchunks} chunks...')
-    print(insert_template)
 
-    for chunk in tqdm(chunks(wordvalues, chunklen=chunklen),
-                      total=totwordchunks):
-        try:
-            cursor.executemany(insert_template, chunk)
-            connection.commit()
-        except IntegrityError as e:
-            # this is not ok
-            logging.exception(e)
-            connection.rollback()
-            break
+def upsert_freqs(dbc: DatabaseConnection,
+                 freqs: FreqAccumulator,
+                 manifestrow: Tuple[str, int, float, str, int]):
+    """Add frequencies of an input file to the database and record the file in the manifest.
 
-    insert_tpl = ', '.join(list(featfields))
-    values_tpl = ', '.join(['?' for _ in featfields])
+    Existing frequencies are incremented. Everything is stored in a single
+    transaction, so an input file is either stored completely or not at all.
+    """
+    connection = dbc.get_connection()
+    cursor = connection.cursor()
 
-    insert_template = itemplate % ('features', insert_tpl, values_tpl)
+    featmap = dbc.featmap()
+    wordfields, featfields = get_freq_templates(dbc)
 
-    totfeatchunks = math.ceil(len(featvalues)/chunklen)
+    upsert_template = (f"INSERT INTO wordfreqs ({', '.join(wordfields)}) "
+                       f"values ({', '.join(['?' for _ in wordfields])}) "
+                       "ON CONFLICT(lemma, form, pos, feats) DO UPDATE SET frequency = frequency + excluded.frequency")
+    feat_template = (f"INSERT OR IGNORE INTO features ({', '.join(featfields)}) "
+                     f"values ({', '.join(['?' for _ in featfields])})")
+    manifest_template = ("INSERT OR REPLACE INTO manifest (path, size, mtime, sha256, tokens, completed) "
+                         "values (?, ?, ?, ?, ?, datetime('now'))")
 
-    print(f'Inserting {len(featvalues)} rows in {totfeatchunks} chunks...')
-    print(insert_template)
+    featvalues: List[List] = []
+    featids = get_featids(connection)
 
-    for chunk in tqdm(chunks(featvalues, chunklen=chunklen),
-                      total=totfeatchunks):
-        try:
-            cursor.executemany(insert_template, chunk)
-            connection.commit()
-        except IntegrityError as e:
-            # this is not ok
-            logging.exception(e)
-            connection.rollback()
+    try:
+        for chunk in chunks(freq_rows(freqs, featmap, featvalues, featids), chunklen=100000):
+            cursor.executemany(upsert_template, chunk)
+        cursor.executemany(feat_template, featvalues)
+        cursor.execute(manifest_template, manifestrow)
+        connection.commit()
+    except sqlite3.Error:
+        connection.rollback()
+        raise
 
 
 # FIXME: make this a query class
@@ -547,27 +925,21 @@ def parse_query(query: str,
     return kvparts, errors
 
 
-indexorder = ['w.form', 'w.revform', 'w.frequency', 'w.lemma', 'w.len',
-              'c.clitic',
-              'n.nouncase',
-              'd.derivation',
-              ]
-
-# fields that have good indexes
-indexfields = {
-    'w.frequency': 'idx_wordfreqs_freq_len',
-    # 'w.form': 'idx_wordfreqs_freq_form',
-    'w.form': 'idx_wordfreqs_form_freq',
-    'w.lemma': 'idx_wordfreqs_freq_lemma',
-    'w.revform': 'idx_wordfreqs_freq_revform',
-    'w.len': 'idx_wordfreqs_freq_len',
+# indexes for paging by an ordering column
+pageindexfields = {
+    'w.frequency': 'idx_wordfreqs_freq_id',
+    'w.frequencyx': 'idx_wordfreqs_freqx_id',
 }
 
 
 def parse_querystring(querystr: str,
                       revfeatmap: Dict,
-                      relfieldmap: Dict) -> Tuple[str, List, List, List, List, bool]:
-    """Parse the query string."""
+                      relfieldmap: Dict) -> Tuple[str, List, List, bool, List[Condition]]:
+    """Parse the query string.
+
+    Also returns the conditions of the query for the query planner: (column, comparator,
+    value) of each part, e.g. ('w.start', '=', 'auto').
+    """
     queryparts, errors = parse_query(querystr, revfeatmap, relfieldmap)
     # print(queryparts)
 
@@ -576,8 +948,7 @@ def parse_querystring(querystr: str,
     args = []
     useposx = True
 
-    indexers = []
-    notlikeindexers = []
+    conditions: List[Condition] = []
 
     features = revfeatmap.keys()
 #    features = ['nouncase', 'nnumber',
@@ -622,14 +993,7 @@ def parse_querystring(querystr: str,
             v = v.upper()
         fullcol = f'{usetable}.{k}'
         # print(f'{fullcol},{k},{c},{v}')
-        if fullcol in indexorder:
-            if c in ['like', 'not like']:
-                # % not at the beginning of string of like query: no forced indexing
-                if not v.startswith('%'):
-                    indexers.append(fullcol)
-            else:
-                notlikeindexers.append(fullcol)
-                indexers.append(fullcol)
+        conditions.append((fullcol, c, v))
 
         if c in ['in', 'notin']:
             invals = [w.strip() for w in v.split(',')]
@@ -757,23 +1121,20 @@ def parse_querystring(querystr: str,
         wherestr = "WHERE " + " AND ".join(whereparts)
     if useposx:
         wherestr = wherestr.replace('w.frequency', 'w.frequencyx')
-        indexers = [i.replace('w.frequency', 'w.frequencyx') for i in indexers]
-        notlikeindexers = [i.replace('w.frequency', 'w.frequencyx') for i in notlikeindexers]
+        conditions = [('w.frequencyx' if col == 'w.frequency' else col, c, v) for col, c, v in conditions]
 
-    return wherestr, args, errors, indexers, notlikeindexers, useposx
+    return wherestr, args, errors, useposx, conditions
 
 
-def parse_querydict(querydict: Dict) -> Tuple[str, List, List, List, List]:
+def parse_querydict(querydict: Dict) -> Tuple[str, List, List]:
     """Parse query dictionary."""
     wherestr = ""
     whereparts = []
     args = []
-    indexers = set()
     errors: List[str] = []
 
     # FIXME: validate: can only have lemma/form (?)
     for querypart in querydict.keys():
-        indexers.add(querypart)
         qs = []
         for queryval in querydict[querypart]:
             # if querypart == 'lemma':
@@ -787,52 +1148,27 @@ def parse_querydict(querydict: Dict) -> Tuple[str, List, List, List, List]:
         else:
             whereparts.append(f"w.{querypart} IN ({ ','.join(qs) })")
     wherestr = "WHERE (" + " OR ".join(whereparts) + ") "
-    return wherestr, args, errors, list(indexers), []
-
-
-def get_indexer(indexers: List,
-                notlikeindexers: List,
-                orderby: str,
-                useposx: bool) -> str:
-    """Possibly force indexer."""
-    logger.debug('Indexers: %s', indexers)
-    # print(f'Indexers: {indexers}')
-    logger.debug('Not LIKE indexers: %s', notlikeindexers)
-    # print(f'Not LIKE indexers: {notlikeindexers}')
-
-    orderby = orderby.split(' ')[0]
-    windexedby = ""
-    # At least one column needs to be indexed with a proper index
-    if len(notlikeindexers) == 0:
-        for indexer in indexorder:
-            if indexer in indexers and indexer in indexfields:
-                windexedby = f"indexed by {indexfields[indexer]}"
-                break
-        if len(windexedby) == 0:
-            # The best index depends on the sorting. This is by default frequency
-            orderfield = orderby.split(' ')[0]
-            if orderfield in indexfields:
-                windexedby = f"indexed by {indexfields[orderby]}"
-        if useposx:
-            windexedby = windexedby.replace('_freq', '_freqx')
-        logger.debug('Force indexer other than autoindex: %s', windexedby)
-    return windexedby
+    return wherestr, args, errors
 
 
 def get_querystring(query: Union[str, Dict],
                     revfeatmap: Dict,
                     relfieldmap: Dict,
                     orderby: str = 'w.frequency',
-                    defaultindex: bool = False) -> Tuple[str, List[str], List[str], str, bool]:
-    """Get final query string and other things."""
+                    defaultindex: bool = False) -> Tuple[str, List[str], List[str], bool, List[Condition]]:
+    """Get final query string and other things.
+
+    The conditions for the query planner are returned only if the index is not left to SQLite.
+    """
     useposx = True
+    conditions: List[Condition] = []
     if isinstance(query, str):
         logger.info('Query: %s', query)
-        wherestr, args, errors, indexers, notlikeindexers, useposx = parse_querystring(query, revfeatmap, relfieldmap)
+        wherestr, args, errors, useposx, conditions = parse_querystring(query, revfeatmap, relfieldmap)
         # print(errors)
     elif isinstance(query, dict):
         defaultindex = True
-        wherestr, args, errors, indexers, notlikeindexers = parse_querydict(query)
+        wherestr, args, errors = parse_querydict(query)
 
     if useposx:
         orderby = orderby.replace('w.frequency', 'w.frequencyx')
@@ -845,8 +1181,7 @@ def get_querystring(query: Union[str, Dict],
         whereshow = whereshow[:200] + ' ...'
     logger.info('Wherestring, arguments: %s, %s', whereshow, argshow)
     # print(wherestr, args)
-    windexedby = "" if defaultindex else get_indexer(indexers, notlikeindexers, orderby, useposx)
-    return wherestr, args, errors, windexedby, useposx
+    return wherestr, args, errors, useposx, [] if defaultindex else conditions
 
 
 def get_orderby(orderby: str) -> str:
@@ -915,7 +1250,7 @@ def parse_aggregation_query(query: str,
     if whereparts:
         # print(whereparts)
         # print(' and '.join(whereparts))
-        wherestr, pargs, perrors, _indexers, _notlikeindexers, _useposx = parse_querystring(' and '.join(whereparts), revfeatmap, relfieldmap)
+        wherestr, pargs, perrors, _useposx, _conditions = parse_querystring(' and '.join(whereparts), revfeatmap, relfieldmap)
         if not perrors:
             wheres += " and " + wherestr[6:]
             args.extend(pargs)
@@ -942,11 +1277,170 @@ def get_frequency_dataframe(dbconnection: DatabaseConnection,
                             lemmas: bool = False,
                             # aggregate: bool = True,
                             grams: bool = False) -> Tuple[pd.DataFrame, int, str]:
-    """Get frequencies as dataframe."""
+    """Get frequencies as dataframe.
+
+    Query strings are compiled to SQL once; repeated queries use the compiled query,
+    so the SQL string is identical and the prepared statement cache of the connection
+    is used as well. Results of query strings are kept in the result cache.
+    """
     # FIXME: validate rowlimit
 
     connection = dbconnection.new_connection() if newconnection else dbconnection.connection
 
+    starttime = time.perf_counter()
+    profile: Optional[Dict[str, Any]] = None
+    if profiling:
+        profile = {'query': query if isinstance(query, str) else 'word input', 'dbfile': dbconnection.dbfile, 'cached': False}
+    resultkey = None
+    querykey = None
+    if isinstance(query, str):
+        querykey = dbconnection.query_key(query, orderby, defaultindex, lemmas, grams, connection)
+    if querykey is not None and querykey[-1] is not None:
+        resultkey = json.dumps([abspath(dbconnection.dbfile), *querykey], ensure_ascii=False)
+        if (cached := resultcache.get(resultkey)) is not None:
+            hits, misses, _ = resultcache.stats()
+            logger.info('Using cached result (%d hits, %d misses)', hits, misses)
+            if profile is not None:
+                profile.update({'cached': True, 'rows': len(cached), 'total': time.perf_counter() - starttime})
+                profiles.append(profile)
+            return cached.copy(), 0, 'success'
+        hits = dbconnection.compiled.stats()[0]
+        sqlstr, args, _useposx, aggregate = dbconnection.compiled.get_with(querykey, connection)
+        if dbconnection.compiled.stats()[0] > hits:
+            logger.info('Using compiled query: %s', query)
+    else:
+        # Word inputs are seldom repeated, and compiling them is cheaper than building a key;
+        # without a fingerprint, the cached queries and results could never be used again
+        sqlstr, args, _useposx, aggregate = compile_query(dbconnection, query, orderby, defaultindex, lemmas, grams,
+                                                          connection=connection)
+    if profile is not None:
+        profile['parse'] = time.perf_counter() - starttime
+
+    if aggregate:
+        logger.info('Running as an aggregation query')
+        logger.debug('SQL: %s', sqlstr)
+        df, querystatus, querymessage = run_query(connection, sqlstr, list(args), False, profile=profile)
+        if resultkey is not None and querymessage == 'success':
+            resultcache.put(resultkey, df.copy(), time.perf_counter() - starttime)
+        if profile is not None:
+            profile['total'] = time.perf_counter() - starttime
+            profiles.append(profile)
+        return df, querystatus, querymessage
+
+    if len(sqlstr) == 0:
+        return pd.DataFrame(), -1, 'No valid query string'
+
+    sqlshow = sqlstr
+    if len(sqlstr) > 1000:
+        sqlshow = sqlstr[:1000] + ' ... [SQL string cut]'
+    logger.debug('SQL: %s', sqlshow)
+    argshow = args
+    if len(args) > 20:
+        argshow = args[:20]
+        argshow.append('...')
+    logger.debug('Arguments: %s', argshow)
+    # print(sqlstr)
+    # print(args)
+    df, querystatus, querymessage = run_query(connection, sqlstr, list(args), profile=profile)
+
+    if resultkey is not None and querymessage == 'success':
+        resultcache.put(resultkey, df.copy(), time.perf_counter() - starttime)
+
+    # Add original wordinput ordering
+    ordertime = time.perf_counter()
+    if isinstance(query, dict):
+        dc = query.keys()
+        testcol = 'form'
+        if 'lemma' in dc:
+            testcol = 'lemma'
+        df.insert(0, 'order', 0)
+        for idx, item in enumerate(query[testcol]):
+            # print(idx, item)
+            # pass
+            df.loc[df[testcol].str.replace('#', '') == item, 'order'] = idx + 1
+
+    if profile is not None:
+        profile['postprocess'] = profile.get('postprocess', 0.0) + time.perf_counter() - ordertime
+        profile['total'] = time.perf_counter() - starttime
+        profiles.append(profile)
+
+    return df, querystatus, querymessage
+
+
+def get_frequency_page(dbconnection: DatabaseConnection,
+                       query: str,
+                       after: Optional[Tuple] = None,
+                       pagesize: Optional[int] = None,
+                       orderby: str = 'w.frequency',
+                       newconnection: bool = False,
+                       lemmas: bool = False,
+                       grams: bool = False) -> Tuple[pd.DataFrame, Optional[Tuple], int, str]:
+    """Get a page of frequencies as dataframe, after the key of the previous page.
+
+    Rows are ordered by the ordering column (which must not be NULL) and id, and the key is
+    the ordering value and id of the last row of a page. Each page is fetched with an index
+    seek, so fetching a page takes the same time however deep it is. Returns the page, the
+    key for the next page (None after the last page), status and message. Aggregation
+    queries are returned as one page.
+    """
+    connection = dbconnection.new_connection() if newconnection else dbconnection.connection
+    pagesize = pagesize or dbconnection.rowlimit()
+
+    paging = 'first' if after is None else 'after'
+    querykey = dbconnection.query_key(query, orderby, False, lemmas, grams, connection, paging=paging)
+    if querykey[-1] is not None:
+        sqlstr, args, _useposx, aggregate = dbconnection.compiled.get_with(querykey, connection)
+    else:
+        sqlstr, args, _useposx, aggregate = dbconnection.compile_query(querykey, connection)
+    if aggregate:
+        df, querystatus, querymessage = run_query(connection, sqlstr, list(args), False)
+        return df, None, querystatus, querymessage
+    if len(sqlstr) == 0:
+        return pd.DataFrame(), None, -1, 'No valid query string'
+
+    if after is None:
+        pageargs = list(args) + [pagesize]
+    else:
+        key, keyid = after
+        pageargs = list(args) + [key, keyid, pagesize] + list(args) + [key, pagesize, pagesize]
+    df, querystatus, querymessage = run_query(connection, sqlstr, pageargs)
+    if querymessage != 'success':
+        return df, None, querystatus, querymessage
+
+    nextkey = None
+    if len(df) == pagesize:
+        nextkey = (df.pagekey.tolist()[-1], df.pageid.tolist()[-1])
+    return df.drop(['pagekey', 'pageid'], axis=1), nextkey, querystatus, querymessage
+
+
+def format_profile(profile: Dict) -> str:
+    """Format a query profile."""
+    if profile['cached']:
+        return f"{profile['query']}: cached result, {profile['rows']} rows in {profile['total']:.3f} s"
+    lines = [f"{profile['query']}: {profile.get('rows', 0)} rows in {profile['total']:.3f} s",
+             f"parse {profile['parse']:.3f} s, SQL {profile.get('sql', 0.0):.3f} s ({profile.get('steps', 0)} steps), "
+             f"dataframe {profile.get('materialize', 0.0):.3f} s, post-processing {profile.get('postprocess', 0.0):.3f} s"]
+    if 'plan' in profile:
+        lines.append(f"Query plan:\n{profile['plan']}")
+    return '\n'.join(lines)
+
+
+def compile_query(dbconnection: DatabaseConnection,
+                  query: Union[str, Dict],
+                  orderby: str = 'w.frequency',
+                  defaultindex: bool = False,
+                  lemmas: bool = False,
+                  grams: bool = False,
+                  paging: str = '',
+                  connection: Optional[sqlite3.Connection] = None) -> CompiledQuery:
+    """Compile a query to an SQL string and arguments.
+
+    The SQL string is empty if there is no valid query string. With paging, the SQL
+    string fetches the first page or a page after a key (see page_query). The tables
+    and indexes are looked up with the connection of the query if given, as the query
+    may be run in another thread than the one of the database connection.
+    """
+    connection = connection or dbconnection.connection
     # FIXME: orderstring takes posx into account
     orderstring = get_orderby(orderby)
     # table = 'wordfreqs'
@@ -966,12 +1460,9 @@ def get_frequency_dataframe(dbconnection: DatabaseConnection,
     if isinstance(query, str) and 'agg' in query:
         aggstr, aggargs, aggerrors = parse_aggregation_query(query, revfeats, relfieldmap)
         if not aggerrors:
-            logger.info('Running as an aggregation query')
-            logger.debug('SQL: %s', aggstr)
-            return run_query(dbconnection, connection,
-                             aggstr, aggargs, False, False)
+            return aggstr, aggargs, False, True
 
-    wherestr, args, errors, windexedby, useposx = get_querystring(query, revfeats, relfieldmap,
+    wherestr, args, errors, useposx, conditions = get_querystring(query, revfeats, relfieldmap,
                                                                   orderstring, defaultindex)
 
     if errors:
@@ -983,7 +1474,23 @@ def get_frequency_dataframe(dbconnection: DatabaseConnection,
         # wherestr = wherestr.replace('w.frequency', 'w.frequencyx')
 
     if len(wherestr) == 0:
-        return pd.DataFrame(), -1, 'No valid query string'
+        return '', [], useposx, False
+
+    # The query table has the columns of features, lemmas and gram frequencies: no joins are needed
+    wide = has_table(connection, querytable)
+
+    windexedby = ''
+    if conditions:
+        if wide:
+            conditions = [(re.sub(r'^(ft|l)\.', 'w.', column), comparator, value) for column, comparator, value in conditions]
+        # The index with the lowest estimated cost, or a condition looking up candidate rows
+        windexedby, planstr, planargs = plan_query(connection, dbconnection.statistics(connection),
+                                                   querytable if wide else 'wordfreqs', conditions,
+                                                   dbconnection.rowlimit(), useposx, orderstring)
+        logger.debug('Planned index: %s %s', windexedby, planstr)
+        if planstr:
+            wherestr += f' AND {planstr}'
+            args = args + planargs
 
     groupby = ""
     # haveposx = [w for w in selects if 'posx' in w]
@@ -1000,19 +1507,31 @@ def get_frequency_dataframe(dbconnection: DatabaseConnection,
 
     # jointables = ["wordfreqs w", "features ft", "forms f"]
     # jointables = ["wordfreqs w", "features ft"]
-    fromtable = f"wordfreqs w {windexedby}, features ft"
-    # fromtable = f"wordfreqs w {windexedby}, features ft, forms f"
-    # fromtable = f"wordfreqs w, features ft"
+    if wide:
+        fromtable = f"{querytable} w {windexedby}"
+        wherestr = re.sub(r'\b(ft|l)\.', 'w.', wherestr)
+    else:
+        fromtable = f"wordfreqs w {windexedby}, features ft"
+        # fromtable = f"wordfreqs w {windexedby}, features ft, forms f"
+        # fromtable = f"wordfreqs w, features ft"
 
-    wherestr += " AND w.featid = ft.featid"
+        wherestr += " AND w.featid = ft.featid"
+    if useposx:
+        # Verb rows sharing lemma, form and feats (VERB and AUX) have the same frequencyx: keep the first one
+        wherestr += (" AND (w.posx != 'VERB' OR w.id = (SELECT min(w2.id) FROM wordfreqs w2"
+                     " WHERE w2.lemma = w.lemma AND w2.form = w.form AND w2.posx = w.posx AND w2.feats = w.feats))")
     # wherestr += " AND w.featid = ft.featid AND w.form = f.form"
 
     if (addfeats := dbconnection.get_queryselects('features')):
-        selects.extend(addfeats)
+        selects.extend([col.replace('ft.', 'w.') for col in addfeats] if wide else addfeats)
     # if (addforms := dbconnection.get_queryselects('forms')):
     #    selects.extend(addforms)
 
-    if lemmas:
+    if lemmas and wide:
+        # Only rows having a lemma, as with the join
+        wherestr += " AND w.lemmafreq IS NOT NULL"
+        selects.extend([col.replace('l.', 'w.') for col in dbconnection.get_queryselects('lemmas')])
+    elif lemmas:
         # fromtable += ", lemmas l indexed by lemmas_lemmac_pos"
         fromtable += f", lemmas l {lindexedby}"
         wherestr += " AND w.lemma = l.lemma AND w.posx = l.pos"
@@ -1039,7 +1558,9 @@ def get_frequency_dataframe(dbconnection: DatabaseConnection,
         # selects.append(1-lf.formpct as ambform)
         # addjoins += ' LEFT JOIN lemmaforms lf ON w.lemma = lf.lemma AND w.form = lf.form AND w.posx = lf.pos'
 
-    if grams:
+    if grams and wide:
+        selects.extend(['w.initgramfreq', 'w.fingramfreq', 'w.bigramfreq'])
+    elif grams:
         aliases = ['i', 'e', 'b']
         names = ['initgramfreq', 'fingramfreq', 'bigramfreq']
         tables = ['initgramfreqs', 'fingramfreqs', 'wordbigramfreqs']
@@ -1053,69 +1574,98 @@ def get_frequency_dataframe(dbconnection: DatabaseConnection,
                 selects.append(f'{alias}.frequency as {aname}')
             addjoins += f' LEFT JOIN {atable} {alias} ON {alias}.form = {wordcomp}'
 
-    userowlimit = int(dbconnection.rowlimit() * 1.5) if useposx else dbconnection.rowlimit()
-    sqlstr = f'SELECT {", ".join(selects)} FROM {fromtable} {addfrom} {addjoins} {wherestr} {groupby} ORDER BY {orderstring} LIMIT {userowlimit}'
-    whereshow = wherestr
-    if len(wherestr) > 200:
-        whereshow = wherestr[:200] + ' ... [WHERE string arguments cut]'
-    sqlshow = f'SELECT {", ".join(selects)} FROM {fromtable} {addfrom} {addjoins} {whereshow} {groupby} ORDER BY {orderstring} LIMIT {userowlimit}'
-    logger.debug('SQL: %s', sqlshow)
-    argshow = args
-    if len(args) > 20:
-        argshow = args[:20]
-        argshow.append('...')
-    logger.debug('Arguments: %s', argshow)
-    # print(sqlstr)
-    # print(args)
-    df, querystatus, querymessage = run_query(dbconnection, connection,
-                                              sqlstr, args,
-                                              useposx)
-
-    # Add original wordinput ordering
-    if isinstance(query, dict):
-        dc = query.keys()
-        testcol = 'form'
-        if 'lemma' in dc:
-            testcol = 'lemma'
-        df.insert(0, 'order', 0)
-        for idx, item in enumerate(query[testcol]):
-            # print(idx, item)
-            # pass
-            df.loc[df[testcol].str.replace('#', '') == item, 'order'] = idx + 1
-
-    return df, querystatus, querymessage
-
-
-def run_query(dbconnection: DatabaseConnection,
-              connection: sqlite3.Connection,
+    if paging:
+        pageindex = pageindexfields.get(orderstring.split(' ')[0])
+        if pageindex is not None and wide:
+            pageindex = pageindex.replace('idx_wordfreqs_', f'idx_{querytable}_')
+        if pageindex is not None and not has_index(connection, pageindex):
+            pageindex = None
+        sqlstr = page_query(selects, fromtable, f'{addfrom} {addjoins}', wherestr, orderstring, pageindex,
+                            first=paging == 'first')
+        return sqlstr, args, useposx, False
+
+    sqlstr = f'SELECT {", ".join(selects)} FROM {fromtable} {addfrom} {addjoins} {wherestr} {groupby} ORDER BY {orderstring} LIMIT {dbconnection.rowlimit()}'
+    return sqlstr, args, useposx, False
+
+
+def page_query(selects: List[str],
+               fromtable: str,
+               joins: str,
+               wherestr: str,
+               orderstring: str,
+               pageindex: Optional[str] = None,
+               first: bool = False) -> str:
+    """Get the SQL string of a page, after a key of the ordering column and id.
+
+    The rows tied with the key and the rows after the key are fetched separately, so both
+    parts are a seek in an index of the ordering column and id, however long the ties are.
+    Arguments after the where arguments: key, id and page size for the tied rows, key and
+    page size for the rest and page size for the page. The first page has no key, so its
+    only argument after the where arguments is the page size.
+    """
+    ordercol, direction = orderstring.split(' ')
+    comparator = '<' if direction == 'DESC' else '>'
+    # Paging is ordered by id within the key, which the other indexes of the ordering column do not have
+    if pageindex is not None and re.search(rf'indexed by idx_(wordfreqs|{querytable})_freq', fromtable):
+        fromtable = re.sub(r'indexed by \S+', f'indexed by {pageindex}', fromtable)
+    selects = selects + [f'{ordercol} as pagekey', 'w.id as pageid']
+    pageorder = f'ORDER BY {ordercol} {direction}, w.id {direction} LIMIT ?'
+    base = f'SELECT {", ".join(selects)} FROM {fromtable} {joins} {wherestr}'
+    if first:
+        return f'{base} {pageorder}'
+    return (f'SELECT * FROM ({base} AND {ordercol} = ? AND w.id {comparator} ? {pageorder}) '
+            f'UNION ALL SELECT * FROM ({base} AND {ordercol} {comparator} ? {pageorder}) '
+            f'ORDER BY pagekey {direction}, pageid {direction} LIMIT ?')
+
+
+def run_query(connection: sqlite3.Connection,
               sqlstr: str,
-              args: List[str],
-              useposx: bool = False,
-              reorder: bool = True) -> pd.DataFrame:
-    """Run the final SQL query."""
+              args: List,
+              reorder: bool = True,
+              profile: Optional[Dict] = None) -> pd.DataFrame:
+    """Run the final SQL query.
+
+    With a profile record, the plan, the virtual machine steps and the time of the
+    phases are recorded in it.
+    """
     querystatus = 0
     querymessage = 'success'
 
     try:
-        explainer = pd.read_sql_query('explain query plan ' + sqlstr,
-                                      connection,
-                                      params=args)
-        if len(explainer) > 20:
-            showex = explainer[:20].copy()
-            showex.loc[len(showex)] = [len(explainer), '-1', 0, '[Rest of output cut]']
-            logger.debug('Query plan:\n%s', tabulate(showex, headers=explainer.columns))
-        else:
-            logger.debug('Query plan:\n%s', tabulate(explainer, headers=explainer.columns))
+        # Planning the query again is only needed for showing the plan
+        if profile is not None or logger.isEnabledFor(logging.DEBUG):
+            explainer = pd.read_sql_query('explain query plan ' + sqlstr,
+                                          connection,
+                                          params=args)
+            if len(explainer) > 20:
+                showex = explainer[:20].copy()
+                showex.loc[len(showex)] = [len(explainer), '-1', 0, '[Rest of output cut]']
+                logger.debug('Query plan:\n%s', tabulate(showex, headers=explainer.columns))
+            else:
+                logger.debug('Query plan:\n%s', tabulate(explainer, headers=explainer.columns))
+            if profile is not None:
+                profile['plan'] = '\n'.join(explainer.detail)
+
+        steps = 0
+        if profile is not None:
+            def progress() -> int:
+                nonlocal steps
+                steps += progresssteps
+                return 0
+            connection.set_progress_handler(progress, progresssteps)
 
         starttime = time.perf_counter()
-        sql_query = pd.read_sql_query(sqlstr,
-                                      connection,
-                                      params=args)
-
-        df = pd.DataFrame(sql_query)
-        if useposx:
-            df = df.drop_duplicates(subset=['lemma', 'form', 'pos', 'feats'], keep='last').reset_index().drop('index', axis=1)
-            df = df[:dbconnection.rowlimit()]
+        try:
+            cursor = connection.execute(sqlstr, args)
+            rows = cursor.fetchall()
+        finally:
+            if profile is not None:
+                connection.set_progress_handler(None, progresssteps)
+        sqltime = time.perf_counter()
+
+        df = pd.DataFrame.from_records(rows, columns=[desc[0] for desc in cursor.description], coerce_float=True)
+        materializetime = time.perf_counter()
+
         if reorder:
             df = reorder_columns(df).rename({'nouncase': 'case', 'nnumber': 'number'}, axis=1)
 
@@ -1123,11 +1673,15 @@ def run_query(dbconnection: DatabaseConnection,
         logger.info('%d rows returned in %.1f seconds', len(df), endtime - starttime)
         # print()
         # print(f'{len(df)} rows returned in {endtime - starttime:.1f} seconds')
+        if profile is not None:
+            profile.update({'sql': sqltime - starttime, 'materialize': materializetime - sqltime,
+                            'postprocess': endtime - materializetime, 'rows': len(rows), 'steps': steps})
 
-    except DatabaseError as e:
+    except (DatabaseError, sqlite3.Error) as e:
         logger.error(str(e))
         # print(str(e))
-        _, errmsg = str(e).split(': ', 1)
+        # pandas adds the SQL string to the message
+        errmsg = str(e).split(': ', 1)[1] if isinstance(e, DatabaseError) else str(e)
         logger.error(errmsg)
         # print(errmsg)
         logging.exception(e)
@@ -1315,7 +1869,7 @@ def filter_dataframe(dbc: DatabaseConnection,
 
     try:
         logger.debug('Querying dataframe for: %s', querystring)
-        _wherestr, _args, errors, _indexers, _notlikeindexers, _useposx = parse_querystring(querystring, revfeats, relfieldmap)
+        _wherestr, _args, errors, _useposx, _conditions = parse_querystring(querystring, revfeats, relfieldmap)
         if len(errors) > 0:
             errstr = '\n'.join(errors)
             raise ValueError(errstr)
@@ -0,0 +1,194 @@
+"""Incremental maintenance of helper tables after changes to the wordfreqs table."""
+
+# pylint: disable=invalid-name, line-too-long
+
+from typing import Iterable, List, Tuple
+import time
+import sqlite3
+import logging
+import numpy as np
+from .dbutil import adhoc_query, count_gram_freqs
+from .buildutil import update_from
+from .memo import PersistentCache
+from . import hood
+
+logger = logging.getLogger('wm2')
+
+helpertables = ['forms', 'lemmaforms', 'lemmas']
+gramtables = ['initgramfreqs', 'fingramfreqs', 'bigramfreqs', 'wordbigramfreqs']
+
+
+def has_tables(sqlcon: sqlite3.Connection, tables: List[str]) -> bool:
+    """Check if the database has these tables."""
+    names = {row[0] for row in sqlcon.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    return all(table in names for table in tables)
+
+
+def start_changes(sqlcon: sqlite3.Connection):
+    """Create temporary tables for recording the changed wordfreqs keys."""
+    sqlcon.executescript("""
+    DROP TABLE IF EXISTS temp.changedkeys;
+    DROP TABLE IF EXISTS temp.oldforms;
+    CREATE TEMP TABLE changedkeys (lemma TEXT, form TEXT, pos TEXT, posx TEXT, feats TEXT);
+    CREATE TEMP TABLE oldforms (form TEXT PRIMARY KEY, frequency INTEGER);
+    """)
+
+
+def snapshot_forms(sqlcon: sqlite3.Connection):
+    """Record the frequencies of the changed forms before the change."""
+    adhoc_query(sqlcon, """INSERT OR IGNORE INTO oldforms SELECT c.form, coalesce(f.frequency, 0)
+    FROM (SELECT DISTINCT form FROM changedkeys) c LEFT JOIN forms f ON f.form = c.form""")
+
+
+def add_changed_rows(sqlcon: sqlite3.Connection, where: str):
+    """Record wordfreqs rows matching the condition as changed; call before changing them."""
+    adhoc_query(sqlcon, f"INSERT INTO changedkeys SELECT lemma, form, pos, posx, feats FROM wordfreqs WHERE {where}",
+                verbose=True)
+    snapshot_forms(sqlcon)
+
+
+def add_changed_keys(sqlcon: sqlite3.Connection, keys: Iterable[Tuple[str, str, str, str, str]]):
+    """Record (lemma, form, pos, posx, feats) keys as changed; call before changing them."""
+    sqlcon.executemany("INSERT INTO changedkeys VALUES (?, ?, ?, ?, ?)", keys)
+    sqlcon.commit()
+    snapshot_forms(sqlcon)
+
+
+def run_script(sqlcon: sqlite3.Connection, script: str):
+    """Run SQL statements separated by semicolons."""
+    for statement in script.split(';'):
+        if statement.strip():
+            adhoc_query(sqlcon, statement, raiseerror=True)
+
+
+def update_aggregates(sqlcon: sqlite3.Connection):
+    """Update frequencyx, lemmaforms, forms and lemmas for the changed keys."""
+    print('Updating aggregate frequencies...')
+    run_script(sqlcon, """
+    CREATE TEMP TABLE changedlf AS SELECT DISTINCT lemma, form, posx AS pos FROM changedkeys;
+    CREATE TEMP TABLE changedforms AS SELECT DISTINCT form FROM changedkeys;
+    CREATE UNIQUE INDEX temp.idx_changedforms ON changedforms(form);
+    CREATE TEMP TABLE changedlemmas AS SELECT DISTINCT lemma, posx AS pos FROM changedkeys;
+    CREATE TEMP TABLE posxfreqs AS SELECT w.id,
+        CASE WHEN w.posx = 'VERB' THEN sum(w.frequency) OVER (PARTITION BY w.lemma, w.form, w.posx, w.feats)
+        ELSE w.frequency END AS frequencyx
+        FROM wordfreqs w JOIN (SELECT DISTINCT lemma, form, posx, feats FROM changedkeys) c
+        ON w.lemma = c.lemma AND w.form = c.form AND w.posx = c.posx AND w.feats = c.feats;
+    CREATE UNIQUE INDEX temp.idx_posxfreqs_id ON posxfreqs(id)
+    """)
+    update_from(sqlcon, 'wordfreqs', {'frequencyx': 'src.frequencyx'}, 'temp.posxfreqs', 'wordfreqs.id = src.id')
+
+    print('Updating lemmaforms and forms...')
+    run_script(sqlcon, """
+    DELETE FROM lemmaforms WHERE (lemma, form, pos) IN (SELECT lemma, form, pos FROM changedlf);
+    INSERT INTO lemmaforms SELECT w.lemma, w.form, w.posx, sum(w.frequency), 0, 0
+        FROM wordfreqs w JOIN changedlf c ON w.lemma = c.lemma AND w.form = c.form AND w.posx = c.pos
+        GROUP BY w.lemma, w.form, w.posx;
+    CREATE TEMP TABLE newforms AS SELECT form, sum(frequency) AS frequency, count(*) AS numforms
+        FROM lemmaforms WHERE form IN (SELECT form FROM changedforms) GROUP BY form;
+    CREATE UNIQUE INDEX temp.idx_newforms ON newforms(form)
+    """)
+    update_from(sqlcon, 'lemmaforms',
+                {'formsum': 'src.frequency', 'formpct': 'lemmaforms.frequency / cast(src.frequency as real)'},
+                'temp.newforms', 'lemmaforms.form = src.form')
+    run_script(sqlcon, """
+    DELETE FROM forms WHERE form IN (SELECT form FROM changedforms) AND form NOT IN (SELECT form FROM newforms);
+    INSERT INTO forms SELECT form, frequency, numforms, 0 FROM newforms WHERE true
+        ON CONFLICT(form) DO UPDATE SET frequency = excluded.frequency, numforms = excluded.numforms
+    """)
+
+    print('Updating lemmas...')
+    run_script(sqlcon, """
+    CREATE TEMP TABLE newlemmas AS SELECT w.lemma, w.posx AS pos, sum(w.frequency) AS lemmafreq
+        FROM wordfreqs w JOIN changedlemmas c ON w.lemma = c.lemma AND w.posx = c.pos GROUP BY w.lemma, w.posx;
+    DELETE FROM lemmas WHERE (lemma, pos) IN (SELECT lemma, pos FROM changedlemmas)
+        AND (lemma, pos) NOT IN (SELECT lemma, pos FROM newlemmas);
+    INSERT INTO lemmas SELECT lemma, replace(lemma, '#', ''), pos, lemmafreq, length(replace(lemma, '#', '')), 0,
+        length(lemma) - length(replace(lemma, '#', '')) FROM newlemmas WHERE true
+        ON CONFLICT(lemma, pos) DO UPDATE SET lemmafreq = excluded.lemmafreq;
+    CREATE TEMP TABLE amblemmas AS SELECT lemma, pos FROM changedlemmas
+        UNION SELECT lemma, pos FROM lemmaforms WHERE form IN (SELECT form FROM changedforms);
+    CREATE TEMP TABLE lemmaformfreqs AS SELECT lf.lemma, lf.pos, sum(lf.frequency) AS lfreq,
+        sum(CASE WHEN f.numforms = 1 OR lf.formpct > 0.99 THEN lf.frequency END) AS numfreq
+        FROM lemmaforms lf LEFT JOIN forms f ON lf.form = f.form
+        WHERE (lf.lemma, lf.pos) IN (SELECT lemma, pos FROM amblemmas) GROUP BY lf.lemma, lf.pos;
+    CREATE UNIQUE INDEX temp.idx_lemmaformfreqs ON lemmaformfreqs(lemma, pos)
+    """)
+    update_from(sqlcon, 'lemmas', {'amblemma': 'coalesce((src.lfreq - src.numfreq) / cast(src.lfreq as real), 1)'},
+                'temp.lemmaformfreqs', 'lemmas.lemma = src.lemma and lemmas.pos = src.pos')
+
+    # Form percentages change for all lemmas of the changed forms
+    if adhoc_query(sqlcon, "SELECT 1 FROM wordfreqs WHERE ambform != 0 LIMIT 1"):
+        print('Updating ambform...')
+        update_from(sqlcon, 'wordfreqs', {'ambform': '1 - src.formpct'}, 'lemmaforms',
+                    'wordfreqs.lemma = src.lemma and wordfreqs.form = src.form and wordfreqs.posx = src.pos',
+                    where='wordfreqs.form IN (SELECT form FROM changedforms)')
+
+
+def update_grams(sqlcon: sqlite3.Connection):
+    """Update gram frequencies by the frequency changes of the forms."""
+    rows = adhoc_query(sqlcon, """SELECT o.form, coalesce(f.frequency, 0) - o.frequency FROM oldforms o
+    LEFT JOIN forms f ON f.form = o.form WHERE coalesce(f.frequency, 0) != o.frequency""")
+    print(f'Updating gram frequencies of {len(rows)} changed forms...')
+    if rows:
+        init, fin, bi, _ = count_gram_freqs([row[0] for row in rows],
+                                            np.array([row[1] for row in rows], dtype=np.int64))
+        for table, counts in zip(['initgramfreqs', 'fingramfreqs', 'bigramfreqs'], [init, fin, bi]):
+            sqlcon.executemany(f"INSERT INTO {table} VALUES (?, ?) "
+                               "ON CONFLICT(form) DO UPDATE SET frequency = frequency + excluded.frequency",
+                               [(gram, freq) for gram, freq in counts.items() if freq != 0])
+            sqlcon.execute(f"DELETE FROM {table} WHERE frequency <= 0")
+            sqlcon.commit()
+
+    # The mean bigram frequencies of forms sharing bigrams with the changed forms change as well
+    bigrams = dict(adhoc_query(sqlcon, "SELECT form, frequency FROM bigramfreqs"))
+    forms = [row[0] for row in adhoc_query(sqlcon, "SELECT form FROM forms")]
+    _, _, _, means = count_gram_freqs(forms, np.zeros(len(forms), dtype=np.int64), bigrams=bigrams)
+    old = dict(adhoc_query(sqlcon, "SELECT form, frequency FROM wordbigramfreqs"))
+    changed = [(form, mean) for form, mean in means if old.get(form) != mean]
+    removed = [(form,) for form in set(old).difference(forms)]
+    print(f'Updating {len(changed)} and removing {len(removed)} wordbigramfreqs rows...')
+    sqlcon.executemany("INSERT INTO wordbigramfreqs VALUES (?, ?) "
+                       "ON CONFLICT(form) DO UPDATE SET frequency = excluded.frequency", changed)
+    sqlcon.executemany("DELETE FROM wordbigramfreqs WHERE form = ?", removed)
+    sqlcon.commit()
+
+
+def update_hood(sqlcon: sqlite3.Connection, cachefile: str, jobs: int = 1):
+    """Recalculate the neighbourhood of forms of the changed lengths and update the changed values."""
+    lengths = [row[0] for row in adhoc_query(sqlcon, "SELECT DISTINCT length(form) FROM changedforms")]
+    lengthlist = ', '.join(str(length) for length in lengths)
+    rows = adhoc_query(sqlcon, f"SELECT form, frequency, hood FROM forms WHERE length(form) IN ({lengthlist})")
+    print(f'Recalculating the neighbourhood of {len(rows)} forms of {len(lengths)} lengths...')
+    analyses = PersistentCache(hood.analyzable, cachefile, namespace='fin')
+    try:
+        counts = hood.hood_counts([row[0] for row in rows], [row[1] for row in rows], analyses, jobs=jobs)
+    except ImportError as e:
+        logger.warning('Neighbourhood not updated, no morphological analyzer: %s', e)
+        return
+    changed = [(counts[form], form) for form, _freq, oldhood in rows if counts[form] != oldhood]
+    sqlcon.executemany("UPDATE forms SET hood = ? WHERE form = ?", changed)
+    if adhoc_query(sqlcon, "SELECT 1 FROM wordfreqs WHERE hood != 0 LIMIT 1"):
+        # Rows of the changed forms may have been added
+        changedforms = {row[0] for row in adhoc_query(sqlcon, "SELECT form FROM changedforms")}
+        changed.extend((counts[form], form) for form in changedforms.difference(form for _hood, form in changed)
+                       if form in counts)
+        print(f'Updating hood of {len(changed)} forms in wordfreqs...')
+        sqlcon.executemany("UPDATE wordfreqs SET hood = ? WHERE form = ?", changed)
+    sqlcon.commit()
+
+
+def update_helper_tables(sqlcon: sqlite3.Connection,
+                         cachefile: str = hood.analysiscache,
+                         jobs: int = 1):
+    """Update the helper tables for the recorded changes of the wordfreqs table."""
+    start = time.perf_counter()
+    update_aggregates(sqlcon)
+    if has_tables(sqlcon, gramtables):
+        update_grams(sqlcon)
+    if adhoc_query(sqlcon, "SELECT 1 FROM forms WHERE hood != 0 LIMIT 1"):
+        update_hood(sqlcon, cachefile, jobs)
+    for table in ['changedkeys', 'oldforms', 'changedlf', 'changedforms', 'changedlemmas', 'posxfreqs',
+                  'newforms', 'newlemmas', 'amblemmas', 'lemmaformfreqs']:
+        adhoc_query(sqlcon, f"DROP TABLE IF EXISTS temp.{table}")
+    print(f'Updated helper tables in {time.perf_counter() - start:.1f} seconds')
@@ -0,0 +1,122 @@
+"""Orthographic neighbourhood of word forms."""
+
+# pylint: disable=invalid-name, line-too-long
+
+from typing import Dict, Iterator, List, Tuple
+from collections import defaultdict
+from os.path import expanduser, join
+from multiprocessing import Pool
+import logging
+import numpy as np
+from tqdm.autonotebook import tqdm
+from .memo import CacheStats, PersistentCache, add_stats, format_stats
+
+logger = logging.getLogger('wm2')
+
+# Neighbours at least this frequent are always counted
+autofreq = 10000
+# Neighbours less frequent than this are never counted; the ones in between need a morphological analysis
+minfreq = 100
+
+# Morphological analyses are shared by all databases
+analysiscache = join(expanduser('~'), '.cache', 'lastu', 'analyses.db')
+
+
+def analyzable(form: str) -> bool:
+    """Check if the form has a morphological analysis."""
+    # pylint: disable=import-outside-toplevel
+    from uralicNLP import uralicApi
+    return len(uralicApi.analyze(form, "fin")) > 0
+
+
+def row_groups(rows: np.ndarray) -> np.ndarray:
+    """Get a group number for each row; equal rows have the same number."""
+    keys = np.ascontiguousarray(rows).view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+    _, inverse = np.unique(keys, return_inverse=True)
+    return inverse.ravel()
+
+
+def neighbour_groups(chars: np.ndarray) -> Iterator[np.ndarray]:
+    """Get groupings of forms (as rows of code points) where forms in a group are neighbours.
+
+    For each position, the forms are grouped by the other positions (masked-position key).
+    For each pair of adjacent positions, the forms are grouped by the other positions
+    and the pair in sorted order: distinct forms sharing this key are transpositions
+    of each other.
+    """
+    length = chars.shape[1]
+    for i in range(length):
+        masked = chars.copy()
+        masked[:, i] = 0
+        yield row_groups(masked)
+    for i in range(length - 1):
+        swapped = chars.copy()
+        swapped[:, i] = np.minimum(chars[:, i], chars[:, i+1])
+        swapped[:, i+1] = np.maximum(chars[:, i], chars[:, i+1])
+        yield row_groups(swapped)
+
+
+def length_hood(shard: Tuple[List[str], List[int], PersistentCache]) -> Tuple[Dict[str, int], CacheStats]:
+    """Get neighbour counts of forms of equal length.
+
+    Returns the counts and the statistics of the analysis cache for this shard.
+    """
+    forms, freqs, analyses = shard
+    before = analyses.stats()
+    length = len(forms[0])
+    chars = np.array(forms, dtype=f'<U{length}').view(np.uint32).reshape(len(forms), length)
+    groupings = list(neighbour_groups(chars))
+
+    # Only forms having neighbours need to be checked
+    candidates = np.zeros(len(forms), dtype=bool)
+    for groups in groupings:
+        candidates |= np.bincount(groups)[groups] > 1
+    freqarr = np.asarray(freqs)
+    ok = candidates & (freqarr >= autofreq)
+    analyze = np.flatnonzero(candidates & (freqarr >= minfreq) & (freqarr < autofreq))
+    ok[analyze] = analyses.get_many([forms[idx] for idx in analyze.tolist()])
+
+    counts = np.zeros(len(forms), dtype=np.int64)
+    for groups in groupings:
+        counts += np.bincount(groups, weights=ok).astype(np.int64)[groups] - ok
+
+    after = analyses.stats()
+    return dict(zip(forms, counts.tolist())), (after[0] - before[0], after[1] - before[1], after[2] - before[2])
+
+
+def hood_counts(forms: List[str],
+                freqs: List[int],
+                analyses: PersistentCache,
+                jobs: int = 1) -> Dict[str, int]:
+    """Get the number of neighbours of each form.
+
+    Neighbours are forms of the same length at edit distance 1: one substituted
+    character or one adjacent transposition. Neighbours are counted if they are
+    frequent, or moderately frequent and analyzable. The analyses are looked up
+    from the cache in one batch per length.
+
+    Each length is independent, so the lengths are processed in separate
+    worker processes when jobs > 1.
+    """
+    bylength: Dict[int, Tuple[List[str], List[int]]] = defaultdict(lambda: ([], []))
+    for form, freq in zip(forms, freqs):
+        bylength[len(form)][0].append(form)
+        bylength[len(form)][1].append(freq)
+
+    # Largest shards first, for balancing the workers
+    shards = [(lforms, lfreqs, analyses) for lforms, lfreqs in sorted(bylength.values(), key=lambda v: -len(v[0]))]
+    counts: Dict[str, int] = {}
+    stats: Dict[str, CacheStats] = {}
+    if jobs > 1:
+        with Pool(jobs) as pool:
+            for shardcounts, shardstats in tqdm(pool.imap_unordered(length_hood, shards), total=len(shards)):
+                counts.update(shardcounts)
+                stats = add_stats(stats, {'analyses': shardstats})
+    else:
+        for shard in tqdm(shards):
+            shardcounts, shardstats = length_hood(shard)
+            counts.update(shardcounts)
+            stats = add_stats(stats, {'analyses': shardstats})
+    hits, misses, _ = stats.get('analyses', (0, 0, 0.0))
+    print(f'Analysis cache: {hits} cached, {misses} analyzed; {format_stats(stats)}')
+    return counts
@@ -0,0 +1,254 @@
+"""Memoization with statistics."""
+
+# pylint: disable=invalid-name, line-too-long
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from collections import OrderedDict
+from functools import lru_cache
+from os.path import dirname, exists
+import os
+import sys
+import json
+import pickle
+import sqlite3
+import threading
+import time
+
+CacheStats = Tuple[int, int, float]
+
+
+class MemoCache:
+    """Bounded LRU cache for a function of one argument.
+
+    The time spent computing the missing values is recorded, so that the time
+    saved by the cache hits can be estimated.
+    """
+
+    def __init__(self, func: Callable, maxsize: int):
+        """Initialize cache."""
+        self.misstime = 0.0
+        # Arguments of the function after the key, set by get_with in each thread
+        self.context = threading.local()
+
+        def timed(key):
+            start = time.perf_counter()
+            value = func(key, *getattr(self.context, 'args', ()))
+            self.misstime += time.perf_counter() - start
+            return value
+
+        self.get = lru_cache(maxsize=maxsize)(timed)
+
+    def get_with(self, key: Any, *args) -> Any:
+        """Get value for key, computing a missing value with arguments that are not part of the key.
+
+        E.g. the database connection of the calling thread.
+        """
+        self.context.args = args
+        try:
+            return self.get(key)
+        finally:
+            self.context.args = ()
+
+    def stats(self) -> CacheStats:
+        """Get hits, misses and time spent on misses."""
+        info = self.get.cache_info()
+        return info.hits, info.misses, self.misstime
+
+
+class PersistentCache:
+    """Cache for a function of one string argument, stored in an SQLite file.
+
+    The values must be serializable as JSON. Keys are looked up in batches:
+    the missing keys are deduplicated, computed and stored in one transaction.
+    The cache can be shared by processes; each process opens its own connection.
+    """
+
+    def __init__(self, func: Callable[[str], Any], filename: str, namespace: str = ''):
+        """Initialize cache."""
+        self.func = func
+        self.filename = filename
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self.misstime = 0.0
+        self.connection: Optional[sqlite3.Connection] = None
+
+    def __getstate__(self):
+        """Get state for pickling, without the connection."""
+        state = dict(self.__dict__)
+        state['connection'] = None
+        return state
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Get connection to the cache file, creating it if necessary."""
+        if self.connection is None:
+            assert self.filename is not None, 'The cache has no file'
+            if dirname(self.filename) and not exists(dirname(self.filename)):
+                os.makedirs(dirname(self.filename), exist_ok=True)
+            self.connection = sqlite3.connect(self.filename, timeout=600)
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS cache
+            (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (namespace, key))""")
+        return self.connection
+
+    def get_many(self, keys: List[str]) -> List[Any]:
+        """Get values for keys, computing and storing the missing ones."""
+        connection = self.get_connection()
+        found: Dict[str, Any] = {}
+        unique = list(dict.fromkeys(keys))
+        # Stay below the SQLite variable limit
+        for i in range(0, len(unique), 900):
+            chunk = unique[i:i+900]
+            rows = connection.execute(f"""SELECT key, value FROM cache
+            WHERE namespace = ? AND key IN ({', '.join('?' * len(chunk))})""", [self.namespace] + chunk)
+            found.update((key, json.loads(value)) for key, value in rows)
+        missing = [key for key in unique if key not in found]
+        self.hits += len(unique) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            start = time.perf_counter()
+            computed = {key: self.func(key) for key in missing}
+            self.misstime += time.perf_counter() - start
+            with connection:
+                connection.executemany('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                                       [(self.namespace, key, json.dumps(value)) for key, value in computed.items()])
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    def stats(self) -> CacheStats:
+        """Get hits, misses and time spent on misses."""
+        return self.hits, self.misses, self.misstime
+
+
+class ResultCache:
+    """LRU cache of results within a memory budget, optionally backed by an SQLite file.
+
+    The least recently used values are evicted from memory when their total size
+    exceeds the budget. With a file, the values are also stored on disk (pickled),
+    so that they survive restarts; the file has a budget of its own. The cache
+    can be used from several threads.
+    """
+
+    def __init__(self,
+                 budgetmb: float,
+                 sizeof: Callable[[Any], int] = sys.getsizeof,
+                 filename: Optional[str] = None,
+                 diskbudgetmb: float = 1024):
+        """Initialize cache."""
+        self.budget = int(budgetmb * 2**20)
+        self.diskbudget = int(diskbudgetmb * 2**20)
+        self.sizeof = sizeof
+        self.filename = filename
+        # key -> value, size, seconds spent computing the value
+        self.values: OrderedDict[str, Tuple[Any, int, float]] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.diskhits = 0
+        self.misses = 0
+        self.misstime = 0.0
+        self.lock = threading.Lock()
+        self.connection: Optional[sqlite3.Connection] = None
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Get connection to the cache file, creating it if necessary."""
+        if self.connection is None:
+            assert self.filename is not None, 'The cache has no file'
+            if dirname(self.filename) and not exists(dirname(self.filename)):
+                os.makedirs(dirname(self.filename), exist_ok=True)
+            # Used by the threads in turn, under the lock
+            self.connection = sqlite3.connect(self.filename, timeout=600, check_same_thread=False)
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS results
+            (key TEXT NOT NULL, value BLOB NOT NULL, size INTEGER NOT NULL, seconds REAL NOT NULL, used REAL NOT NULL,
+            PRIMARY KEY (key))""")
+        return self.connection
+
+    def add(self, key: str, value: Any, seconds: float):
+        """Add value to memory, evicting the least recently used values."""
+        size = self.sizeof(value)
+        if size > self.budget:
+            return
+        if key in self.values:
+            self.size -= self.values.pop(key)[1]
+        self.values[key] = (value, size, seconds)
+        self.size += size
+        while self.size > self.budget:
+            _, (_, oldsize, _) = self.values.popitem(last=False)
+            self.size -= oldsize
+
+    def get(self, key: str) -> Optional[Any]:
+        """Get value for key, or None if it is not cached."""
+        with self.lock:
+            if key in self.values:
+                self.values.move_to_end(key)
+                self.hits += 1
+                return self.values[key][0]
+            if self.filename:
+                connection = self.get_connection()
+                row = connection.execute('SELECT value, seconds FROM results WHERE key = ?', (key,)).fetchone()
+                if row:
+                    with connection:
+                        connection.execute('UPDATE results SET used = ? WHERE key = ?', (time.time(), key))
+                    value = pickle.loads(row[0])
+                    self.add(key, value, row[1])
+                    self.hits += 1
+                    self.diskhits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: Any, seconds: float):
+        """Store value computed in seconds."""
+        with self.lock:
+            self.misstime += seconds
+            self.add(key, value, seconds)
+            if self.filename:
+                data = pickle.dumps(value)
+                if len(data) > self.diskbudget:
+                    return
+                connection = self.get_connection()
+                with connection:
+                    connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                                       (key, data, len(data), seconds, time.time()))
+                    total = connection.execute('SELECT sum(size) FROM results').fetchone()[0]
+                    if total > self.diskbudget:
+                        evict = []
+                        for oldkey, size in connection.execute('SELECT key, size FROM results ORDER BY used'):
+                            evict.append((oldkey,))
+                            total -= size
+                            if total <= self.diskbudget:
+                                break
+                        connection.executemany('DELETE FROM results WHERE key = ?', evict)
+
+    def clear(self):
+        """Remove the values from memory and from the file."""
+        with self.lock:
+            self.values.clear()
+            self.size = 0
+            if self.filename:
+                connection = self.get_connection()
+                with connection:
+                    connection.execute('DELETE FROM results')
+
+    def stats(self) -> CacheStats:
+        """Get hits, misses and time spent on misses."""
+        return self.hits, self.misses, self.misstime
+
+
+def add_stats(stats: Dict[str, CacheStats], other: Dict[str, CacheStats]) -> Dict[str, CacheStats]:
+    """Sum cache statistics."""
+    result = dict(stats)
+    for name, (hits, misses, misstime) in other.items():
+        oldhits, oldmisses, oldmisstime = result.get(name, (0, 0, 0.0))
+        result[name] = (oldhits + hits, oldmisses + misses, oldmisstime + misstime)
+    return result
+
+
+def format_stats(stats: Dict[str, CacheStats]) -> str:
+    """Format hit rates and estimated time saved of caches."""
+    parts = []
+    for name, (hits, misses, misstime) in stats.items():
+        lookups = hits + misses
+        if not lookups:
+            continue
+        saved = hits * misstime / misses if misses else 0.0
+        parts.append(f'{name} {100 * hits / lookups:.1f}% hits, {saved:.1f}s saved')
+    return '; '.join(parts)
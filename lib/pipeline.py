@@ -0,0 +1,246 @@
+"""Database build pipeline."""
+
+# pylint: disable=invalid-name, line-too-long, consider-using-with
+
+from typing import List, Dict, Optional, Set, TextIO, Tuple
+from os.path import exists, join
+import os
+import sys
+import time
+import subprocess
+import sqlite3
+import logging
+from datetime import datetime
+from .dbutil import get_connection
+
+logger = logging.getLogger('wm2')
+
+# Directory of the build scripts, which use relative paths to the SQL schemas
+scriptdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+class Stage:
+    """Build stage running a script on the database."""
+
+    def __init__(self,
+                 name: str,
+                 command: List[str],
+                 deps: List[str],
+                 tables: List[str],
+                 optional: bool = False):
+        """Initialize stage.
+
+        Optional stages are run only when selected, or when they have been run before.
+        """
+        self.name = name
+        self.command = command
+        self.deps = deps
+        self.tables = tables
+        self.optional = optional
+
+
+def build_stages(dbfile: str,
+                 buildargs: Optional[List[str]] = None) -> Dict[str, Stage]:
+    """Get stages of a full database build in dependency order."""
+    stages = [
+        Stage('unigrams', ['build_database.py', '-n', '-d', dbfile] + (buildargs or []),
+              [], ['wordfreqs', 'features']),
+        Stage('grams', ['generate_freqs.py', '-d', dbfile],
+              ['unigrams'], ['initgramfreqs', 'fingramfreqs', 'bigramfreqs', 'wordbigramfreqs']),
+        Stage('posx', ['generate_helper_tables.py', '-d', dbfile, '-p'],
+              ['unigrams'], ['wordfreqs']),
+        Stage('features', ['generate_helper_tables.py', '-d', dbfile, '-F'],
+              ['unigrams'], ['features', 'derivations', 'clitics', 'nouncases']),
+        Stage('forms', ['generate_helper_tables.py', '-d', dbfile, '-f'],
+              ['unigrams'], ['forms', 'lemmaforms']),
+        # Form aggregates need to be present before amblemma is calculated
+        Stage('lemmas', ['generate_helper_tables.py', '-d', dbfile, '-l'],
+              ['forms'], ['lemmas']),
+        Stage('hood', ['generate_helper_tables.py', '-d', dbfile, '-H'],
+              ['forms'], ['forms']),
+        Stage('copy', ['generate_helper_tables.py', '-d', dbfile, '-c'],
+              ['forms', 'hood', 'posx', 'features'], ['wordfreqs']),
+        Stage('indexes', ['manage_database.py', '-c', 'reindex', '-i', dbfile],
+              ['grams', 'lemmas', 'copy'], []),
+        Stage('querytable', ['generate_helper_tables.py', '-d', dbfile, '-Q'],
+              ['indexes'], ['wordquery'], optional=True),
+        Stage('trigrams', ['generate_helper_tables.py', '-d', dbfile, '-T'],
+              ['unigrams'], ['formtrigrams'], optional=True),
+        # Listed last: one stage at a time, the statistics cover the optional tables built before it
+        Stage('analyze', ['manage_database.py', '-c', 'analyze', '-i', dbfile],
+              ['indexes'], ['histograms']),
+    ]
+    return {stage.name: stage for stage in stages}
+
+
+def dependents(stages: Dict[str, Stage], names: Set[str]) -> Set[str]:
+    """Get stages depending on these stages, including the stages themselves."""
+    result = set(names)
+    changed = True
+    while changed:
+        changed = False
+        for stage in stages.values():
+            if stage.name not in result and result.intersection(stage.deps):
+                result.add(stage.name)
+                changed = True
+    return result
+
+
+def get_completed_stages(dbfile: str) -> Dict[str, str]:
+    """Get completed stages and their completion times from the database metadata."""
+    if not exists(dbfile):
+        return {}
+    sqlcon = get_connection(dbfile)
+    try:
+        rows = sqlcon.execute("SELECT key, value FROM metadata WHERE key LIKE 'stage_%'").fetchall()
+    except sqlite3.OperationalError:
+        # No metadata table yet
+        rows = []
+    sqlcon.close()
+    return {key[len('stage_'):]: value for key, value in rows}
+
+
+def record_stage(dbfile: str, name: str, completed: bool = True):
+    """Record a stage as completed (or not completed) in the database metadata."""
+    sqlcon = get_connection(dbfile)
+    if completed:
+        sqlcon.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?)',
+                       (f'stage_{name}', datetime.now().isoformat(timespec='seconds')))
+    else:
+        sqlcon.execute('DELETE FROM metadata WHERE key = ?', (f'stage_{name}',))
+    sqlcon.commit()
+    sqlcon.close()
+
+
+def count_rows(dbfile: str, tables: List[str]) -> str:
+    """Get row counts of existing tables."""
+    sqlcon = get_connection(dbfile)
+    counts = []
+    for table in tables:
+        try:
+            count = sqlcon.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+            counts.append(f'{table}: {count}')
+        except sqlite3.OperationalError:
+            pass
+    sqlcon.close()
+    return ', '.join(counts)
+
+
+def set_journal_mode(dbfile: str, mode: str):
+    """Set journal mode of the database."""
+    sqlcon = get_connection(dbfile)
+    sqlcon.execute(f'PRAGMA journal_mode={mode}')
+    sqlcon.close()
+
+
+def start_stage(stage: Stage, logdir: Optional[str]) -> Tuple[subprocess.Popen, Optional[TextIO]]:
+    """Start the script of a stage in a subprocess."""
+    command = [sys.executable] + stage.command
+    print(f"Starting stage {stage.name}: {' '.join(stage.command)}")
+    logfh = None
+    if logdir:
+        logfile = join(logdir, f'{stage.name}.log')
+        print(f'Writing output of stage {stage.name} to {logfile}')
+        logfh = open(logfile, 'w', encoding='utf-8')
+    process = subprocess.Popen(command, cwd=scriptdir, stdout=logfh, stderr=subprocess.STDOUT if logfh else None)
+    return process, logfh
+
+
+def run_pipeline(stages: Dict[str, Stage],
+                 dbfile: str,
+                 jobs: int = 1,
+                 redo: Optional[List[str]] = None,
+                 targets: Optional[List[str]] = None,
+                 logdir: Optional[str] = None) -> List[List]:
+    """Run build stages in dependency order, skipping completed stages.
+
+    Stages whose dependencies are completed are run concurrently, up to jobs
+    stages at a time. With more than one job, the database is in WAL mode
+    during the build, so that a stage can read while another one writes.
+    Writes of concurrent stages are serialized by SQLite locking.
+
+    Returns a report row (stage, status, seconds, row counts) for each stage.
+    """
+    completed = get_completed_stages(dbfile)
+    # Optional stages run before are kept up to date
+    wanted = {name for name, stage in stages.items() if not stage.optional or name in completed}
+    wanted.update(redo or [])
+    if redo:
+        for name in dependents(stages, set(redo)):
+            if name in completed:
+                record_stage(dbfile, name, completed=False)
+                del completed[name]
+
+    if targets:
+        wanted = set(targets)
+        # Dependencies of the targets
+        changed = True
+        while changed:
+            changed = False
+            for name in list(wanted):
+                for dep in stages[name].deps:
+                    if dep not in wanted:
+                        wanted.add(dep)
+                        changed = True
+
+    report: Dict[str, List] = {}
+    for name in stages:
+        if name in wanted and name in completed:
+            print(f'Skipping stage {name}, completed at {completed[name]}')
+            report[name] = [name, 'skipped', 0.0, '']
+
+    pending = [name for name in stages if name in wanted and name not in completed]
+    running: Dict[str, Tuple[subprocess.Popen, Optional[TextIO], float]] = {}
+    failed: Set[str] = set()
+    concurrent = False
+
+    if logdir and not exists(logdir):
+        os.makedirs(logdir)
+
+    while pending or running:
+        if jobs > 1 and not concurrent and not running and exists(dbfile):
+            set_journal_mode(dbfile, 'WAL')
+            concurrent = True
+        # Start stages whose dependencies are completed
+        for name in list(pending):
+            stage = stages[name]
+            if any(dep in failed for dep in stage.deps):
+                pending.remove(name)
+                failed.add(name)
+                report[name] = [name, 'not run', 0.0, '']
+                continue
+            if len(running) >= jobs or not all(dep in completed for dep in stage.deps):
+                continue
+            pending.remove(name)
+            process, logfh = start_stage(stage, logdir if jobs > 1 else None)
+            running[name] = (process, logfh, time.perf_counter())
+
+        if not running:
+            # Remaining stages depend on stages that were not selected
+            for name in pending:
+                report[name] = [name, 'not run', 0.0, '']
+            break
+
+        time.sleep(0.2)
+        for name, (process, logfh, start) in list(running.items()):
+            if process.poll() is None:
+                continue
+            elapsed = time.perf_counter() - start
+            if logfh:
+                logfh.close()
+            del running[name]
+            if process.returncode == 0:
+                record_stage(dbfile, name)
+                completed[name] = 'now'
+                rows = count_rows(dbfile, stages[name].tables)
+                print(f'Stage {name} completed in {elapsed:.1f} seconds')
+                report[name] = [name, 'done', elapsed, rows]
+            else:
+                logger.warning('Stage %s failed with exit code %d', name, process.returncode)
+                failed.add(name)
+                report[name] = [name, 'failed', elapsed, '']
+
+    if concurrent:
+        set_journal_mode(dbfile, 'DELETE')
+
+    return [report[name] for name in stages if name in report]
@@ -0,0 +1,379 @@
+"""Query planning: choosing how the rows of a query are read by estimated costs."""
+
+# pylint: disable=invalid-name, line-too-long
+
+import math
+import bisect
+import sqlite3
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple, Any
+
+# Trigram index of the distinct forms: (trigram, form) for each trigram of a form
+trigramtable = 'formtrigrams'
+
+# Histograms of columns: samples of the values, with the rows equal to and less than them
+histogramtable = 'histograms'
+histogrambuckets = 64
+
+# Text columns having histograms, in addition to the numeric columns and the features
+histogramcolumns = ['pos', 'posx']
+
+# Cost of looking up a row with an index, relative to scanning a row in the order of the results
+lookupcost = 13
+
+# GLOB wildcards: substrings having them are not looked up as trigrams,
+# and prefixes starting with one have no index range
+globchars = '*?['
+
+# Selectivity of conditions without statistics
+defaultselectivity = {
+    '=': 0.1, 'in': 0.1, 'like': 0.1,
+    '<': 0.33, '<=': 0.33, '>': 0.33, '>=': 0.33,
+    '!=': 0.9, 'notin': 0.9, 'not like': 0.9,
+}
+
+# Indexes for looking up the rows of a condition: column -> index suffix, with freq replaced
+# by freqx when the query is ordered by frequencyx
+seekindexes = {
+    'w.form': 'form_freq',
+    'w.revform': 'revform_freq',
+    'w.lemma': 'lemma_posx_freq',
+    'w.lemmac': 'lemmac_freq',
+    'w.start': 'form_rev',
+    'w.end': 'rev_form',
+}
+
+# Indexes in the order of the results having a column of the conditions, so it is checked in the index
+orderindexes = {
+    'w.form': 'freq_form',
+    'w.start': 'freq_form',
+    'w.middle': 'freq_form',
+    'w.revform': 'freq_revform',
+    'w.end': 'freq_revform',
+    'w.lemma': 'freq_lemma',
+    'w.len': 'freq_len',
+}
+# Otherwise the index of the order and id: the rows of a frequency are read in the table order
+defaultorderindex = 'freq_id'
+
+# Condition: (column, comparator, value), e.g. ('w.len', '>', '5'); in and notin have comma separated values
+Condition = Tuple[str, str, str]
+
+
+def get_trigrams(value: str) -> List[str]:
+    """Get the distinct trigrams of a string."""
+    return sorted({value[i:i + 3] for i in range(len(value) - 2)})
+
+
+def get_histogram(counts: List[Tuple[Any, int]],
+                  buckets: int = histogrambuckets) -> List[Tuple[Any, int, int, int]]:
+    """Get the histogram of a column from the row counts of its values in value order.
+
+    As in sqlite_stat4, values are sampled at each 1/buckets of the rows, and the values
+    having more rows than that are all sampled. A sample is (value, rows equal to it,
+    rows less than it, distinct values less than it).
+    """
+    total = sum(count for _, count in counts)
+    step = max(1.0, total / buckets)
+    samples = []
+    lt = 0
+    nextrow = step
+    for distinct, (value, count) in enumerate(counts):
+        if distinct in (0, len(counts) - 1) or count >= step or lt + count >= nextrow:
+            samples.append((value, count, lt, distinct))
+            nextrow = (math.floor((lt + count) / step) + 1) * step
+        lt += count
+    return samples
+
+
+def histogram_rows(samples: List[Tuple[Any, int, int, int]],
+                   comparator: str,
+                   value: Any) -> Optional[float]:
+    """Estimate the rows of a comparison from the samples of a histogram.
+
+    Between samples, the rows less than a value are interpolated by value, and the rows of
+    a value are the average of the values between the samples. Returns None if the value is
+    not comparable with the samples.
+    """
+    values = [sample[0] for sample in samples]
+    lastvalue, lasteq, lastlt, _ = samples[-1]
+    total = lastlt + lasteq
+    try:
+        i = bisect.bisect_right(values, value) - 1
+        if i < 0:
+            lt = le = 0.0
+        elif values[i] == value:
+            lt, le = samples[i][2], samples[i][2] + samples[i][1]
+        elif value > lastvalue:
+            lt = le = total
+        else:
+            _, eq, below, distinct = samples[i]
+            _, _, nextbelow, nextdistinct = samples[i + 1]
+            gaprows = nextbelow - below - eq
+            gapdistinct = nextdistinct - distinct - 1
+            try:
+                fraction = (value - values[i]) / (values[i + 1] - values[i])
+            except TypeError:
+                # Text values
+                fraction = 0.5
+            average = gaprows / gapdistinct if gapdistinct > 0 else 0
+            lt = below + eq + (gaprows - average) * fraction
+            le = lt + average
+    except TypeError:
+        return None
+    return {'=': le - lt, '!=': total - (le - lt),
+            '<': lt, '<=': le, '>': total - le, '>=': total - lt}.get(comparator)
+
+
+class Statistics:
+    """Statistics of a database.
+
+    The rows per key of the indexes are from ANALYZE (sqlite_stat1), and the histograms of the columns from
+    the histograms table.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        """Read the statistics of a database."""
+        self.tablerows: Dict[str, int] = {}
+        self.keyrows: Dict[str, List[int]] = {}
+        self.histograms: Dict[Tuple[str, str], List[Tuple[Any, int, int, int]]] = defaultdict(list)
+        try:
+            for table, index, stat in connection.execute('SELECT tbl, idx, stat FROM sqlite_stat1'):
+                numbers = [int(part) for part in stat.split() if part.isdigit()]
+                self.tablerows[table] = numbers[0]
+                if index:
+                    self.keyrows[index] = numbers[1:]
+            for table, column, value, eq, lt, distinct in connection.execute(
+                    f'SELECT tbl, col, value, eq, lt, dlt FROM {histogramtable} ORDER BY tbl, col, lt'):
+                self.histograms[(table, column)].append((value, eq, lt, distinct))
+        except sqlite3.OperationalError:
+            # The database has not been analyzed
+            pass
+
+    def analyzed(self) -> bool:
+        """Check if the database has statistics."""
+        return bool(self.tablerows)
+
+    def rows_per_key(self, index: str, columns: int = 1) -> Optional[int]:
+        """Get the average rows per key of the first columns of an index."""
+        keyrows = self.keyrows.get(index, [])
+        return keyrows[columns - 1] if len(keyrows) >= columns else None
+
+    def selectivity(self, tables: List[str], column: str, comparator: str, value: str) -> Optional[float]:
+        """Estimate the fraction of rows satisfying a comparison from the histogram of the first table having one."""
+        for table in tables:
+            if (samples := self.histograms.get((table, column))):
+                break
+        else:
+            return None
+        total = samples[-1][1] + samples[-1][2]
+        if comparator in ('in', 'notin'):
+            values = [v.strip() for v in value.split(',')]
+            comparator = '=' if comparator == 'in' else '!='
+        else:
+            values = [value]
+        if comparator not in ('=', '!=', '<', '<=', '>', '>='):
+            return None
+        if isinstance(samples[0][0], (int, float)):
+            try:
+                values = [float(v) for v in values]  # type: ignore
+            except ValueError:
+                return None
+        rows = [histogram_rows(samples, '=' if comparator == '!=' else comparator, v) for v in values]
+        if total == 0 or None in rows:
+            return None
+        fraction = sum(rows) / total  # type: ignore
+        return max(0.0, 1 - fraction) if comparator == '!=' else min(1.0, fraction)
+
+
+def has_index(connection: sqlite3.Connection, name: str) -> bool:
+    """Check if the database has an index."""
+    sqlstr = "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?"
+    return connection.execute(sqlstr, (name,)).fetchone() is not None
+
+
+def has_table(connection: sqlite3.Connection, name: str) -> bool:
+    """Check if the database has a table."""
+    sqlstr = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+    return connection.execute(sqlstr, (name,)).fetchone() is not None
+
+
+def get_index(connection: sqlite3.Connection,
+              table: str,
+              suffix: str,
+              useposx: bool) -> Optional[str]:
+    """Get the name of an index of the table, the one with frequencyx if the query uses it and the index exists."""
+    index = f'idx_{table}_{suffix}'
+    xindex = f"idx_{table}_{'_'.join('freqx' if part == 'freq' else part for part in suffix.split('_'))}"
+    if useposx and xindex != index and has_index(connection, xindex):
+        return xindex
+    return index if has_index(connection, index) else None
+
+
+def count_rows(connection: sqlite3.Connection,
+               table: str,
+               index: str,
+               where: str,
+               args: List[str],
+               cap: int) -> int:
+    """Count the rows of a condition using an index, up to cap."""
+    return connection.execute(f'SELECT count(*) FROM (SELECT 1 FROM {table} INDEXED BY {index} WHERE {where} LIMIT ?)',
+                              args + [cap]).fetchone()[0]
+
+
+def count_forms(connection: sqlite3.Connection,
+                trigram: str,
+                cap: int) -> int:
+    """Count the forms having a trigram, up to cap."""
+    return connection.execute(f'SELECT count(*) FROM (SELECT 1 FROM {trigramtable} WHERE trigram = ? LIMIT ?)',
+                              (trigram, cap)).fetchone()[0]
+
+
+def get_values(comparator: str, value: str) -> List[str]:
+    """Get the values of a condition."""
+    return [v.strip() for v in value.split(',')] if comparator in ('in', 'notin') else [value]
+
+
+def middle_candidates(connection: sqlite3.Connection,
+                      values: List[str],
+                      cap: int) -> Optional[Tuple[str, List[str], int]]:
+    """Get a condition narrowing the forms of a middle query to candidates from the trigram index.
+
+    The candidates of a substring are the forms having its rarest trigram; the GLOB of
+    the query is still checked for the rows. Returns the condition, its arguments and the
+    number of candidates, or None if there are at least cap candidates.
+    """
+    if any(len(value) < 3 or any(ch in value for ch in globchars) for value in values):
+        return None
+    trigrams = []
+    total = 0
+    for value in values:
+        rarest = None
+        rarestcount = cap - total
+        for trigram in get_trigrams(value):
+            count = count_forms(connection, trigram, rarestcount)
+            if count < rarestcount:
+                rarest, rarestcount = trigram, count
+        if rarest is None:
+            return None
+        trigrams.append(rarest)
+        total += rarestcount
+    subqueries = ' UNION ALL '.join([f'SELECT form FROM {trigramtable} WHERE trigram = ?'] * len(trigrams))
+    return f'w.form IN ({subqueries})', trigrams, total
+
+
+def seek_rows(connection: sqlite3.Connection,
+              table: str,
+              condition: Condition,
+              useposx: bool,
+              cap: int) -> Optional[Tuple[str, int]]:
+    """Count the rows of a condition in the index for looking them up, up to cap.
+
+    Returns the index and the rows, or None if the condition has no index for looking up rows.
+    """
+    column, comparator, value = condition
+    if column not in seekindexes or comparator not in ('=', 'in'):
+        return None
+    if (index := get_index(connection, table, seekindexes[column], useposx)) is None:
+        return None
+    values = get_values(comparator, value)
+    if column in ('w.start', 'w.end'):
+        # A range of the index for each alternative
+        prefixes = values if column == 'w.start' else [v[::-1] for v in values]
+        if any(not prefix or prefix[0] in globchars for prefix in prefixes):
+            return None
+        indexcol = 'form' if column == 'w.start' else 'revform'
+        count = 0
+        for prefix in prefixes:
+            count += count_rows(connection, table, index, f'{indexcol} GLOB ?', [f'{prefix}*'], cap - count)
+        return index, count
+    where = f"{column[2:]} IN ({','.join(['?'] * len(values))})"
+    return index, count_rows(connection, table, index, where, values, cap)
+
+
+def plan_query(connection: sqlite3.Connection,
+               statistics: Statistics,
+               table: str,
+               conditions: List[Condition],
+               limit: int,
+               useposx: bool,
+               orderstring: str) -> Tuple[str, str, List[str]]:
+    """Choose how to read the rows of a query by estimated costs.
+
+    The costs are in rows scanned in the order of the results. Scanning an index in the
+    result order until the limit costs limit / selectivity rows, the selectivity being the
+    product of the selectivities of the conditions. Ordered by frequency, the index is the
+    frequency index having a column of the conditions; ordered by another column, the index
+    starting with the column, and without one all the rows are scanned. Looking up the rows of a condition with
+    an index (or the trigram index, or the lemmas joined to wordfreqs) costs lookupcost per
+    row. The rows of the conditions having an index are counted, up to the rows where
+    looking up would cost more than scanning the whole table; the selectivity of the other
+    conditions is estimated from the histograms, or defaults without them.
+
+    Returns the INDEXED BY clause (empty if SQLite chooses the index, e.g. for the trigram
+    candidates), a condition to add and its arguments.
+    """
+    rows = (statistics.tablerows.get('wordfreqs')
+            or connection.execute(f'SELECT max(rowid) FROM {table}').fetchone()[0] or 1)
+    cap = rows // lookupcost + 1
+    freqcol = 'w.frequencyx' if useposx else 'w.frequency'
+    ordercol = orderstring.split(' ')[0]
+    wide = table != 'wordfreqs'
+    # Tables of the histograms of each alias, the wide query table having the columns of all of them
+    histtables = {'w': [table, 'wordfreqs', 'lemmas', 'features'], 'l': ['lemmas'],
+                  'ft': ['features'], 'd': ['features'], 'c': ['features'], 'n': ['features']}
+    selectivity = 1.0
+    rangerows = float(rows)
+    # (cost, INDEXED BY clause, condition, arguments)
+    lookups: List[Tuple[float, str, str, List[str]]] = []
+    for condition in conditions:
+        column, comparator, value = condition
+        alias, name = column.split('.', 1)
+        fraction = None
+        if (seek := seek_rows(connection, table, condition, useposx, cap)) is not None:
+            index, count = seek
+            fraction = count / rows
+            if count < cap:
+                lookups.append((count * lookupcost, f'indexed by {index}', '', []))
+        elif column == 'w.middle' and comparator in ('=', 'in') and has_table(connection, trigramtable):
+            if (candidates := middle_candidates(connection, get_values(comparator, value), cap)) is not None:
+                candidatestr, candidateargs, count = candidates
+                fraction = count / rows
+                lookups.append((count * lookupcost, '', candidatestr, candidateargs))
+        elif (column == 'l.lemmac' and comparator in ('=', 'in') and not wide
+              and has_index(connection, 'lemmas_lemmac_pos')):
+            # Lemmas looked up first, joined to their rows in wordfreqs
+            values = get_values(comparator, value)
+            count = count_rows(connection, 'lemmas', 'lemmas_lemmac_pos',
+                               f"lemmac IN ({','.join(['?'] * len(values))})", values, cap)
+            count *= statistics.rows_per_key('idx_wordfreqs_lemma_posx_freq', 2) or 1
+            fraction = min(1.0, count / rows)
+            if count < cap:
+                lookups.append((count * lookupcost, '', '', []))
+        if fraction is None and alias in histtables:
+            fraction = statistics.selectivity(histtables[alias], name, comparator, value)
+        if fraction is None:
+            fraction = min(1.0, defaultselectivity.get(comparator, 1.0) * len(get_values(comparator, value)))
+        selectivity *= fraction
+        if column == ordercol and comparator in ('<', '<=', '>', '>='):
+            # A range of the order index
+            rangerows = min(rangerows, fraction * rows)
+
+    scancost = min(rangerows, limit / max(selectivity, 1 / rows))
+    if ordercol == freqcol:
+        columns = [condition[0] for condition in conditions]
+        suffix = next((orderindex for column, orderindex in orderindexes.items() if column in columns),
+                      defaultorderindex)
+        orderindex = (get_index(connection, table, suffix, useposx)
+                      or get_index(connection, table, defaultorderindex, useposx)
+                      or get_index(connection, table, 'freq_len', useposx))
+    else:
+        orderindex = get_index(connection, table, seekindexes[ordercol], useposx) if ordercol in seekindexes else None
+        if orderindex is None:
+            # All the rows are read and sorted
+            scancost = float(rows)
+    best: Tuple[float, str, str, List[str]] = (scancost, f'indexed by {orderindex}' if orderindex else '', '', [])
+    for lookup in lookups:
+        if lookup[0] < best[0]:
+            best = lookup
+    return best[1], best[2], best[3]
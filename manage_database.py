@@ -14,7 +14,7 @@ import logging
 import logging.config
 from tqdm.autonotebook import tqdm
 
-from lib import dbutil, buildutil
+from lib import dbutil, buildutil, delta, hood
 
 
 wm2logconfig = {
@@ -89,6 +89,20 @@ parser.add_argument('-y', '--yes',
                     action='store_true',
                     help='Do not ask for confirmation')
 
+parser.add_argument('-D', '--drop-helpers',
+                    action='store_true',
+                    help='Drop helper tables instead of updating them')
+
+parser.add_argument('-j', '--jobs',
+                    type=int,
+                    default=1,
+                    help='Number of worker processes for updating the neighbourhood')
+
+parser.add_argument('-A', '--analysis-cache',
+                    type=str,
+                    default=hood.analysiscache,
+                    help='Cache file for morphological analyses')
+
 args = parser.parse_args()
 cmd = args.cmd
 
@@ -109,7 +123,7 @@ if cmd == 'prune':
         sys.exit()
 
     print(f'Using {inputfile} as source database')
-    dbconn = dbutil.DatabaseConnection(inputfile)
+    dbconn = dbutil.DatabaseConnection(inputfile, aggregates=False)
     sqlcon = dbconn.get_connection()
     if args.output:
         print(f'Copy database to {args.output}')
@@ -166,18 +180,34 @@ if cmd == 'prune':
         copy(inputfile, args.output)
         sqlcon = dbutil.get_connection(args.output)
 
+    # Helper tables are updated for the deleted rows, if they exist
+    incremental = not args.drop_helpers and delta.has_tables(sqlcon, delta.helpertables)
+    if incremental:
+        print('Recording rows to be deleted...')
+        conditions = []
+        if args.pos is not None:
+            conditions.append(f"pos in ({','.join(repr(p) for p in prunepos)})")
+        if args.frequency is not None:
+            conditions.append(f"frequency < {args.frequency}")
+        if args.maxlength is not None:
+            conditions.append(f"len > {args.maxlength}")
+        delta.start_changes(sqlcon)
+        delta.add_changed_rows(sqlcon, ' or '.join(conditions))
+
     # Drop extraneous information:
-    #  - helper tables
+    #  - helper tables (unless updated)
     #  - wordfreqs indexes, except unique
-    #  - nullify computed wordfreqs info: hood, ambform
+    #  - nullify computed wordfreqs info: hood, ambform (unless updated)
 
-    print('Dropping helper tables...')
-    buildutil.drop_helper_tables(sqlcon)
+    if not incremental:
+        print('Dropping helper tables...')
+        buildutil.drop_helper_tables(sqlcon)
     print('Dropping wordfreqs indexes...')
     if args.pos is None:
         buildutil.drop_indexes(sqlcon, 'wordfreqs', exclude='freq_len')
-    print('Nullifying computed information...')
-    buildutil.nullify_wordfreqs(sqlcon)
+    if not incremental:
+        print('Nullifying computed information...')
+        buildutil.nullify_wordfreqs(sqlcon)
 
     print('Dropping matching rows...')
     # Deletion
@@ -202,10 +232,20 @@ if cmd == 'prune':
         print('Re-linking features information...')
         buildutil.add_features(dbconn)
 
+    if incremental:
+        print('Updating helper tables...')
+        delta.update_helper_tables(sqlcon, cachefile=args.analysis_cache, jobs=args.jobs)
+        if buildutil.has_query_table(sqlcon):
+            buildutil.create_query_table(sqlcon)
+
+    print('Storing aggregate totals...')
+    dbutil.store_aggregate_totals(sqlcon)
+
     # FIXME: run vacuum
     # buildutil.vacuum(sqlcon)
 
-    print('Remember to run the scripts for adding grams and helper tables!')
+    if not incremental:
+        print('Remember to run the scripts for adding grams and helper tables!')
 
 if cmd == 'concat':
     if not args.output:
@@ -235,6 +275,15 @@ if cmd == 'concat':
 
     targetcon = dbutil.get_connection(args.output)
     cursor = targetcon.cursor()
+    # Inserted rows are in the query table after linking their features
+    buildutil.drop_query_table(targetcon)
+    # Inserted forms are not in the trigram index
+    buildutil.drop_trigram_table(targetcon)
+
+    # Helper tables of an existing target are updated for the inserted rows
+    incremental = not args.drop_helpers and delta.has_tables(targetcon, delta.helpertables)
+    if incremental:
+        delta.start_changes(targetcon)
 
     print(f'Inserting data from {len(args.input)} files')
     insertpat = "insert into wordfreqs (%s) values (%s) on conflict(lemma, form, pos, feats) do update set frequency = frequency + excluded.frequency"
@@ -247,6 +296,8 @@ if cmd == 'concat':
         print(f'Inserting data from {fn}...')
         sqlcon = dbutil.get_connection(fn)
         dbdata = dbutil.adhoc_query(sqlcon, "SELECT * FROM wordfreqs", todf=True).drop('id', axis=1)
+        # Feature ids of the input databases are not valid in the target database
+        dbdata['featid'] = 0
         if columns is None:
             columns = dbdata.columns
             print(columns)
@@ -255,6 +306,9 @@ if cmd == 'concat':
             insertsql = insertpat % (', '.join(columns), ','.join(qs))
             print(insertsql)
 
+        if incremental:
+            delta.add_changed_keys(targetcon, dbdata[['lemma', 'form', 'pos', 'posx', 'feats']].values.tolist())
+
         totwordchunks = math.ceil(len(dbdata)/chunklen)
 
         print(f'Inserting {len(dbdata)} rows in {totwordchunks} chunks...')
@@ -270,3 +324,23 @@ if cmd == 'concat':
                 targetcon.rollback()
             # break
         # break
+
+    if incremental:
+        print('Updating helper tables...')
+        delta.update_helper_tables(targetcon, cachefile=args.analysis_cache, jobs=args.jobs)
+        print('Remember to run generate_helper_tables.py -F for linking the features of the inserted rows!')
+
+    print('Storing aggregate totals...')
+    dbutil.store_aggregate_totals(targetcon)
+
+if cmd == 'reindex':
+    for inputfile in args.input:
+        print(f'Re-adding indexes to {inputfile}...')
+        sqlcon = dbutil.get_connection(inputfile)
+        buildutil.add_schema(sqlcon, 'wordfreqs_indexes.sql')
+
+if cmd == 'analyze':
+    for inputfile in args.input:
+        print(f'Analyzing {inputfile} for the query planner...')
+        sqlcon = dbutil.get_connection(inputfile)
+        buildutil.analyze_database(sqlcon)
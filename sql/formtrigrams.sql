@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS formtrigrams (
+       trigram VARCHAR(3) NOT NULL,
+       form VARCHAR(256) NOT NULL,
+       PRIMARY KEY (trigram, form)
+) WITHOUT ROWID;
@@ -0,0 +1,11 @@
+-- Histograms of columns for the query planner: samples of the values of a column,
+-- with the rows equal to the value and the rows and distinct values less than it
+CREATE TABLE IF NOT EXISTS histograms (
+       tbl VARCHAR(32) NOT NULL,
+       col VARCHAR(32) NOT NULL,
+       value,
+       eq INTEGER NOT NULL,
+       lt INTEGER NOT NULL,
+       dlt INTEGER NOT NULL,
+       PRIMARY KEY (tbl, col, lt)
+);
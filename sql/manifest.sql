@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS manifest (
+       path VARCHAR(1024) NOT NULL,
+       size INTEGER NOT NULL,
+       mtime FLOAT NOT NULL,
+       sha256 VARCHAR(64) NOT NULL,
+       tokens INTEGER NOT NULL DEFAULT 0,
+       completed VARCHAR(32) NOT NULL,
+       PRIMARY KEY (path)
+);
@@ -36,3 +36,7 @@ CREATE INDEX IF NOT EXISTS idx_wordfreqs_feats_pos on wordfreqs(feats, pos);
 --CREATE INDEX IF NOT EXISTS idx_wordfreqs_feats_pos_featid_partial on wordfreqs(feats, pos, featid) where featid = 0;
 --CREATE INDEX IF NOT EXISTS idx_wordfreqs_lemma_posx on wordfreqs(lemma, posx);
 CREATE INDEX IF NOT EXISTS idx_wordfreqs_lemma_posx_freq on wordfreqs(lemma, posx, frequency DESC);
+
+-- Indexes for paging: ordering column and id
+CREATE INDEX IF NOT EXISTS idx_wordfreqs_freq_id ON wordfreqs(frequency DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_wordfreqs_freqx_id ON wordfreqs(frequencyx DESC, id DESC);
@@ -0,0 +1,19 @@
+-- Indexes of the query table, named as the wordfreqs indexes they replace
+CREATE INDEX IF NOT EXISTS idx_wordquery_freq_lemma ON wordquery(frequency DESC, lemma);
+CREATE INDEX IF NOT EXISTS idx_wordquery_freq_revform ON wordquery(frequency DESC, revform);
+CREATE INDEX IF NOT EXISTS idx_wordquery_freq_len ON wordquery(frequency DESC, len DESC);
+CREATE INDEX IF NOT EXISTS idx_wordquery_freq_id ON wordquery(frequency DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_wordquery_freqx_lemma ON wordquery(frequencyx DESC, lemma);
+CREATE INDEX IF NOT EXISTS idx_wordquery_freqx_revform ON wordquery(frequencyx DESC, revform);
+CREATE INDEX IF NOT EXISTS idx_wordquery_freqx_len ON wordquery(frequencyx DESC, len DESC);
+CREATE INDEX IF NOT EXISTS idx_wordquery_freqx_id ON wordquery(frequencyx DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_wordquery_form_freq ON wordquery(form, frequency DESC);
+CREATE INDEX IF NOT EXISTS idx_wordquery_form_freqx ON wordquery(form, frequencyx DESC);
+CREATE INDEX IF NOT EXISTS idx_wordquery_revform_freq ON wordquery(revform, frequency DESC);
+CREATE INDEX IF NOT EXISTS idx_wordquery_revform_freqx ON wordquery(revform, frequencyx DESC);
+CREATE INDEX IF NOT EXISTS idx_wordquery_form_rev ON wordquery(form, revform);
+CREATE INDEX IF NOT EXISTS idx_wordquery_rev_form ON wordquery(revform, form);
+CREATE INDEX IF NOT EXISTS idx_wordquery_lemmac_freq ON wordquery(lemmac, frequency DESC);
+CREATE INDEX IF NOT EXISTS idx_wordquery_lemmac_freqx ON wordquery(lemmac, frequencyx DESC);
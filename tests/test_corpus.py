@@ -0,0 +1,139 @@
+"""Testing corpus readers."""
+
+# pylint: disable=invalid-name, redefined-outer-name
+
+import sys
+import os
+import os.path
+import gzip
+import pytest
+from pytest_check import check
+
+currdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currdir)
+sys.path.append(parentdir)
+
+from lib import corpus
+from lib.accumulator import FreqAccumulator
+from lib.features import allfeatures
+
+sample = """# sent_id = 1
+# text = Autotallissakin oli voita.
+1\tAutotallissakin\tauto#talli\tNOUN\t_\tCase=Ine|Clitic=Kin|Number=Sing\t2\tobl\t_\t_
+2\toli\tolla\tAUX\t_\tMood=Ind|Number=Sing|Person=3|Tense=Past|VerbForm=Fin|Voice=Act\t0\troot\t_\t_
+3\tvoita\tvoi\tNOUN\t_\tCase=Par|Number=Plur|Typo=Yes\t2\tnsubj\t_\t_
+4\t.\t.\tPUNCT\t_\t_\t2\tpunct\t_\t_
+
+# sent_id = 2
+1-2\tvoinko\t_\t_\t_\t_\t_\t_\t_\t_
+1\tvoin\tvoida\tVERB\t_\tMood=Ind|Number=Sing|Person=1|Tense=Pres|VerbForm=Fin|Voice=Act\t0\troot\t_\t_
+2\tko\tko\tPART\t_\tClitic=Ko\t1\tadvmod\t_\t_
+3\tsinun  kanssa\tsinä\tPRON\t_\tCase=Gen|Number=Sing|Person=2\t1\tobl\t_\t_
+4\tauton\tauto\tNOUN\t_\tCase=Gen|Derivation=Inen,Ja|Number=Sing\t1\tobj\t_\t_
+"""
+
+
+@pytest.fixture(scope="module")
+def samplefile(tmp_path_factory):
+    """Write sample conllu file."""
+    filename = tmp_path_factory.mktemp('corpus') / 'sample.conllu'
+    filename.write_text(sample, encoding='utf-8')
+    return str(filename)
+
+
+def test_scanner(samplefile):
+    """Check that the token scanner returns the same tokens as the conllu parser."""
+    parsed = []
+    for idx, tokenlist in corpus.conllu_file_reader(samplefile):
+        parsed.append((idx, [(t['form'], t['lemma'], t['upos'], corpus.serialize_feats(t['feats']))
+                             for t in tokenlist]))
+    scanned = []
+    for idx, tokens in corpus.conllu_fast_file_reader(samplefile):
+        scanned.append((idx, [(form, lemma, upos, corpus.filter_feats(feats, allfeatures)[0])
+                              for form, lemma, upos, feats in tokens]))
+    check.equal(scanned, parsed)
+
+
+def test_sentencecount(samplefile):
+    """Check that the sentence count limit is respected."""
+    scanned = list(corpus.conllu_fast_file_reader(samplefile, sentencecount=1))
+    check.equal(len(scanned), 1)
+
+
+def test_freqs(samplefile):
+    """Check that both readers produce the same frequencies."""
+    featmap = {k: v for k, v in allfeatures.items() if k not in ('Typo', 'Clitic')}
+    parsed = corpus.conllu_freq_reader(samplefile, featmap, validate=True)
+    scanned = corpus.conllu_freq_reader(samplefile, featmap)
+    check.equal(list(scanned.items()), list(parsed.items()))
+    check.equal(scanned[('voi', 'voita', 'NOUN', 'Case=Par|Number=Plur')], 1)
+
+
+def test_spill(samplefile, tmp_path):
+    """Check that spilled and merged frequencies match the in-memory frequencies."""
+    featmap = dict(allfeatures)
+    inmemory = corpus.conllu_freq_reader(samplefile, featmap)
+    spilled = corpus.conllu_freq_reader(samplefile, featmap,
+                                        counts=FreqAccumulator(budget=0, tmpdir=str(tmp_path)))
+    check.equal(len(spilled.runs), 1)
+    check.equal(list(spilled.items()), sorted(inmemory.items()))
+    check.equal(len(spilled.runs), 2)
+    check.equal(spilled.total(), inmemory.total())
+    check.equal(spilled.featdict('Clitic=Ko'), {'Clitic': 'Ko'})
+    spilled.remove_runs()
+    check.equal(list(tmp_path.iterdir()), [])
+
+
+def test_ranges(tmp_path):
+    """Check that byte ranges start at sentence boundaries and cover the whole file."""
+    filename = tmp_path / 'ranges.conllu'
+    filename.write_text((sample + '\n') * 20, encoding='utf-8')
+    ranges = corpus.sentence_ranges(str(filename), rangesize=500)
+    check.greater(len(ranges), 1)
+    check.equal(ranges[0][0], 0)
+    check.equal(ranges[-1][1], filename.stat().st_size)
+    expected = [tokens for _idx, tokens in corpus.conllu_fast_file_reader(str(filename))]
+    scanned = []
+    for start, end in ranges:
+        lines = corpus.read_range(str(filename), start, end)
+        scanned.extend(tokens for _idx, tokens in corpus.conllu_token_scanner(lines))
+    check.equal(scanned, expected)
+
+
+def test_block_gzip(tmp_path):
+    """Check that block gzipped files can be read in ranges and as whole files."""
+    filename = tmp_path / 'blocks.conllu'
+    filename.write_text((sample + '\n') * 20, encoding='utf-8')
+    gzfilename = str(filename) + '.gz'
+    with open(filename, 'rb') as inh, gzip.open(gzfilename, 'wb') as outh:
+        outh.write(inh.read())
+    blockfile, ranges = corpus.file_ranges(gzfilename, rangesize=500)
+    check.equal(blockfile, str(tmp_path / 'blocks.blocks.conllu.gz'))
+    check.greater(len(ranges), 1)
+    lines = []
+    for start, end in ranges:
+        lines.extend(corpus.read_range(blockfile, start, end))
+    expected = list(corpus.conllu_fast_file_reader(str(filename)))
+    check.equal(list(corpus.conllu_token_scanner(lines)), expected)
+    check.equal(list(corpus.conllu_fast_file_reader(blockfile)), expected)
+
+
+vrtsample = """<!-- #vrt positional-attributes: word ref lemma lemmacomp pos msd dephead deprel spaces initid lex/ -->
+<text id="1">
+<sentence id="1">
+Autotallissakin\t1\tauto#talli\tauto|talli\tNOUN\tCase_Ine|Clitic_Kin|Number_Sing\t2\tobl\t_\t_\t|auto#talli..n.1|
+oli\t2\tolla\tolla\tAUX\tMood_Ind|Number_Sing|Person_3|Tense_Past|VerbForm_Fin|Voice_Act\t0\troot\t_\t_\t|olla..v.1|
+voita\t3\tvoi\tvoi\tNOUN\tCase_Par|Number_Plur|Typo_Yes\t2\tnsubj\t_\t_\t|voi..n.1|
+.\t4\t.\t.\tPUNCT\t_\t2\tpunct\t_\t_\t|.|
+</sentence>
+</text>
+"""
+
+
+def test_vrt(tmp_path):
+    """Check that the VRT scanner returns the same tokens as the conllu scanner."""
+    filename = tmp_path / 'sample.vrt.gz'
+    with gzip.open(filename, 'wt', encoding='utf-8') as fh:
+        fh.write(vrtsample)
+    expected = list(corpus.conllu_token_scanner(sample.split('\n'), sentencecount=1))
+    check.equal(list(corpus.vrt_file_reader(str(filename))), expected)
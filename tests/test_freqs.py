@@ -0,0 +1,108 @@
+"""Testing frequency generation."""
+
+# pylint: disable=invalid-name
+
+import sys
+import os
+import os.path
+from collections import Counter
+import numpy as np
+from pytest_check import check
+
+currdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currdir)
+sys.path.append(parentdir)
+
+from lib import dbutil, hood
+from lib.memo import PersistentCache
+
+forms = ['auto', 'autotalli', 'talo', 'voi', 'oli', 'ko', 'äiti', 'öljyä', 'autoissa']
+freqs = [10, 3, 7, 5, 20, 2, 4, 1, 6]
+
+
+def test_gram_freqs():
+    """Check vectorized gram frequencies against counting form by form."""
+    init, fin, bi = Counter(), Counter(), Counter()  # type: ignore
+    for form, freq in zip(forms, freqs):
+        for i in range(len(form) - 1):
+            bi[form[i:i+2]] += freq
+        if len(form) >= 4:
+            init[form[:3]] += freq
+            fin[form[-3:]] += freq
+    means = [(form, sum(bi[form[i:i+2]] for i in range(len(form) - 1)) // (len(form) - 1))
+             for form in forms]
+
+    result = dbutil.count_gram_freqs(forms, np.array(freqs))
+    check.equal(result[0], init)
+    check.equal(result[1], fin)
+    check.equal(result[2], bi)
+    check.equal(result[3], means)
+    check.equal(result[2]['au'], 19)
+
+
+hoodfreqs = {'talo': 500, 'talot': 50, 'palo': 20000, 'tali': 200, 'tola': 300,
+             'atlo': 5000, 'kalo': 150, 'salo': 99, 'talo1': 1, 'taloa': 10000}
+
+
+def test_hood(tmp_path):
+    """Check neighbour counts against pairwise edit distances."""
+    def analyzable(form):
+        return form != 'kalo'
+
+    def neighbours(form, other):
+        if len(form) != len(other) or form == other:
+            return False
+        diffs = [i for i in range(len(form)) if form[i] != other[i]]
+        return len(diffs) == 1 or (len(diffs) == 2 and diffs[1] == diffs[0] + 1
+                                   and form[diffs[0]] == other[diffs[1]] and form[diffs[1]] == other[diffs[0]])
+
+    def ok(form):
+        freq = hoodfreqs[form]
+        return freq >= hood.autofreq or (freq >= hood.minfreq and analyzable(form))
+
+    expected = {form: sum(neighbours(form, other) and ok(other) for other in hoodfreqs) for form in hoodfreqs}
+    analyses = PersistentCache(analyzable, str(tmp_path / 'analyses.db'))
+    counts = hood.hood_counts(list(hoodfreqs), list(hoodfreqs.values()), analyses)
+    check.equal(counts, expected)
+    check.equal(counts['talo'], 3)
+    check.equal(counts['talot'], 1)
+    # Analyses come from the cache file on the second run
+    _, misses, _ = analyses.stats()
+    analyses = PersistentCache(analyzable, str(tmp_path / 'analyses.db'))
+    check.equal(hood.hood_counts(list(hoodfreqs), list(hoodfreqs.values()), analyses), expected)
+    check.equal(analyses.stats()[:2], (misses, 0))
+
+
+def test_aggregate_totals(tmp_path):
+    """Check that totals are stored and calculated again when the tables change."""
+    sqlcon = dbutil.get_connection(str(tmp_path / 'totals.db'))
+    sqlcon.executescript("""
+    CREATE TABLE wordfreqs (id INTEGER PRIMARY KEY, frequency INTEGER);
+    CREATE TABLE metadata (key VARCHAR(16) NOT NULL, value VARCHAR(16) NOT NULL, PRIMARY KEY (key));
+    INSERT INTO wordfreqs (frequency) VALUES (3), (4);
+    """)
+    totals = dbutil.get_aggregate_totals(sqlcon)
+    check.equal(totals['wordfreqs'], 7)
+    check.is_none(totals['lemmafreqs'])
+    # The stored totals are used until the next write
+    stored = dict(sqlcon.execute("SELECT key, value FROM metadata").fetchall())
+    check.equal(stored['totals_fingerprint'], dbutil.get_content_version(sqlcon))
+    # Updates in place change the content version
+    sqlcon.execute("UPDATE wordfreqs SET frequency = 10 WHERE id = 1")
+    sqlcon.commit()
+    check.equal(dbutil.get_aggregate_totals(sqlcon)['wordfreqs'], 14)
+    # Added rows and tables do
+    sqlcon.executescript("""
+    INSERT INTO wordfreqs (frequency) VALUES (1);
+    CREATE TABLE lemmas (lemma TEXT, pos TEXT, lemmafreq INTEGER);
+    INSERT INTO lemmas VALUES ('talo', 'NOUN', 5);
+    """)
+    totals = dbutil.get_aggregate_totals(sqlcon)
+    check.equal(totals['wordfreqs'], 15)
+    check.equal(totals['lemmafreqs'], 5)
+    # In WAL mode there is no content version: the totals are calculated each time
+    sqlcon.execute('PRAGMA journal_mode=WAL')
+    check.is_none(dbutil.get_content_version(sqlcon))
+    sqlcon.execute("UPDATE wordfreqs SET frequency = 20 WHERE id = 1")
+    sqlcon.commit()
+    check.equal(dbutil.get_aggregate_totals(sqlcon)['wordfreqs'], 25)
@@ -0,0 +1,188 @@
+"""Testing the query planner: the chosen plans and the statistics they are based on."""
+
+# pylint: disable=invalid-name, redefined-outer-name
+
+import sys
+import os
+import os.path
+import shutil
+import pytest
+from pytest_check import check
+
+currdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currdir)
+sys.path.append(parentdir)
+
+from lib import buildutil, dbutil, planner
+
+# Queries of test_queries.py and the plans chosen for them in the analyzed test database:
+# the forced index, the trigram index for the candidates, or '' for the index chosen by SQLite
+plans = {
+    "form = voi and ambform < 0.9": 'idx_wordfreqs_form_freqx',
+    "start = auto": 'idx_wordfreqs_form_rev',
+    "clitic != _": 'idx_wordfreqs_freqx_id',
+    "nouncase = Ine and len > 5": 'idx_wordfreqs_freqx_len',
+    "lemma = valtakunta and compound": '',
+    "lemma = valtakunta": '',
+    "middle = sta": planner.trigramtable,
+    "middle in sta,iin": planner.trigramtable,
+    "middle = la": 'idx_wordfreqs_freqx_form',
+    "start = auto and end = lla": 'idx_wordfreqs_form_rev',
+    "start = k and end = ssa and pos = AUX": 'idx_wordfreqs_form_rev',
+    "start = la and middle != la": 'idx_wordfreqs_form_rev',
+    "end in ssa,ssä": 'idx_wordfreqs_freqx_revform',
+    "end not in a,ä": 'idx_wordfreqs_freqx_revform',
+    "clitic = Kin": 'idx_wordfreqs_freqx_id',
+    "pos = VERB": 'idx_wordfreqs_freqx_id',
+    "pos = AUX": 'idx_wordfreqs_freq_id',
+    "frequency > 1000": 'idx_wordfreqs_freqx_id',
+    "form in ja,on,hän": 'idx_wordfreqs_form_freqx',
+}
+
+# Plans in the query table, which has the lemmas without a join
+wideplans = {
+    "lemma = valtakunta and compound": 'idx_wordquery_lemmac_freqx',
+    "start = auto": 'idx_wordquery_form_rev',
+    "middle = sta": planner.trigramtable,
+    "clitic != _": 'idx_wordquery_freqx_id',
+    "end in ssa,ssä": 'idx_wordquery_freqx_revform',
+}
+
+# Plans of queries ordered by other columns: an index starting with the column is in the order
+# of the results, without one all the rows are read unless looking them up costs less
+orderedplans = {
+    ("clitic != _", 'w.form ASC'): 'idx_wordfreqs_form_freqx',
+    ("clitic != _", 'w.len DESC'): '',
+    ("start = auto", 'w.len DESC'): 'idx_wordfreqs_form_rev',
+}
+
+
+@pytest.fixture(scope="module")
+def datafile():
+    """Get fixed datafile."""
+    datadir = "tests"
+    dbfile = "fi_gutenberg_70M_100.db"
+    return os.path.join(datadir, dbfile)
+
+
+@pytest.fixture(scope="module")
+def analyzed(datafile, tmp_path_factory):
+    """Get a copy of the database with the current indexes and the trigram index, analyzed for the query planner."""
+    dbfile = str(tmp_path_factory.mktemp('planner') / 'analyzed.db')
+    shutil.copy(datafile, dbfile)
+    sqlcon = dbutil.get_connection(dbfile)
+    buildutil.add_schema(sqlcon, 'wordfreqs_indexes.sql')
+    buildutil.create_trigram_table(sqlcon)
+    buildutil.analyze_database(sqlcon)
+    return dbfile
+
+
+def get_plan(dbc: dbutil.DatabaseConnection, query: str, orderby: str = 'w.frequency') -> str:
+    """Get the plan of a query: the forced index, the trigram index or ''."""
+    sqlstr = dbc.compiled.get(dbc.query_key(query, orderby, False, True, True))[0]
+    if planner.trigramtable in sqlstr:
+        return planner.trigramtable
+    parts = sqlstr.split(' indexed by ')
+    return parts[1].split()[0].rstrip(',') if len(parts) > 1 else ''
+
+
+def check_results(dbc: dbutil.DatabaseConnection, query: str, orderby: str = 'w.frequency'):
+    """Check that the results of a query are the same as with the index chosen by SQLite.
+
+    With as many results as the row limit, the rows tied with the last value of the order may differ.
+    """
+    column = orderby.split(' ')[0][2:]
+    df1, _, _ = dbutil.get_frequency_dataframe(dbc, query=query, orderby=orderby, grams=True, lemmas=True)
+    df2, _, _ = dbutil.get_frequency_dataframe(dbc, query=query, orderby=orderby, grams=True, lemmas=True,
+                                               defaultindex=True)
+    check.equal(list(df1[column]), list(df2[column]), query)
+    if len(df1) == dbc.rowlimit():
+        df1 = df1[df1[column] != df1[column].iloc[-1]]
+        df2 = df2[df2[column] != df2[column].iloc[-1]]
+    columns = list(df1.columns)
+    df1 = df1.sort_values(columns).reset_index(drop=True)
+    df2 = df2.sort_values(columns).reset_index(drop=True)
+    check.is_true(df1.equals(df2), query)
+
+
+def test_histogram():
+    """Check the samples of a histogram and the estimates from them."""
+    counts = [(1, 40), (2, 5), (3, 5), (4, 5), (5, 5), (6, 20), (7, 20)]
+    samples = planner.get_histogram(counts, buckets=4)
+    # The first and last values and the values crossing each quarter of the rows are sampled
+    check.equal(samples, [(1, 40, 0, 0), (3, 5, 45, 2), (6, 20, 60, 5), (7, 20, 80, 6)])
+    check.equal(planner.histogram_rows(samples, '=', 1), 40)
+    check.equal(planner.histogram_rows(samples, '<=', 3), 50)
+    check.equal(planner.histogram_rows(samples, '>=', 6), 40)
+    # A value between samples has the average rows of the values between them
+    check.equal(planner.histogram_rows(samples, '<', 2), 40)
+    check.equal(planner.histogram_rows(samples, '=', 2), 5)
+    check.equal(round(planner.histogram_rows(samples, '=', 4), 6), 5)
+    check.equal(planner.histogram_rows(samples, '>', 10), 0)
+    check.is_none(planner.histogram_rows(samples, '<', 'a'))
+
+
+def test_statistics(analyzed):
+    """Check the estimates of the histograms against the actual rows, which differ by less than a bucket."""
+    sqlcon = dbutil.get_connection(analyzed)
+    statistics = planner.Statistics(sqlcon)
+    check.is_true(statistics.analyzed())
+    rows = sqlcon.execute('SELECT count(*) FROM wordfreqs').fetchone()[0]
+    check.equal(statistics.tablerows['wordfreqs'], rows)
+    for column, comparator, value, sqlstr in [
+            ('len', '=', '5', 'SELECT count(*) FROM wordfreqs WHERE len = 5'),
+            ('len', '>', '7', 'SELECT count(*) FROM wordfreqs WHERE len > 7'),
+            ('frequency', '<=', '3', 'SELECT count(*) FROM wordfreqs WHERE frequency <= 3'),
+            ('ambform', '<', '0.9', 'SELECT count(*) FROM wordfreqs WHERE ambform < 0.9'),
+            ('pos', 'in', 'NOUN,VERB', "SELECT count(*) FROM wordfreqs WHERE pos IN ('NOUN', 'VERB')"),
+            ('nouncase', '=', 'Ine',
+             "SELECT count(*) FROM wordfreqs w JOIN features ft ON w.featid = ft.featid WHERE ft.nouncase = 'Ine'"),
+            ('clitic', '!=', '_',
+             "SELECT count(*) FROM wordfreqs w JOIN features ft ON w.featid = ft.featid WHERE ft.clitic != '_'")]:
+        actual = sqlcon.execute(sqlstr).fetchone()[0]
+        estimate = statistics.selectivity(['wordfreqs', 'features'], column, comparator, value)
+        check.less(abs(estimate * rows - actual), rows / planner.histogrambuckets, f'{column} {comparator} {value}')
+
+
+def test_plans(analyzed):
+    """Check the plans chosen for the queries."""
+    dbutil.set_result_cache(0)
+    dbc = dbutil.DatabaseConnection(analyzed)
+    for query, plan in plans.items():
+        check.equal(get_plan(dbc, query), plan, query)
+        check_results(dbc, query)
+
+
+def test_wide_plans(analyzed, tmp_path):
+    """Check the plans chosen for the queries in the query table."""
+    dbutil.set_result_cache(0)
+    dbfile = str(tmp_path / 'wide.db')
+    shutil.copy(analyzed, dbfile)
+    sqlcon = dbutil.get_connection(dbfile)
+    buildutil.create_query_table(sqlcon)
+    buildutil.analyze_database(sqlcon)
+    dbc = dbutil.DatabaseConnection(dbfile)
+    for query, plan in wideplans.items():
+        check.equal(get_plan(dbc, query), plan, query)
+        check_results(dbc, query)
+
+
+def test_ordered_plans(analyzed):
+    """Check the plans of queries ordered by other columns than frequency."""
+    dbutil.set_result_cache(0)
+    dbc = dbutil.DatabaseConnection(analyzed)
+    for (query, orderby), plan in orderedplans.items():
+        check.equal(get_plan(dbc, query, orderby), plan, f'{query} {orderby}')
+        check_results(dbc, query, orderby)
+
+
+def test_analyze(datafile, tmp_path):
+    """Check that the statistics are read again when the database is analyzed."""
+    dbfile = str(tmp_path / 'unanalyzed.db')
+    shutil.copy(datafile, dbfile)
+    dbc = dbutil.DatabaseConnection(dbfile)
+    check.is_false(dbc.statistics().analyzed())
+    # Analyzed by another connection, as in a build script
+    buildutil.analyze_database(dbutil.get_connection(dbfile))
+    check.is_true(dbc.statistics().analyzed())
+    check.is_true(dbc.statistics().histograms[('wordfreqs', 'len')])
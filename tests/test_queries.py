@@ -5,6 +5,8 @@
 import sys
 import os
 import os.path
+import shutil
+import threading
 import pytest
 from pytest_check import check
 import pandas as pd
@@ -13,7 +15,8 @@ currdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.dirname(currdir)
 sys.path.append(parentdir)
 
-from lib import dbutil, uiutil
+from lib import buildutil, dbutil, planner, uiutil
+from lib.memo import ResultCache
 
 
 @pytest.fixture(scope="session")
@@ -90,6 +93,262 @@ def test_basic(dbc):
     # assert len(df2[df2.form != 'voi']) == 0
 
 
+def test_compiled(dbc):
+    """Check that repeated queries use the compiled query."""
+    # No results are cached with no memory
+    dbutil.set_result_cache(0)
+    q1 = "form = voi and ambform < 0.9"
+    df1, _, _ = dbutil.get_frequency_dataframe(dbc, query=q1, grams=True, lemmas=True)
+    hits, misses, _ = dbc.compiled.stats()
+    df2, _, _ = dbutil.get_frequency_dataframe(dbc, query=f' {q1} ', grams=True, lemmas=True)
+    check.equal(dbc.compiled.stats()[:2], (hits + 1, misses))
+    check.is_true(df1.equals(df2))
+    # Different flags are compiled separately
+    dbutil.get_frequency_dataframe(dbc, query=q1)
+    check.equal(dbc.compiled.stats()[:2], (hits + 1, misses + 1))
+
+
+def test_thread(datafile, tmp_path):
+    """Check that queries are compiled and planned with a new connection in another thread, as in the UI."""
+    dbutil.set_result_cache(0)
+    dbfile = str(tmp_path / 'threads.db')
+    shutil.copy(datafile, dbfile)
+    sqlcon = dbutil.get_connection(dbfile)
+    buildutil.create_trigram_table(sqlcon)
+    buildutil.analyze_database(sqlcon)
+    dbc = dbutil.DatabaseConnection(dbfile)
+    queries = ["start = auto", "middle = sta", "clitic != _"]
+    results = {}
+    errors = []
+
+    def run():
+        try:
+            for query in queries:
+                results[query] = dbutil.get_frequency_dataframe(dbc, query=query, newconnection=True)
+            results['page'] = dbutil.get_frequency_page(dbc, queries[0], newconnection=True)
+        except Exception as e:  # pylint: disable=broad-except
+            errors.append(repr(e))
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    assert not errors, errors
+    for query in queries:
+        df1, _, message = results[query]
+        check.equal(message, 'success', query)
+        check.is_true(df1.equals(dbutil.get_frequency_dataframe(dbc, query=query)[0]), query)
+    check.equal(results['page'][3], 'success')
+
+
+@pytest.fixture
+def cachefile(tmp_path):
+    """Get a file for the result cache, restoring the default cache afterwards."""
+    default = dbutil.resultcache
+    yield str(tmp_path / 'results.db')
+    dbutil.resultcache = default
+
+
+def test_result_cache(dbc, cachefile):
+    """Check that repeated queries use the cached result, also after a restart."""
+    dbutil.set_result_cache(64, filename=cachefile)
+    q1 = "form = voi and ambform < 0.9"
+    df1, _, _ = dbutil.get_frequency_dataframe(dbc, query=q1, grams=True, lemmas=True)
+    df2, _, _ = dbutil.get_frequency_dataframe(dbc, query=q1, grams=True, lemmas=True)
+    check.equal(dbutil.resultcache.stats()[:2], (1, 1))
+    check.is_true(df1.equals(df2))
+    # Row limit is part of the key
+    dbc.rowlimit(10)
+    dbutil.get_frequency_dataframe(dbc, query=q1, grams=True, lemmas=True)
+    check.equal(dbutil.resultcache.stats()[:2], (1, 2))
+    dbc.rowlimit(10000)
+    dbutil.set_result_cache(64, filename=cachefile)
+    df3, _, _ = dbutil.get_frequency_dataframe(dbc, query=q1, grams=True, lemmas=True)
+    check.equal((dbutil.resultcache.hits, dbutil.resultcache.diskhits), (1, 1))
+    check.is_true(df1.equals(df3))
+
+
+def test_result_cache_update(datafile, cachefile, tmp_path):
+    """Check that cached results are not used after rows are updated in place."""
+    dbfile = str(tmp_path / 'updated.db')
+    shutil.copy(datafile, dbfile)
+    dbutil.set_result_cache(64, filename=cachefile)
+    dbc = dbutil.DatabaseConnection(dbfile)
+    q1 = "ambform > 0.5"
+    df1, _, _ = dbutil.get_frequency_dataframe(dbc, query=q1)
+    check.greater(len(df1), 0)
+    # Updated by another connection, as in a build script
+    sqlcon = dbutil.get_connection(dbfile)
+    sqlcon.execute('UPDATE wordfreqs SET ambform = 0')
+    sqlcon.commit()
+    df2, _, _ = dbutil.get_frequency_dataframe(dbc, query=q1)
+    check.equal(len(df2), 0)
+    check.equal(dbutil.resultcache.stats()[:2], (0, 2))
+    # Nor from the disk after a restart
+    dbutil.set_result_cache(64, filename=cachefile)
+    df3, _, _ = dbutil.get_frequency_dataframe(dbutil.DatabaseConnection(dbfile), query=q1)
+    check.equal(len(df3), 0)
+    check.equal(dbutil.resultcache.diskhits, 0)
+
+
+def test_unversioned(datafile, cachefile, tmp_path):
+    """Check that queries of a database without a content version are not cached."""
+    dbfile = str(tmp_path / 'wal.db')
+    shutil.copy(datafile, dbfile)
+    dbutil.get_connection(dbfile).execute('PRAGMA journal_mode=WAL')
+    dbutil.set_result_cache(64, filename=cachefile)
+    dbc = dbutil.DatabaseConnection(dbfile)
+    check.is_none(dbc.fingerprint())
+    q1 = "form = voi and ambform < 0.9"
+    df1, _, _ = dbutil.get_frequency_dataframe(dbc, query=q1, grams=True, lemmas=True)
+    df2, _, _ = dbutil.get_frequency_dataframe(dbc, query=q1, grams=True, lemmas=True)
+    check.is_true(df1.equals(df2))
+    check.equal(dbc.compiled.stats()[:2], (0, 0))
+    check.equal(dbutil.resultcache.stats()[:2], (0, 0))
+    check.equal(len(dbutil.resultcache.values), 0)
+
+
+def test_result_eviction(tmp_path):
+    """Check that the least recently used results are evicted."""
+    cache = ResultCache(1000 / 2**20, sizeof=len, filename=str(tmp_path / 'results.db'), diskbudgetmb=1500 / 2**20)
+    for key in 'abc':
+        cache.put(key, key * 400, 1.0)
+    check.equal(list(cache.values), ['b', 'c'])
+    cache.get('b')
+    cache.put('d', 'd' * 400, 1.0)
+    check.equal(list(cache.values), ['b', 'd'])
+    # Too large to cache
+    cache.put('e', 'e' * 2000, 1.0)
+    check.equal(list(cache.values), ['b', 'd'])
+    check.is_none(cache.get('e'))
+    # The file has room for three values (pickled with some overhead): 'a' is evicted
+    check.is_none(cache.get('a'))
+    check.equal(cache.get('c'), 'c' * 400)
+    check.equal(cache.stats()[:2], (2, 2))
+    check.equal(cache.diskhits, 1)
+
+
+def test_profile(dbc):
+    """Check that query profiles are recorded when profiling."""
+    dbutil.set_result_cache(0)
+    dbutil.profiles.clear()
+    q1 = "form = voi and ambform < 0.9"
+    dbutil.profiling = True
+    try:
+        df1, _, _ = dbutil.get_frequency_dataframe(dbc, query=q1, grams=True, lemmas=True)
+    finally:
+        dbutil.profiling = False
+    check.equal(len(dbutil.profiles), 1)
+    profile = dbutil.profiles[0]
+    for key in ['parse', 'sql', 'materialize', 'postprocess', 'steps', 'plan']:
+        check.is_in(key, profile)
+    check.greater_equal(profile['rows'], len(df1))
+    check.is_in('SEARCH', profile['plan'])
+    dbutil.get_frequency_dataframe(dbc, query=q1, grams=True, lemmas=True)
+    check.equal(len(dbutil.profiles), 1)
+
+
+def same_rows(df1: pd.DataFrame, df2: pd.DataFrame) -> bool:
+    """Check that dataframes have the same rows in any order."""
+    columns = list(df1.columns)
+    return df1.sort_values(columns).reset_index(drop=True).equals(df2.sort_values(columns).reset_index(drop=True))
+
+
+def get_pages(dbc, query: str, orderby: str) -> list:
+    """Get all pages of a query."""
+    pages = []
+    after = None
+    while True:
+        page, after, _, _ = dbutil.get_frequency_page(dbc, query, after=after, pagesize=7, orderby=orderby,
+                                                      grams=True, lemmas=True)
+        pages.append(page)
+        if after is None:
+            return pages
+
+
+def test_pages(dbc):
+    """Check that pages add up to the full result without duplicates."""
+    dbutil.set_result_cache(0)
+    q1 = "start = auto"
+    full, _, _ = dbutil.get_frequency_dataframe(dbc, query=q1, grams=True, lemmas=True)
+    pages = get_pages(dbc, q1, 'w.frequency')
+    paged = pd.concat(pages, ignore_index=True)
+    check.greater(len(pages), 1)
+    check.equal(list(paged.columns), list(full.columns))
+    check.is_true(paged.frequency.is_monotonic_decreasing)
+    check.equal(paged.duplicated(['lemma', 'form', 'pos', 'feats']).sum(), 0)
+    check.is_true(same_rows(paged, full))
+    # Ordered by a text column in both directions
+    for orderby in ['w.form DESC', 'w.form ASC']:
+        paged = pd.concat(get_pages(dbc, q1, orderby), ignore_index=True)
+        check.equal(len(paged), len(full), orderby)
+        forms = paged.form if orderby.endswith('ASC') else paged.form[::-1]
+        check.is_true(forms.is_monotonic_increasing, orderby)
+
+
+def test_query_table(datafile, tmp_path):
+    """Check that queries give the same results from the query table."""
+    dbutil.set_result_cache(0)
+    dbfile = str(tmp_path / 'wide.db')
+    shutil.copy(datafile, dbfile)
+    dbc = dbutil.DatabaseConnection(dbfile)
+    queries = ["start = auto", "clitic != _", "nouncase = Ine and len > 5", "lemma = valtakunta and compound"]
+    joined = [dbutil.get_frequency_dataframe(dbc, query=q, grams=True, lemmas=True)[0] for q in queries]
+    # The table is built by another connection, as in a build script
+    buildutil.create_query_table(dbutil.get_connection(dbfile))
+    for query, df1 in zip(queries, joined):
+        key = dbc.query_key(query, 'w.frequency', False, True, True)
+        check.is_in(dbutil.querytable, dbc.compiled.get(key)[0])
+        df2, _, _ = dbutil.get_frequency_dataframe(dbc, query=query, grams=True, lemmas=True)
+        check.greater(len(df2), 0)
+        check.is_true(same_rows(df1, df2), query)
+    # Changing the tables drops the query table
+    buildutil.drop_query_table(dbutil.get_connection(dbfile))
+    key = dbc.query_key(queries[0], 'w.frequency', False, True, True)
+    check.is_not_in(dbutil.querytable, dbc.compiled.get(key)[0])
+
+
+def test_trigram_table(datafile, tmp_path):
+    """Check that middle queries give the same results with candidates from the trigram index."""
+    dbutil.set_result_cache(0)
+    dbfile = str(tmp_path / 'trigrams.db')
+    shutil.copy(datafile, dbfile)
+    dbc = dbutil.DatabaseConnection(dbfile)
+    # Substrings shorter than three characters are not looked up
+    queries = {"middle = sta": True, "middle in sta,iin": True, "middle = uto and pos = AUX": True,
+               "middle in la,sta": False}
+    scanned = [dbutil.get_frequency_dataframe(dbc, query=q, grams=True, lemmas=True)[0] for q in queries]
+    buildutil.create_trigram_table(dbutil.get_connection(dbfile))
+    for (query, lookup), df1 in zip(queries.items(), scanned):
+        key = dbc.query_key(query, 'w.frequency', False, True, True)
+        check.equal(planner.trigramtable in dbc.compiled.get(key)[0], lookup)
+        df2, _, _ = dbutil.get_frequency_dataframe(dbc, query=query, grams=True, lemmas=True)
+        check.greater(len(df2), 0)
+        check.is_true(same_rows(df1, df2), query)
+    buildutil.drop_trigram_table(dbutil.get_connection(dbfile))
+    key = dbc.query_key("middle = sta", 'w.frequency', False, True, True)
+    check.is_not_in(planner.trigramtable, dbc.compiled.get(key)[0])
+
+
+def test_start_end(dbc):
+    """Check that start and end queries read the range of the more selective one."""
+    dbutil.set_result_cache(0)
+    sqlcon = dbc.get_connection()
+    for query, start, end in [("start = auto and end = lla", 'auto', 'lla'),
+                              ("start = k and end = ssa and pos = AUX", 'k', 'ssa'),
+                              ("start = ka and end = a and middle = ll", 'ka', 'a')]:
+        starts = sqlcon.execute("SELECT count(*) FROM wordfreqs WHERE form GLOB ?", (start + '*',)).fetchone()[0]
+        ends = sqlcon.execute("SELECT count(*) FROM wordfreqs WHERE revform GLOB ?", (end[::-1] + '*',)).fetchone()[0]
+        key = dbc.query_key(query, 'w.frequency', False, True, True)
+        check.is_in('idx_wordfreqs_form_rev' if starts < ends else 'idx_wordfreqs_rev_form', dbc.compiled.get(key)[0])
+        # Same results as without planning
+        df1, _, _ = dbutil.get_frequency_dataframe(dbc, query=query, grams=True, lemmas=True)
+        df2, _, _ = dbutil.get_frequency_dataframe(dbc, query=query, grams=True, lemmas=True, defaultindex=True)
+        check.greater(len(df1), 0)
+        check.is_true(same_rows(df1, df2), query)
+        page, _, _, _ = dbutil.get_frequency_page(dbc, query, pagesize=len(df1), grams=True, lemmas=True)
+        check.equal(sorted(page.form), sorted(df1.form))
+
+
 def test_clitic(dbc):
     """Check that clitics are queried properly."""
     q1 = "clitic != _"
@@ -10,7 +10,7 @@
 import sys
 # import faulthandler; faulthandler.enable()
 from typing import Optional
-from os.path import exists, getsize, join
+from os.path import exists, expanduser, getsize, join
 import configparser
 # from collections import defaultdict
 from pathlib import Path
@@ -262,6 +262,8 @@ class DBWorker(QRunnable):
             end = time.perf_counter()
             diff = end - start
             logger.debug('Query finished in %.1f seconds', diff)
+            if dbutil.profiling and dbutil.profiles:
+                logger.info('Query profile: %s', dbutil.format_profile(dbutil.profiles[-1]))
             self.signals.finished.emit()
             self.signals.result.emit(diff, newdf)
         except Exception as we:
@@ -524,6 +526,13 @@ class MainWindow(QMainWindow):
         window_menu.addSeparator()
         window_menu.addAction(menuaction_smaller)
         window_menu.addAction(menuaction_bigger)
+        if dbutil.profiling:
+            menuaction_profile = QAction("&Show query profile", self)
+            menuaction_profile.setStatusTip("Show profile of the latest query")
+            menuaction_profile.setShortcut(QKeySequence("Ctrl+p"))
+            menuaction_profile.triggered.connect(self.showProfile)
+            window_menu.addSeparator()
+            window_menu.addAction(menuaction_profile)
 
         if df:
             self.setData(df)
@@ -913,6 +922,13 @@ class MainWindow(QMainWindow):
                 self.setData(df)
         self.clearresultsifempty = False
 
+    def showProfile(self):
+        if dbutil.profiles:
+            text = dbutil.format_profile(dbutil.profiles[-1])
+        else:
+            text = 'No queries profiled yet'
+        QMessageBox.information(self, "Query profile", text)
+
     def setQueryError(self, _text: str, error: str):
         if '\n' in error:
             self.statusfield.setText('Issue with query:\n%s' % error)
@@ -1167,10 +1183,15 @@ if __name__ == "__main__":
     parser.add_argument('-e', '--exit',
                         action='store_true',
                         help='Exit from GUI')
+    parser.add_argument('-p', '--profile',
+                        action='store_true',
+                        help='Record query profiles: timings, steps and plans')
     args = parser.parse_args()
     if args.exit:
         print('Exiting from GUI')
         sys.exit()
+    if args.profile:
+        dbutil.profiling = True
 
     logger.info('Launching application at %s', datetime.now())
     inifile = 'lastu.ini'
@@ -1189,6 +1210,11 @@ if __name__ == "__main__":
 
     logger.debug('Got final database file: %s', dbfile)
 
+    if (resultcachemb := configfile.getConfigValue('query.resultcache')) is not None:
+        resultcachefile = configfile.getConfigValue('query.resultcachefile')
+        logger.debug('Setting result cache to %d MB, file %s', resultcachemb, resultcachefile)
+        dbutil.set_result_cache(resultcachemb, filename=expanduser(resultcachefile) if resultcachefile else None)
+
     try:
         logger.info("Connecting to %s...", dbfile)
         dbconn = dbutil.DatabaseConnection(dbfile)